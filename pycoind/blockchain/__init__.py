@@ -24,12 +24,13 @@
 import threading
 
 from . import block
+from . import blockfile
 from . import keys
 from . import transaction
 from . import unspent
 
 from .. import coins
-from .. import script
+from .. import protocol
 from .. import util
 
 __all__ = ['BlockChain']
@@ -39,16 +40,16 @@ _0 = chr(0) * 32
 
 class BlockChain(object):
 
-    def __init__(self, data_dir = None, coin = coins.Bitcoin):
+    def __init__(self, data_dir = None, coin = coins.Bitcoin, profile = None):
         if data_dir is None:
             data_dir = util.default_data_directory()
         self._data_dir = data_dir
         self._coin = coin
 
         # a block database also holds a reference to a transaction database
-        self._blocks = block.Database(data_dir, coin)
+        self._blocks = block.Database(data_dir, coin, profile)
 
-        self._unspent = unspent.Database(data_dir, coin, processes = 1)
+        self._unspent = unspent.Database(data_dir, coin, processes = 1, profile = profile)
 
     data_dir = property(lambda s: s._data_dir)
     coin = property(lambda s: s._coin)
@@ -73,33 +74,46 @@ class BlockChain(object):
 
 
     def get_unspent_outputs(self, address):
-        'Return the list of unspent transaction outputs (utxo) for an address.'
+        '''Return the list of unspent transaction outputs (utxo) for an address,
+           as (outpoint, output) tuples. Only pay-to-pubkey-hash addresses are
+           supported; others (eg. pay-to-script-hash) raise a ValueError.'''
 
-        raise NotImplementedError('coming soon...')
+        return self.get_unspent_outputs_many([address])[address]
 
-        outputs = []
-        for uock in self._unspent._list_unspent(address):
 
-            # get the transaction for this utxo
-            txck = keys.get_uock_txck(uock)
-            txn = self._blocks._txns._get(txck)
+    def get_unspent_outputs_many(self, addresses):
+        '''Return a dict mapping each address to its list of unspent
+           transaction outputs (see get_unspent_outputs).'''
 
-            output_index = keys.get_uock_index(uock)
+        outputs = self._unspent.unspent_outputs_many(addresses)
 
-            # remove false positives (since the database only stores a hint)
-            txio = script.Script(txn)
-            if txio.output_address(output_index) == address:
-                outputs.append(txn.outputs[output_index])
+        # look up all the txids together
+        txcks = [keys.get_uock_txck(o[0]) for a in outputs for o in outputs[a]]
+        txids = self._blocks._txns._get_txids(txcks)
 
-        return outputs
+        result = dict()
+        for (address, unspent) in outputs.iteritems():
+            result[address] = [ ]
+            for (uock, value, pk_script) in unspent:
+                txid = txids[keys.get_uock_txck(uock)]
+                outpoint = protocol.OutPoint(txid, keys.get_uock_index(uock))
+                result[address].append((outpoint, protocol.TxnOut(value, pk_script)))
+
+        return result
 
 
     def get_balance(self, address):
-        'Return the current balance for an address.'
+        '''Return the current balance for an address, in coins (as a float).
+           See get_unspent_outputs for the supported addresses.'''
+
+        return self.get_balances([address])[address]
+
 
-        raise NotImplementedError('coming soon...')
+    def get_balances(self, addresses):
+        'Return a dict mapping each address to its current balance.'
 
-        return sum(o.value for o in self.get_unspent_outputs(address)) / 100000000.0
+        balances = self._unspent.balances(addresses)
+        return dict((a, v / 100000000.0) for (a, v) in balances.iteritems())
 
 
     def __getitem__(self, name):
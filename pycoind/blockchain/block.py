@@ -21,10 +21,12 @@
 # THE SOFTWARE.
 
 
+import array
 import math
 import struct
 import time
 
+from . import blockfile
 from . import database
 from . import transaction
 
@@ -36,6 +38,32 @@ __all__ = ['Database', 'InvalidBlockException']
 # A buffer of 32 chr(0) bytes
 _0 = buffer(chr(0) * 32)
 
+# chainwork is stored as 32 byte big-endian blobs, which sort numerically
+def _pack_work(work):
+    return ('%064x' % work).decode('hex')
+
+def _unpack_work(data):
+    return int(str(data).encode('hex'), 16)
+
+# Skip Pointers
+#
+# Each block (above height 0) stores the id of one ancestor, at the height
+# given by _skip_height, besides its parent. Following these pointers finds
+# any ancestor in O(log n) steps, rather than one step per block. (this is
+# the scheme used by the reference client's CBlockIndex::pskip)
+
+def _skip_height(height):
+    'Returns the height of the ancestor a block at height skips to.'
+
+    if height < 2:
+        return 0
+
+    # turn off the lowest 1 bit (twice for odd heights)
+    if height & 1:
+        n = (height - 1) & (height - 2)
+        return (n & (n - 1)) + 1
+    return height & (height - 1)
+
 class InvalidBlockException(Exception): pass
 
 class Block(object):
@@ -59,6 +87,9 @@ class Block(object):
     height = property(lambda s: s.__data['height'])
     txn_count = property(lambda s: s.__data['txn_count'])
 
+    # the total expected work of the chain up to and including this block
+    chainwork = property(lambda s: _unpack_work(s.__data['chainwork']))
+
     mainchain = property(lambda s: s.__data['mainchain'])
 
     @property
@@ -81,15 +112,16 @@ class Block(object):
 
     @property
     def previous_block(self):
-        cursor = self.__database._cursor()
-        cursor.execute(self.__database.sql_select + ' where id = ?', (self._previous_blockid, ))
-        row = cursor.fetchone()
-        if row:
-            return Block(self.__database, row)
-        return None
+        return self.__database._get(self._previous_blockid)
 
     @property
     def next_block(self):
+        index = self.__database._index
+        if index is not None and self.mainchain:
+            blockid = index.get_mainchain_id(self.height + 1)
+            if blockid is None: return None
+            return self.__database._get(blockid)
+
         cursor = self.__database._cursor()
         cursor.execute(self.__database.sql_select + ' where previous_id = ?', (self._blockid, ))
         row = cursor.fetchone()
@@ -97,6 +129,15 @@ class Block(object):
             return Block(self.__database, row)
         return None
 
+    def get_ancestor(self, height):
+        'Returns the ancestor of this block at height, or None if none.'
+
+        if not (0 <= height <= self.height):
+            return None
+
+        header = self.__database._header(self._blockid)
+        return self.__database._get(self.__database._ancestor(header, height)[0])
+
     def __str__(self):
         return '<Block %s>' % (self.hash.encode('hex'), )
 
@@ -115,13 +156,112 @@ class Block(object):
         '''Update the database with the transaction count and attaches the
            transactions to this Block instance. INTERNAL USE ONLY!!'''
 
-        cursor = self.__database._cursor()
-        cursor.execute('update blocks set txn_count = ? where id = ?', (len(transactions), self._blockid))
-        self.__database._connection.commit()
+        self.__database._update_transactions([(self, transactions)])
+
+    def _set_transactions(self, transactions):
+        '''Attaches the transactions to this Block instance, without updating
+           the database. INTERNAL USE ONLY!!'''
 
         self.__data['txns'] = transactions
         self.__data['txn_count'] = len(transactions)
 
+    _database = property(lambda s: s.__database)
+
+
+class HeaderIndex(object):
+    '''A compact in-memory index of every block's previous id, skip id, height,
+       hash, chainwork and mainchain flag, stored in arrays indexed by block id, so
+       finding and walking blocks (and the top block) needs no queries.
+
+       The index only sees headers added through its Database, so it must
+       only be used by the process adding headers.'''
+
+    def __init__(self, cursor):
+        self._previous_ids = array.array('l')
+        self._skip_ids = array.array('l')
+        self._heights = array.array('l')
+        self._mainchain = array.array('b')
+        self._hashes = bytearray()
+        self._chainwork = bytearray()
+
+        # maps block hash to block id
+        self._ids = dict()
+
+        # maps mainchain height to block id
+        self._mainchain_ids = array.array('l')
+
+        cursor.execute('select id, previous_id, hash, height, mainchain, chainwork, skip_id from blocks order by id')
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows: break
+            for (blockid, previous_id, block_hash, height, mainchain, chainwork, skip_id) in rows:
+                self.add(blockid, previous_id, str(block_hash), height, mainchain, _unpack_work(chainwork), skip_id)
+
+    height = property(lambda s: len(s._mainchain_ids) - 1)
+    top_id = property(lambda s: s._mainchain_ids[-1])
+
+    def add(self, blockid, previous_id, block_hash, height, mainchain, chainwork, skip_id):
+        'Add a block. Block ids must be added in increasing order.'
+
+        # pad any gaps in the ids (rowids start at 1)
+        while len(self._heights) < blockid:
+            self._previous_ids.append(-1)
+            self._skip_ids.append(-1)
+            self._heights.append(-1)
+            self._mainchain.append(0)
+            self._hashes.extend(str(_0))
+            self._chainwork.extend(str(_0))
+
+        self._previous_ids.append(previous_id)
+        self._skip_ids.append(skip_id)
+        self._heights.append(height)
+        self._mainchain.append(0)
+        self._hashes.extend(block_hash)
+        self._chainwork.extend(_pack_work(chainwork))
+
+        self._ids[block_hash] = blockid
+
+        if mainchain:
+            self.set_mainchain(blockid, True)
+
+    def set_mainchain(self, blockid, mainchain):
+        self._mainchain[blockid] = int(mainchain)
+
+        # the pre-genesis block has no height to index
+        height = self._heights[blockid]
+        if height < 0:
+            return
+
+        if mainchain:
+            while len(self._mainchain_ids) <= height:
+                self._mainchain_ids.append(-1)
+            self._mainchain_ids[height] = blockid
+
+        # a chain with more work may be shorter; drop the orphaned top
+        elif height < len(self._mainchain_ids) and self._mainchain_ids[height] == blockid:
+            self._mainchain_ids[height] = -1
+            while self._mainchain_ids[-1] == -1:
+                self._mainchain_ids.pop()
+
+    def get_id(self, block_hash):
+        return self._ids.get(block_hash)
+
+    def get_hash(self, blockid):
+        return str(self._hashes[blockid * 32:(blockid + 1) * 32])
+
+    def get_mainchain_id(self, height):
+        if 0 <= height < len(self._mainchain_ids):
+            return self._mainchain_ids[height]
+        return None
+
+    def header(self, blockid):
+        '''Returns the (id, previous_id, height, mainchain, chainwork, skip_id)
+           tuple for a block.'''
+
+        chainwork = _unpack_work(self._chainwork[blockid * 32:(blockid + 1) * 32])
+        return (blockid, self._previous_ids[blockid], self._heights[blockid],
+                self._mainchain[blockid], chainwork, self._skip_ids[blockid])
+
 
 class Database(database.Database):
 
@@ -139,24 +279,90 @@ class Database(database.Database):
         ('height', 'integer not null', True),
         ('txn_count', 'integer not null', True),
         ('mainchain', 'boolean not null', False),
+
+        ('chainwork', 'blob', True),
+        ('skip_id', 'integer', False),
     ]
 
     Name = 'blocks'
 
-    def __init__(self, data_dir = None, coin = coins.Bitcoin):
-        database.Database.__init__(self, data_dir, coin)
+    Version = 3
+
+    def _migrate_from_1(self, cursor):
+        'Adds the chainwork column, summing the work along every chain.'
+
+        # a previously interrupted migration may have added the column
+        cursor.execute('pragma table_info(blocks)')
+        if 'chainwork' not in [r[1] for r in cursor.fetchall()]:
+            cursor.execute('alter table blocks add column chainwork blob')
+            cursor.execute('create index index_chainwork on blocks (chainwork)')
+
+        # a block's parent always has a lower id
+        chainwork = dict()
+        updates = [ ]
+        cursor.execute('select id, previous_id, bits, height from blocks order by id')
+        for (blockid, previous_id, bits, height) in cursor.fetchall():
+            work = 0
+            if height >= 0:
+                work = chainwork[previous_id] + util.get_work(bits)
+            chainwork[blockid] = work
+            updates.append((buffer(_pack_work(work)), blockid))
+
+        cursor.executemany('update blocks set chainwork = ? where id = ?', updates)
+
+    def _migrate_from_2(self, cursor):
+        'Adds the skip_id column, computing every skip pointer.'
+
+        # a previously interrupted migration may have added the column
+        cursor.execute('pragma table_info(blocks)')
+        if 'skip_id' not in [r[1] for r in cursor.fetchall()]:
+            cursor.execute('alter table blocks add column skip_id integer')
+
+        # a block's ancestors always have lower ids
+        headers = dict()
+        updates = [ ]
+        cursor.execute('select id, previous_id, height from blocks order by id')
+        for (blockid, previous_id, height) in cursor.fetchall():
+            skip_id = -1
+            if height > 0:
+                skip_id = self._ancestor(headers[previous_id], _skip_height(height), headers.get)[0]
+            headers[blockid] = (blockid, previous_id, height, 0, 0, skip_id)
+            updates.append((skip_id, blockid))
+
+        cursor.executemany('update blocks set skip_id = ? where id = ?', updates)
+
+    Migrations = {1: _migrate_from_1, 2: _migrate_from_2}
+
+    def __init__(self, data_dir = None, coin = coins.Bitcoin, profile = None, migrate = False, header_index = False, block_files = False):
+        database.Database.__init__(self, data_dir, coin, profile, migrate)
 
         # connect to the block database
         self._connection = self.get_connection()
 
-        # transaction database (used by Block to for .transactions)
-        self._txns = transaction.Database(self.data_dir, coin)
+        # in-memory header index (only for the process adding headers)
+        self._index = None
+        if header_index:
+            self._index = HeaderIndex(self._cursor())
+
+        # transaction database (used by Block to for .transactions); block
+        # files are used if the data_dir already has them, or if requested
+        if blockfile.Database.exists(self.data_dir, coin):
+            self._txns = blockfile.Database(self.data_dir, coin, profile, migrate)
+
+        elif block_files:
+            # switching would silently begin a second (empty) store
+            if transaction.Database.exists(self.data_dir, coin):
+                raise database.DatabaseException('data directory has sqlite transactions; cannot use block files')
+            self._txns = blockfile.Database(self.data_dir, coin, profile, migrate)
+
+        else:
+            self._txns = transaction.Database(self.data_dir, coin, profile, migrate)
 
 
     def populate_database(self, cursor):
 
         # add an entry for the block previous to the genesis block
-        pregenesis = [-1, _0, 1, _0, 0, 0, 0, -1, -1, 1]
+        pregenesis = [-1, _0, 1, _0, 0, 0, 0, -1, -1, 1, _0, -1]
         cursor.execute(self.sql_insert, pregenesis)
 
         # add the genesis block
@@ -171,6 +377,8 @@ class Database(database.Database):
             0,                                         # height
             0,                                         # txn_count
             1,                                         # mainchain
+            buffer(_pack_work(util.get_work(self.coin.genesis_bits))),
+            -1,                                        # skip_id
         ]
         cursor.execute(self.sql_insert, genesis)
 
@@ -179,73 +387,231 @@ class Database(database.Database):
         return self._connection.cursor()
 
 
+    def _header(self, blockid = None, block_hash = None):
+        '''Returns the (id, previous_id, height, mainchain, chainwork, skip_id)
+           tuple for a block by id or hash, or None if it does not exist.
+           Internal use only.'''
+
+        if self._index is not None:
+            if block_hash is not None:
+                blockid = self._index.get_id(block_hash)
+                if blockid is None: return None
+            return self._index.header(blockid)
+
+        cursor = self._cursor()
+        sql = 'select id, previous_id, height, mainchain, chainwork, skip_id from blocks'
+        if block_hash is not None:
+            cursor.execute(sql + ' where hash = ?', (buffer(block_hash), ))
+        else:
+            cursor.execute(sql + ' where id = ?', (blockid, ))
+        row = cursor.fetchone()
+        if row:
+            return self._header_from_row(row)
+        return None
+
+
+    def _header_from_row(self, row):
+        (blockid, previous_id, height, mainchain, chainwork, skip_id) = row
+        return (blockid, previous_id, height, mainchain, _unpack_work(chainwork), skip_id)
+
+
+    def _top_header(self):
+        '''Returns the (id, previous_id, height, mainchain, chainwork, skip_id)
+           tuple for the top block; the mainchain block with the most work.'''
+
+        if self._index is not None:
+            return self._index.header(self._index.top_id)
+
+        cursor = self._cursor()
+        cursor.execute('select id, previous_id, height, mainchain, chainwork, skip_id from blocks where mainchain = 1 order by chainwork desc limit 1')
+        return self._header_from_row(cursor.fetchone())
+
+
+    def _ancestor(self, header, height, get_header = None):
+        '''Returns the header tuple of the ancestor at height of the block
+           with header, following skip pointers. The get_header function
+           looks up a header tuple by id. Internal use only.'''
+
+        if get_header is None:
+            get_header = self._header
+
+        cur = header
+        while cur[2] > height:
+            skip_height = _skip_height(cur[2])
+            skip_height_previous = _skip_height(cur[2] - 1)
+
+            # only skip if it doesn't overshoot, and the parent couldn't
+            # skip better
+            if cur[5] >= 0 and (skip_height == height or (skip_height > height and not (
+                    skip_height_previous < skip_height - 2 and skip_height_previous >= height))):
+                cur = get_header(cur[5])
+            else:
+                cur = get_header(cur[1])
+
+        return cur
+
+
+    def _fork_point(self, header, get_header = None):
+        '''Returns the header tuple of the highest mainchain ancestor of the
+           block with header (which is itself, if it is mainchain), using a
+           binary search over its ancestors. Internal use only.'''
+
+        if header[3]:
+            return header
+
+        # the ancestor at lo is mainchain (the pre-genesis block always is)
+        # and the ancestor at hi is not
+        (lo, hi) = (-1, header[2])
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self._ancestor(header, mid, get_header)[3]:
+                lo = mid
+            else:
+                hi = mid
+
+        return self._ancestor(header, lo, get_header)
+
+
     def add_header(self, header):
         '''Adds a block to the database (if not present) and returns it.
 
            If a block's transactions is None, it means that only the block
            header is present in the database.'''
 
-        # Calculate the block hash
-        binary_header = header.binary()[:80]
-
-        block_hash = util.sha256d(binary_header)
-
-        # Already exists and nothing new
-        existing = self.get(block_hash, orphans = True)
-        if existing:
-            return False
+        return self.add_headers([header])[0]
 
-        # @TODO: Calculate the expected target and make sure the block matches
 
-        # @TODO: Calculate the valid time range and make sure the block matches
+    def add_headers(self, headers):
+        '''Adds many blocks to the database in a single transaction, returning
+           a list of whether each was added (False if already present).
 
-        # verify the block hits the target
-        if not util.verify_target(self.coin, header):
-            raise InvalidBlockException('block proof-of-work is greater than target')
-
-        # find the previous block
-        previous_block = self.get(header.prev_block, orphans = True)
-        if not previous_block:
-            raise InvalidBlockException('previous block does not exist')
+           Headers may build on earlier headers in the same batch, and the
+           mainchain (the chain with the most work) is updated once, for the
+           final top block. If a header is invalid, the headers before it are
+           still added before the InvalidBlockException is raised.'''
 
         cursor = self._cursor()
         cursor.execute('begin immediate transaction')
 
-        # find the top block
-        cursor.execute(self.sql_select + ' where mainchain = 1 order by height desc limit 1')
-        top_block = Block(self, cursor.fetchone())
+        # anything unexpected (eg. a database error) must not leave the
+        # database locked
+        try:
+            # find the top block; (id, previous_id, height, mainchain, chainwork, skip_id)
+            top_block = self._top_header()
+            best_block = top_block
+
+            # headers added so far this batch; by hash and by id
+            added = dict()
+            added_ids = dict()
+
+            def get_header(blockid):
+                if blockid in added_ids:
+                    return added[added_ids[blockid]]
+                return self._header(blockid)
+
+            results = [ ]
+            error = None
+            for header in headers:
+
+                # Calculate the block hash
+                block_hash = header.hash
+
+                # Already exists and nothing new
+                if block_hash in added or self._header(block_hash = block_hash):
+                    results.append(False)
+                    continue
+
+                # @TODO: Calculate the expected target and make sure the block matches
+
+                # @TODO: Calculate the valid time range and make sure the block matches
+
+                # verify the block hits the target
+                if not util.verify_target(self.coin, header):
+                    error = InvalidBlockException('block proof-of-work is greater than target')
+                    break
+
+                # find the previous block
+                previous_block = added.get(header.prev_block)
+                if previous_block is None:
+                    previous_block = self._header(block_hash = header.prev_block)
+                if not previous_block:
+                    error = InvalidBlockException('previous block does not exist')
+                    break
+
+                height = previous_block[2] + 1
+                chainwork = previous_block[4] + util.get_work(header.bits)
+                skip_id = self._ancestor(previous_block, _skip_height(height), get_header)[0]
+
+                # add the block to the database (the mainchain is updated below)
+                row = (previous_block[0], buffer(block_hash), header.version,
+                       buffer(header.merkle_root), header.timestamp, header.bits,
+                       header.nonce, height, 0, False, buffer(_pack_work(chainwork)),
+                       skip_id)
+                cursor.execute(self.sql_insert, row)
+
+                block = (cursor.lastrowid, previous_block[0], height, 0, chainwork, skip_id)
+                added[block_hash] = block
+                added_ids[block[0]] = block_hash
+                results.append(True)
+
+                # the first block with (strictly) more work becomes the mainchain
+                if chainwork > best_block[4]:
+                    best_block = block
+
+            # find where the new top meets the current mainchain
+            fork = self._fork_point(best_block, get_header)
+
+            # everything on the old mainchain above the fork is now orphaned
+            if fork[0] != top_block[0]:
+                cursor.execute('update blocks set mainchain = 0 where mainchain = 1 and height > ?', (fork[2], ))
+
+            # update all blocks from the new top to the fork as mainchain
+            mainchain = [ ]
+            cur = best_block
+            while cur[0] != fork[0]:
+                mainchain.append(cur[0])
+                cur = get_header(cur[1])
+
+            cursor.executemany('update blocks set mainchain = 1 where id = ?', [(i, ) for i in mainchain])
+
+        except Exception, e:
+            self._connection.rollback()
+            raise e
 
-        height = previous_block.height + 1
+        self._connection.commit()
 
-        mainchain = bool(height > top_block.height)
+        # keep the index in sync, now that it's safely on disk
+        if self._index is not None:
+            for height in xrange(top_block[2], fork[2], -1):
+                self._index.set_mainchain(self._index.get_mainchain_id(height), False)
 
-        # we building off of a sidechain that will become the mainchain?
-        if mainchain and not previous_block.mainchain:
+            mainchain = set(mainchain)
+            for blockid in sorted(added_ids):
+                (blockid, previous_id, height, flag, chainwork, skip_id) = added[added_ids[blockid]]
+                self._index.add(blockid, previous_id, added_ids[blockid], height, blockid in mainchain, chainwork, skip_id)
+                mainchain.discard(blockid)
 
-            # update all blocks from previous_block to the fork as mainchain
-            cur = previous_block
-            while not cur.mainchain:
-                cursor.execute('update blocks set mainchain = 1 where id = ?', (cur._blockid, ))
-                cur = cur.previous_block
+            for blockid in mainchain:
+                self._index.set_mainchain(blockid, True)
 
-            forked_at = cur.hash
+        if error:
+            raise error
 
-            # update all blocks from the old top (now orphan) to the fork as not mainchain
-            cur = top_block
-            while cur.hash != forked_at:
-                cursor.execute('update blocks set mainchain = 0 where id = ?', (cur._blockid, ))
-                cur = cur.previous_block
+        return results
+
+
+    def _update_transactions(self, updates):
+        '''Update the transaction count for many blocks in a single commit
+           and attach the transactions to each Block instance. Each item
+           in updates is a (block, transactions) tuple. Internal use only.'''
 
-        # add the block to the database
         cursor = self._cursor()
-        row = (previous_block._blockid, buffer(block_hash), header.version,
-               buffer(header.merkle_root), header.timestamp, header.bits,
-               header.nonce, height, 0, mainchain)
-        cursor.execute(self.sql_insert, row)
-        #lastrowid = cursor.lastrowid
+        cursor.executemany('update blocks set txn_count = ? where id = ?',
+                           [(len(t), b._blockid) for (b, t) in updates])
         self._connection.commit()
 
-        return True
+        for (block, transactions) in updates:
+            block._set_transactions(transactions)
 
 
     def _get(self, blockid):
@@ -263,6 +629,14 @@ class Database(database.Database):
     def get(self, blockhash, default = None, orphans = False):
         'Return the block with the hash, or None if not in the block chain.'
 
+        if self._index is not None:
+            blockid = self._index.get_id(blockhash)
+            if blockid is None:
+                return default
+            if not (orphans or self._index.header(blockid)[3]):
+                return default
+            return self._get(blockid)
+
         sql = ' where hash = ?'
         if not orphans:
             sql += ' and mainchain = 1'
@@ -279,25 +653,33 @@ class Database(database.Database):
     def block_locator_hashes(self):
         'Return a list of hashes suitable as a block locator hash.'
 
-        # Find the height of the block chain
-        hashes = [ ]
+        top_height = self._top_header()[2]
 
         # First 10...
+        heights = range(top_height, max(top_height - 10, 0), -1)
         offset = 0
-        cursor = self._cursor()
-        cursor.execute('select hash, height from blocks where mainchain = 1 and height > 0 order by height desc limit 10')
-        rows = cursor.fetchall()
-        hashes.extend([str(hash) for (hash, offset) in rows])
+        if heights: offset = heights[-1]
         offset -= 1
 
         # ...then step down by twice the previous step...
         if offset > 0:
             for i in xrange(1, int(math.log(2 * offset, 2))):
                 if offset <= 1: break
-                cursor.execute('select hash from blocks where mainchain = 1 and height = ?', (offset, ))
-                hashes.append(str(cursor.fetchone()[0]))
+                heights.append(offset)
                 offset -= (1 << i)
 
+        # look up every hash at once
+        if self._index is not None:
+            index = self._index
+            hashes = [index.get_hash(index.get_mainchain_id(h)) for h in heights]
+
+        else:
+            cursor = self._cursor()
+            sql = 'select height, hash from blocks where mainchain = 1 and height in (%s)'
+            cursor.execute(sql % ','.join('?' for h in heights), heights)
+            lookup = dict((h, str(b)) for (h, b) in cursor.fetchall())
+            hashes = [lookup[h] for h in heights]
+
         # ...finally the genesis hash
         hashes.append(self.coin.genesis_block_hash)
 
@@ -307,19 +689,22 @@ class Database(database.Database):
     def locate_blocks(self, locator, count = 500, hash_stop = None):
 
         # Find the first block that matches
-        block = None
+        header = None
         for hash in locator:
-            block = self.get_block(hash)
-            if block: break
+            header = self._header(block_hash = hash)
+            if header: break
 
         # no matching block... :'(
-        if block is None:
+        if header is None:
             return None
 
+        # a sidechain block; continue from where it forked
+        fork = self._fork_point(header)
+
         # Select the next count rows
         cursor = self._cursor()
         sql = ' where mainchain = 1 and height > ? order by height limit %d' % count
-        cursor.execute(self._SELECT + sql, (block.height, ))
+        cursor.execute(self.sql_select + sql, (fork[2], ))
 
         # Wrap the row in the Block object
         blocks = [ ]
@@ -333,6 +718,14 @@ class Database(database.Database):
 
     def __getitem__(self, name):
 
+        if self._index is not None:
+            if name < 0:
+                name += self._index.height + 1
+            blockid = self._index.get_mainchain_id(name)
+            if blockid is None:
+                raise IndexError()
+            return self._get(blockid)
+
         row = None
 
         # negative height, search from the top
@@ -363,6 +756,9 @@ class Database(database.Database):
 
 
     def __len__(self):
+        if self._index is not None:
+            return self._index.height + 1
+
         highest = self[-1]
         return highest.height + 1
 
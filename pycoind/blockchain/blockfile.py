@@ -0,0 +1,394 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Richard Moore
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Block File Database
+#
+# An alternative to the sqlite partitions of transaction.Database, which
+# stores each block's raw bytes once, appended to flat files (like bitcoind's
+# blkNNNNN.dat), with a small sqlite index beside them.
+#
+# Block files
+#
+#   Each record is the coin's magic (4 bytes), the payload length (4 bytes,
+#   little-endian) and the payload, which is exactly the payload of a block
+#   message: the 80 byte header, the transaction count and the transactions.
+#   Files are capped at about MAX_FILE_SIZE, after which a new file is begun.
+#
+# Index (the txindex and blocks tables)
+#
+#   blocks  - (blockid) => (file, offset, length) of each block's payload
+#   txindex - (txck) => (txid_hint, txid, offset, length) of each transaction
+#             within its block's payload
+#
+# The bytes are always written (and synced, unless the profile is ibd) before
+# the index is committed, so readers (in any process) only see complete
+# records. Records (and files) whose index was never committed (eg. after a
+# crash) are dropped when the writer next appends.
+#
+# A data directory holding transactions in sqlite files cannot switch to
+# block files (see block.Database).
+#
+# Only one process may add blocks; any number may read.
+
+
+import os
+import struct
+
+from . import database
+from . import keys
+from . import transaction
+
+from .. import coins
+from .. import protocol
+from .. import util
+
+__all__ = ['Database']
+
+
+_0 = chr(0) * 32
+
+
+class Database(database.Database):
+
+    # block files are started anew beyond this size
+    MAX_FILE_SIZE = 1 << 27              # 128MB
+
+    Columns = [
+        ('txck', 'integer primary key', False),
+        ('txid_hint', 'integer', True),
+        ('txid', 'blob', False),
+        ('offset', 'integer', False),
+        ('length', 'integer', False),
+    ]
+
+    Name = 'txindex'
+
+    def __init__(self, data_dir = None, coin = coins.Bitcoin, profile = None, migrate = False):
+        database.Database.__init__(self, data_dir, coin, profile, migrate)
+
+        self._connection = self.get_connection()
+
+        # open block files for reading; maps file number to file object
+        self._files = dict()
+
+        # the block file being appended to (opened by the first add)
+        self._file_number = None
+        self._file = None
+
+    @staticmethod
+    def exists(data_dir, coin = coins.Bitcoin):
+        'Returns True if data_dir holds a block file database for coin.'
+
+        return os.path.isfile(os.path.join(data_dir, '%s-%s.sqlite' % (coin.name, Database.Name)))
+
+
+    def populate_database(self, cursor):
+        cursor.execute('create table blocks (blockid integer primary key, file integer, offset integer, length integer)')
+
+
+    def get_block_filename(self, file_number):
+        return os.path.join(self.data_dir, '%s-blk%05d.dat' % (self.coin.name, file_number))
+
+
+    def _open_writer(self):
+        '''Open the last block file for appending, dropping any bytes (and
+           files) past the last indexed record. Internal use.'''
+
+        cursor = self._connection.cursor()
+        cursor.execute('select file, offset, length from blocks order by file desc, offset desc limit 1')
+        row = cursor.fetchone()
+
+        (file_number, end) = (0, 0)
+        if row:
+            file_number = row[0]
+            end = row[1] + row[2]
+
+        # files begun after the last indexed record hold nothing indexed
+        n = file_number + 1
+        while os.path.isfile(self.get_block_filename(n)):
+            os.remove(self.get_block_filename(n))
+            n += 1
+
+        self._open_block_file(file_number, end)
+
+
+    def _open_block_file(self, file_number, end):
+        '''Open a block file for appending, dropping any bytes past end (which
+           were never indexed). Internal use.'''
+
+        filename = self.get_block_filename(file_number)
+        self._file = open(filename, 'ab')
+        if os.path.getsize(filename) > end:
+            self._file.truncate(end)
+        self._file.seek(0, os.SEEK_END)
+
+        self._file_number = file_number
+
+
+    def add(self, block, transactions):
+        'Add transactions to the database.'
+
+        return self.add_blocks([(block, transactions)])[0]
+
+
+    def add_blocks(self, blocks):
+        '''Add the transactions for many blocks to the database at once.
+
+           Each item in blocks is a (block, transactions) tuple. Each block
+           is appended to the block files as a single record, and the index
+           (and the blocks' transaction counts) committed once. Returns the
+           list of updated blocks.'''
+
+        # check the merkle root of every block before writing anything
+        for (block, transactions) in blocks:
+            block._check_merkle_root(util.get_merkle_root(transactions))
+
+        if self._file is None:
+            self._open_writer()
+
+        # blocks already stored are not stored again
+        cursor = self._connection.cursor()
+        blockids = list(set(b._blockid for (b, t) in blocks))
+        stored = set()
+        for offset in xrange(0, len(blockids), 500):
+            batch = blockids[offset:offset + 500]
+            cursor.execute('select blockid from blocks where blockid in (%s)' % ','.join('?' for b in batch), batch)
+            stored.update(r[0] for r in cursor.fetchall())
+
+        block_rows = [ ]
+        txn_rows = [ ]
+        updates = [ ]
+        for (block, transactions) in blocks:
+
+            header = util.get_block_header(block.version, block.previous_hash or _0,
+                                           block.merkle_root, block.timestamp,
+                                           block.bits, block.nonce)
+            payload = [header, protocol.format.FormatTypeVarInteger.binary(len(transactions))]
+            offset = len(payload[0]) + len(payload[1])
+
+            block_txns = [ ]
+            for (txn_index, txn) in enumerate(transactions):
+                txid = txn.hash
+                binary = txn.binary()
+                payload.append(binary)
+
+                txck = keys.get_txck(block._blockid, txn_index)
+                txn_rows.append((txck, keys.get_hint(txid), buffer(txid), offset, len(binary)))
+                offset += len(binary)
+
+                # wrap up the transaction for the returned block
+                row = (txck, keys.get_hint(txid), buffer(binary), buffer(txid))
+                block_txns.append(transaction.Transaction(self, row, txn))
+
+            updates.append((block, block_txns))
+
+            if block._blockid in stored: continue
+            stored.add(block._blockid)
+
+            payload = ''.join(payload)
+
+            # start a new file if this one is full
+            position = self._file.tell()
+            if position and position + 8 + len(payload) > self.MAX_FILE_SIZE:
+                self._file.close()
+                self._open_block_file(self._file_number + 1, 0)
+                position = self._file.tell()
+
+            self._file.write(self.coin.magic + struct.pack('<I', len(payload)) + payload)
+            block_rows.append((block._blockid, self._file_number, position + 8, len(payload)))
+
+        # the bytes must be on disk before they are indexed
+        self._file.flush()
+        if self.profile != database.PROFILE_IBD:
+            os.fsync(self._file.fileno())
+
+        cursor.executemany('insert or ignore into blocks (blockid, file, offset, length) values (?, ?, ?, ?)', block_rows)
+        cursor.executemany(self.sql_insert.replace('insert', 'insert or ignore', 1), txn_rows)
+        self._connection.commit()
+
+        # update the blocks with their transactions (all in one commit)
+        if updates:
+            block = updates[0][0]
+            block._database._update_transactions(updates)
+
+        # return the now updated blocks
+        return [b for (b, t) in updates]
+
+
+    def compact(self, limit = None, duration = None):
+        'Block files are never compacted; returns 0 transactions moved.'
+
+        return 0
+
+
+    def rebuild_bloom_filters(self):
+        'The index is a single file, so there are no bloom filters to rebuild.'
+
+        pass
+
+
+    def _read(self, file_number, offset, length):
+        'Read length bytes at offset within a block file. Internal use.'
+
+        f = self._files.get(file_number)
+        if f is None:
+            f = open(self.get_block_filename(file_number), 'rb')
+            self._files[file_number] = f
+
+        f.seek(offset)
+        return f.read(length)
+
+
+    def _locate(self, blockid):
+        'Returns the (file, offset, length) of a block, or None. Internal use.'
+
+        cursor = self._connection.cursor()
+        cursor.execute('select file, offset, length from blocks where blockid = ?', (blockid, ))
+        return cursor.fetchone()
+
+
+    def get_block_binary(self, block):
+        '''Returns the payload of a block message for a block, with a single
+           read, or None if its transactions are not stored.'''
+
+        location = self._locate(block._blockid)
+        if location is None:
+            return None
+
+        return self._read(*location)
+
+
+    def _transaction(self, row):
+        '''Read and wrap up the transaction for a (txck, txid_hint, txid,
+           offset, length) row. Internal use.'''
+
+        (txck, txid_hint, txid, offset, length) = row
+
+        location = self._locate(keys.get_txck_blockid(txck))
+        if location is None:
+            return None
+
+        binary = self._read(location[0], location[1] + offset, length)
+        return transaction.Transaction(self, (txck, txid_hint, binary, str(txid)))
+
+
+    def _get(self, txck):
+        'Find a transaction by its txck. Internal use.'
+
+        cursor = self._connection.cursor()
+        cursor.execute(self.sql_select + ' where txck = ?', (txck, ))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        return self._transaction(row)
+
+    def _get_txid(self, txck):
+        '''Find the txid for a txck, without reading the transaction. Internal
+           use.'''
+
+        cursor = self._connection.cursor()
+        cursor.execute('select txid from txindex where txck = ?', (txck, ))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        return str(row[0])
+
+    def _get_txids(self, txcks):
+        '''Find the txids for many txcks, with one query per batch of txcks.
+           Returns a dict mapping txck to txid. Internal use.'''
+
+        txcks = list(set(txcks))
+
+        txids = dict()
+        cursor = self._connection.cursor()
+        for offset in xrange(0, len(txcks), 500):
+            batch = txcks[offset:offset + 500]
+            sql = 'select txck, txid from txindex where txck in (%s)' % ','.join('?' for t in batch)
+            cursor.execute(sql, batch)
+            txids.update((r[0], str(r[1])) for r in cursor.fetchall())
+
+        return txids
+
+    def _get_transactions(self, blockid):
+        '''Find all transactions for a block, ordered by transaction index, with
+           a single read of the block. Internal use.'''
+
+        location = self._locate(blockid)
+        if location is None:
+            return [ ]
+
+        # the range that this block's composite keys can have [lo, hi)
+        lo = keys.get_txck(blockid, 0)
+        hi = keys.get_txck(blockid + 1, 0)
+
+        cursor = self._connection.cursor()
+        cursor.execute(self.sql_select + ' where txck >= ? and txck < ? order by txck', (lo, hi))
+        rows = cursor.fetchall()
+
+        payload = self._read(*location)
+        return [transaction.Transaction(self, (txck, txid_hint, payload[offset:offset + length], str(txid)))
+                for (txck, txid_hint, txid, offset, length) in rows]
+
+
+    def get(self, txid, default = None):
+        'Get a transaction by its txid.'
+
+        row = self._find(txid, self.sql_select)
+        if row is None:
+            return default
+
+        return self._transaction(row)
+
+
+    def _get_txck(self, txid):
+        '''Find the txck for a txid, without reading the transaction. Internal
+           use.'''
+
+        row = self._find(txid, 'select txck from txindex')
+        if row is None:
+            return None
+
+        return row[0]
+
+
+    def _find(self, txid, sql):
+        'Return the row selected by sql for a txid, or None. Internal use.'
+
+        # the hint index prunes; the stored txid confirms
+        cursor = self._connection.cursor()
+        cursor.execute(sql + ' where txid_hint = ? and txid = ?', (keys.get_hint(txid), buffer(txid)))
+        return cursor.fetchone()
+
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = dict()
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        self._connection.close()
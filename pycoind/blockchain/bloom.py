@@ -0,0 +1,163 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Richard Moore
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+
+# Bloom Filter Files
+#
+# A bloom filter over 32-byte hashes (such as txids), stored on disk and
+# memory mapped, so the node and any readers share the same pages.
+#
+#   header (32 bytes)
+#     - magic:4 ('PCBF')
+#     - version:4
+#     - hash_count:4 (k)
+#     - reserved:4
+#     - bit_count:8 (m, a multiple of 8)
+#     - count:8 (number of hashes added)
+#   bits (m / 8 bytes)
+#
+# The hashes we store are already uniformly distributed, so the k bit
+# positions are derived by double hashing two 8-byte words from the hash
+# itself. The first 8 bytes are skipped, since they also select which
+# partition a transaction is stored in.
+#
+# A bloom filter may have false positives, but never false negatives, as
+# long as every hash is added before the data it represents is committed.
+
+
+import mmap
+import os
+import struct
+
+__all__ = ['BloomFilter', 'BloomFilterException']
+
+
+class BloomFilterException(Exception): pass
+
+
+_Header = struct.Struct('<4sIIIQQ')
+_Words = struct.Struct('<QQ')
+
+
+class BloomFilter(object):
+
+    Magic = 'PCBF'
+    Version = 1
+
+    # about 1% false positives for 3.5 million hashes (4MB)
+    DEFAULT_BIT_COUNT = 1 << 25
+    DEFAULT_HASH_COUNT = 7
+
+    def __init__(self, filename, readonly = False):
+        self._filename = filename
+        self._readonly = readonly
+
+        mode = 'r+b'
+        access = mmap.ACCESS_WRITE
+        if readonly:
+            mode = 'rb'
+            access = mmap.ACCESS_READ
+
+        self._fp = open(filename, mode)
+        try:
+            self._mmap = mmap.mmap(self._fp.fileno(), 0, access = access)
+        except Exception, e:
+            self._fp.close()
+            raise BloomFilterException('invalid bloom filter file: %s' % filename)
+
+        (magic, version, k, reserved, m, count) = _Header.unpack_from(self._mmap, 0)
+        if magic != self.Magic:
+            raise BloomFilterException('invalid bloom filter file: %s' % filename)
+        if version != self.Version:
+            raise BloomFilterException('incompatible bloom filter version: %d (expected %d)' % (version, self.Version))
+        if len(self._mmap) != _Header.size + m // 8:
+            raise BloomFilterException('truncated bloom filter file: %s' % filename)
+
+        self._hash_count = k
+        self._bit_count = m
+
+    @staticmethod
+    def create(filename, bit_count = None, hash_count = None):
+        'Create a new, empty bloom filter file and return it opened.'
+
+        if bit_count is None:
+            bit_count = BloomFilter.DEFAULT_BIT_COUNT
+        if hash_count is None:
+            hash_count = BloomFilter.DEFAULT_HASH_COUNT
+
+        # round up to a whole byte
+        bit_count = (bit_count + 7) & ~7
+
+        with open(filename, 'wb') as fp:
+            fp.write(_Header.pack(BloomFilter.Magic, BloomFilter.Version, hash_count, 0, bit_count, 0))
+            fp.truncate(_Header.size + bit_count // 8)
+
+        return BloomFilter(filename)
+
+    filename = property(lambda s: s._filename)
+    readonly = property(lambda s: s._readonly)
+    hash_count = property(lambda s: s._hash_count)
+    bit_count = property(lambda s: s._bit_count)
+
+    @property
+    def count(self):
+        'The number of hashes that have been added.'
+
+        return struct.unpack_from('<Q', self._mmap, 24)[0]
+
+    def _bits(self, hash):
+        'Yields the (byte_offset, mask) for each bit position of hash.'
+
+        (h1, h2) = _Words.unpack_from(hash, 8)
+        h2 |= 1
+
+        m = self._bit_count
+        for i in xrange(0, self._hash_count):
+            bit = (h1 + i * h2) % m
+            yield (_Header.size + (bit >> 3), 1 << (bit & 0x07))
+
+    def add(self, hash):
+        'Add a hash to the filter. Call flush before relying on it.'
+
+        mm = self._mmap
+        for (offset, mask) in self._bits(hash):
+            mm[offset] = chr(ord(mm[offset]) | mask)
+
+        struct.pack_into('<Q', mm, 24, self.count + 1)
+
+    def __contains__(self, hash):
+        mm = self._mmap
+        for (offset, mask) in self._bits(hash):
+            if not (ord(mm[offset]) & mask):
+                return False
+        return True
+
+    def flush(self):
+        'Write any changes to disk.'
+
+        if not self._readonly:
+            self._mmap.flush()
+
+    def close(self):
+        self._mmap.close()
+        self._fp.close()
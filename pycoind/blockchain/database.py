@@ -28,6 +28,53 @@ from .. import coins, util
 
 KEY_VERSION = 1
 
+
+# Connection Profiles
+#
+# A profile is a list of (pragma, value) tuples applied to every connection
+# when it is opened, trading durability for performance.
+#
+#   ibd      - initial block download; a crash may lose (or corrupt) the
+#              most recent writes, which can simply be downloaded again
+#   steady   - normal operation once synced; WAL allows readers (such as a
+#              block explorer) to run concurrently with the node's writer
+#   readonly - readers only; the connection refuses to modify the database
+#
+# The page_size only takes effect when a database file is created.
+
+PROFILE_IBD      = 'ibd'
+PROFILE_STEADY   = 'steady'
+PROFILE_READONLY = 'readonly'
+
+Profiles = {
+    PROFILE_IBD: [
+        ('page_size', 4096),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'OFF'),
+        ('cache_size', -262144),       # 256MB (negative values are in KB)
+        ('mmap_size', 1 << 30),
+        ('temp_store', 'MEMORY'),
+    ],
+    PROFILE_STEADY: [
+        ('page_size', 4096),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -65536),        # 64MB
+        ('mmap_size', 1 << 28),
+        ('temp_store', 'MEMORY'),
+    ],
+    PROFILE_READONLY: [
+        ('cache_size', -65536),
+        ('mmap_size', 1 << 28),
+        ('temp_store', 'MEMORY'),
+        ('query_only', 'ON'),
+    ],
+}
+
+# pragmas which must wait until the database has been initialized
+_DEFERRED_PRAGMAS = set(['query_only'])
+
+
 class DatabaseException(Exception): pass
 
 class Database(object):
@@ -41,13 +88,23 @@ class Database(object):
     # obsolete databases will raise an exception
     Version = 1
 
-    def __init__(self, data_dir = None, coin = coins.Bitcoin):
+    # maps an obsolete version to a function(self, cursor) which upgrades a
+    # database from that version to the next; these are only run if the
+    # database is opened with migrate = True
+    Migrations = dict()
+
+    def __init__(self, data_dir = None, coin = coins.Bitcoin, profile = None, migrate = False):
 
         if data_dir is None:
             data_dir = util.default_data_directory()
         self.__data_dir = data_dir
         self.__coin = coin
 
+        if profile is not None and profile not in Profiles:
+            raise ValueError('unknown database profile: %r' % profile)
+        self.__profile = profile
+        self.__migrate = migrate
+
         self.sql_select = 'select %s from %s' % (','.join(n for (n, t, i) in self.Columns), self.Name)
 
         offset = 0
@@ -63,6 +120,8 @@ class Database(object):
 
     data_dir = property(lambda s: s.__data_dir)
     coin = property(lambda s: s.__coin)
+    profile = property(lambda s: s.__profile)
+    migrate = property(lambda s: s.__migrate)
 
     def get_filename(self, extra = ''):
         return os.path.join(self.data_dir, '%s-%s%s.sqlite' % (self.coin.name, self.Name, extra))
@@ -71,9 +130,23 @@ class Database(object):
         filename = self.get_filename(extra)
         connection = sqlite3.connect(filename, timeout = 30)
         connection.row_factory = sqlite3.Row
+        self.apply_profile(connection)
         self.initialize_database(connection)
+        self.apply_profile(connection, deferred = True)
         return connection
 
+    def apply_profile(self, connection, deferred = False):
+        '''Apply this database's profile pragmas to a connection. Pragmas which
+           would prevent initializing the database are only applied if
+           deferred.'''
+
+        if self.__profile is None: return
+
+        cursor = connection.cursor()
+        for (pragma, value) in Profiles[self.__profile]:
+            if (pragma in _DEFERRED_PRAGMAS) != deferred: continue
+            cursor.execute('pragma %s = %s' % (pragma, value))
+
     def initialize_database(self, connection):
         cursor = connection.cursor()
 
@@ -112,7 +185,26 @@ class Database(object):
             # check the version is compatible
             version = self.get_metadata(cursor, KEY_VERSION)
             if version != self.Version:
-                raise DatabaseException('incompatible database version: %d (expected %d)' % (version, self.Version))
+                if not self.__migrate:
+                    raise DatabaseException('incompatible database version: %d (expected %d)' % (version, self.Version))
+                self.migrate_database(connection, version)
+
+    def migrate_database(self, connection, version):
+        '''Upgrade a database from an obsolete version, one version at a time.
+           This may take a long time, and should only be done while no other
+           process is using the database.'''
+
+        cursor = connection.cursor()
+        while version != self.Version:
+            migration = self.Migrations.get(version)
+            if migration is None:
+                raise DatabaseException('cannot migrate database version: %d (expected %d)' % (version, self.Version))
+
+            migration(self, cursor)
+
+            version += 1
+            cursor.execute('update metadata set value = ? where key = ?', (version, KEY_VERSION))
+            connection.commit()
 
     def set_metadata(self, cursor, key, value):
         '''Set metadata for this database; the caller must commit. The value may
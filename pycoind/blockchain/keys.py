@@ -82,6 +82,16 @@ def get_address_hint(address):
     if address is None:
         return 0
     bytes = util.base58.decode_check(address)
-    hint = get_hint(bytes[1:])
+    return get_pubkeyhash_hint(bytes[1:])
+
+
+def get_pubkeyhash_hint(pubkeyhash):
+    '''Generate the hint for an address (see get_address_hint) directly from
+       its public key hash (hash160), without a base58 round trip. The hint
+       does not depend on the address version.'''
+
+    if pubkeyhash is None:
+        return 0
+    hint = get_hint(pubkeyhash)
     return (hint & 0x7ffffffffffe) | 0x01
 
@@ -26,6 +26,7 @@
 #   txck      - transaction composite key (see below)
 #   txid_hint - hash integer, provides pruning to likely txid
 #   txn       - the binary blob of the transaction
+#   txid      - the txid (hash) of the transaction
 #
 # The database is broken up into files about 1.75GB each (so file systems like
 # FAT32 work). The database filename contains two numbers, a number of
@@ -42,8 +43,13 @@
 #    3. file(N / 4, get_q(txid) % (N / 4))
 # and so on, until we reach a k, such that (N / (2 ** k)) < 4.
 #
-# We can also, over time migrate values into higher levels. This is a future
-# todo, if performance becomes an issue.
+# Over time, compact migrates values from the lower levels into the highest
+# level, and once a level is empty its files are deleted (retired), so fewer
+# levels must be checked. Rows are committed into the highest level before
+# they are deleted from the old one, so they are always readable. Retired
+# levels are always the lowest, so the levels on disk remain contiguous.
+# Readers close a retired level once they notice its files are gone; its
+# -wal and -shm files are only deleted by the following compact.
 
 # Composite Keys
 #
@@ -62,13 +68,51 @@
 # A hint (hash integer) the integer value of a byte string to quickly prune
 # any obviously non-matching elements. The remaining elements must then be
 # compared against confirmed values, since the hash may yield false positives.
+#
+# The full txid is stored beside the hint (since version 2), so candidates can
+# be confirmed by the query itself, without parsing or hashing the
+# transaction. Version 1 files must be migrated (see database.Migrations),
+# which hashes every stored transaction once.
+#
+# Since the txid column follows the (often overflowing) txn blob in each row,
+# the hint and txid are indexed together (since version 3); a lookup by txid
+# (eg. _get_txck) is answered from the index alone, never reading the
+# transaction. This costs about 40 bytes more per transaction than indexing
+# the hint alone.
+
+# Bloom Filters
+#
+# Each file has a bloom filter of its txids beside it (see bloom.py), which
+# is checked before querying the file by txid; most levels will not contain
+# a given txid. A filter cannot grow, so each is sized for a full file
+# (TARGET_COUNT txids, about 9MB). Files created before bloom filters existed
+# have no filter (and are always queried) until rebuild_bloom_filters is
+# called, which must only be done while no other process is using the
+# database.
+
+# Block Ranges
+#
+# Each file stores the minimum and maximum block id it contains in its
+# metadata, which are kept in memory so lookups by txck (or block id) skip
+# the files whose range cannot contain the block.
+#
+# This prunes levels, not partitions. Rows are spread across a level's
+# partitions by txid, so every partition of a level holds about the same
+# range of blocks, and a lookup still queries all N partitions of each level
+# whose range matches. It mostly helps while a lower level, holding only
+# older blocks, is still on disk; once compact has moved everything into the
+# highest level, its range covers every block and nothing is pruned.
+# (Partitioning by block instead would break lookups by txid, which must know
+# the one partition per level to search.)
 
 
 import os
 import random
 import sqlite3
 import struct
+import time
 
+from . import bloom
 from . import database
 from . import keys
 
@@ -80,20 +124,24 @@ from .. import util
 __all__ = ['Database']
 
 
+KEY_MIN_BLOCKID = 2
+KEY_MAX_BLOCKID = 3
+
+
 def get_q(txid):
     'Compute the index q from a txid.'
 
     return struct.unpack('>I', txid[:4])[0]
 
 
-_KEY_DUP = 'PRIMARY KEY must be unique'
-
 _0 = chr(0) * 32
 
 class Transaction(object):
 
     def __init__(self, database, row, _transaction = None):
-        keys = [n for (n, t, i) in database.Columns]
+        # rows are always in this layout, whichever database built them (see
+        # blockfile.py)
+        keys = [n for (n, t, i) in Database.Columns]
 
         self._database = database
         self._data = dict(zip(keys, row))
@@ -101,6 +149,10 @@ class Transaction(object):
         # cache for previous outputs' transactions, since it hits the database
         self._po_cache = dict()
 
+        # previous outputs provided by the caller (eg. the unspent cache), so
+        # their transactions need not be loaded; index => (uock, value, pk_script)
+        self._po_known = dict()
+
         self._transaction = _transaction
 
     version = property(lambda s: s.txn.version)
@@ -110,22 +162,31 @@ class Transaction(object):
 
     lock_time = property(lambda s: s.txn.lock_time)
 
-    hash = property(lambda s: s.txn.hash)
+    @property
+    def hash(self):
+        if self._transaction is not None:
+            return self._transaction.hash
+
+        # the stored txid; hash the stored bytes if it is missing
+        if self._data.get('txid') is None:
+            self._data['txid'] = util.sha256d(self._data['txn'])
+        return str(self._data['txid'])
 
     index = property(lambda s: keys.get_txck_index(s._txck))
 
     def __getstate__(self):
-        return (self._po_cache, dict(txn = str(self._data['txn']), txck = self._data['txck']))
+        return (self._po_cache, self._po_known, dict(txn = str(self._data['txn']), txck = self._data['txck'], txid = self.hash))
 
     def __setstate__(self, state):
         self._database = None
 
-        (self._po_cache, self._data) = state
+        (self._po_cache, self._po_known, self._data) = state
 
         self._transaction = None
 
     def cache_previous_outputs(self):
         for i in xrange(0, len(self.inputs)):
+            if i in self._po_known: continue
             self.previous_transaction(i)
 
     def previous_transaction(self, index):
@@ -151,6 +212,10 @@ class Transaction(object):
     def previous_output(self, index):
         'Returns the previous output for the input at index.'
 
+        if index in self._po_known:
+            (uock, value, pk_script) = self._po_known[index]
+            return protocol.TxnOut(value, pk_script)
+
         previous_txn = self.previous_transaction(index)
         if previous_txn is None: return None
 
@@ -166,18 +231,26 @@ class Transaction(object):
 
     def _previous_uock(self, index):
 
+        if index in self._po_known:
+            return self._po_known[index][0]
+
         previous_txn = self.previous_transaction(index)
         if previous_txn is None: return None
 
         po = self.inputs[index].previous_output
         return keys.get_uock(previous_txn._txck, po.index)
 
+    def _set_previous_output(self, index, uock, value, pk_script):
+        'Provide the previous output for the input at index. Internal use.'
+
+        self._po_known[index] = (uock, value, pk_script)
+
     @property
     def txn(self):
         'The raw transaction object.'
 
         if self._transaction is None:
-            (vl, self._transaction) = protocol.Txn.parse(self.txn_binary)
+            (vl, self._transaction) = protocol.Txn.parse(self._data['txn'])
         return self._transaction
 
     txn_binary = property(lambda s: str(s._data['txn']))
@@ -187,37 +260,124 @@ class Database(database.Database):
 
     MINIMUM_N = 4
 
+    # levels above this are never searched for
+    MAXIMUM_N = 1 << 16
+
+    # transactions moved per commit while compacting
+    COMPACT_BATCH_SIZE = 1000
+
     TARGET_SIZE = (1 << 30) * 7 // 4     # 1.75GB
 
+    # a full file holds about this many transactions (assuming a small
+    # average of 256 bytes each, so the estimate errs high)
+    TARGET_COUNT = TARGET_SIZE // 256
+
+    # about 10 bits per txid keeps bloom filter false positives around 1%
+    BLOOM_BITS_PER_TXID = 10
+
     Columns = [
         ('txck', 'integer primary key', False),
-        ('txid_hint', 'integer', True),
+        ('txid_hint', 'integer', False),
         ('txn', 'blob', False),
+        ('txid', 'blob', False),
     ]
 
     Name = 'txns'
 
-    def __init__(self, data_dir = None, coin = coins.Bitcoin):
-        database.Database.__init__(self, data_dir, coin)
+    Version = 3
+
+    def _migrate_from_1(self, cursor):
+        'Adds the txid column, hashing every existing transaction.'
+
+        # a previously interrupted migration may have added the column
+        cursor.execute('pragma table_info(txns)')
+        if 'txid' not in [r[1] for r in cursor.fetchall()]:
+            cursor.execute('alter table txns add column txid blob')
+
+        txck = -1
+        while True:
+            cursor.execute('select txck, txn from txns where txck > ? order by txck limit 1000', (txck, ))
+            rows = cursor.fetchall()
+            if not rows: break
+            cursor.executemany('update txns set txid = ? where txck = ?',
+                               [(buffer(util.sha256d(r[1])), r[0]) for r in rows])
+            txck = rows[-1][0]
+
+    def _migrate_from_2(self, cursor):
+        'Indexes the txid with its hint, replacing the index of the hint alone.'
+
+        self._create_txid_index(cursor)
+        cursor.execute('drop index if exists index_txid_hint')
+
+    Migrations = {1: _migrate_from_1, 2: _migrate_from_2}
+
+    def __init__(self, data_dir = None, coin = coins.Bitcoin, profile = None, migrate = False):
+        database.Database.__init__(self, data_dir, coin, profile, migrate)
+
+        # duplicates don't matter, and must not abort a batch insert
+        self.sql_insert_ignore = self.sql_insert.replace('insert', 'insert or ignore', 1)
 
         # maps (n, i % n) tuples to sqlite connection
         self._connections = dict()
 
+        # maps (n, i % n) tuples to (min_blockid, max_blockid), or None if empty
+        self._ranges = dict()
+
+        # maps (n, i % n) tuples to a bloom.BloomFilter, or None if missing
+        self._blooms = dict()
+
+        # levels retired whose -wal and -shm files may remain (see _retire_level)
+        self._retired = set()
+
         # the largest N level on disk
         self._N = self.load_n()
 
-        # loading/creating a connection loads/creates the entire level
-        n = self._N
+        # loading/creating a connection loads/creates the entire level (only
+        # the highest level is created; lower levels may have been retired)
+        self.get_connection(self._N, 0, True)
+        n = self._N // 2
         while n >= self.MINIMUM_N:
-            self.get_connection(n, 0, True)
+            self.get_connection(n, 0)
             n //= 2
 
         #self._unspent = unspent.Database(self.data_dir, coin)
 
+    def populate_database(self, cursor):
+        self._create_txid_index(cursor)
+
+    def _create_txid_index(self, cursor):
+        cursor.execute('create index if not exists index_txid on txns (txid_hint, txid)')
+
+    @staticmethod
+    def exists(data_dir, coin = coins.Bitcoin):
+        'Returns True if data_dir holds any transactions in sqlite files for coin.'
+
+        prefix = '%s-%s-' % (coin.name, Database.Name)
+        for filename in os.listdir(data_dir):
+            if not (filename.startswith(prefix) and filename.endswith('.sqlite')):
+                continue
+
+            connection = sqlite3.connect(os.path.join(data_dir, filename), timeout = 30)
+            try:
+                row = connection.execute('select 1 from txns limit 1').fetchone()
+            finally:
+                connection.close()
+
+            if row: return True
+
+        return False
+
+
     def load_n(self):
         'Determine the highest N for a database directory.'
 
+        # skip past any retired levels to the lowest level on disk
         n = self.MINIMUM_N
+        while not os.path.isfile(self.get_filename(self.get_suffix(n, 0))):
+            n *= 2
+            if n > self.MAXIMUM_N:
+                return self.MINIMUM_N
+
         while True:
             if not os.path.isfile(self.get_filename(self.get_suffix(n * 2, 0))):
                 break
@@ -225,6 +385,35 @@ class Database(database.Database):
         return n
 
 
+    def _load_levels(self):
+        '''Load any levels added, and close any levels retired, (by another
+           process) since we last checked. Returns True if anything changed.'''
+
+        changed = False
+        for n in self._levels():
+            if n != self._N and not os.path.isfile(self.get_filename(self.get_suffix(n, 0))):
+                self._close_level(n)
+                changed = True
+
+        new_n = self.load_n()
+        if new_n == self._N:
+            return changed
+
+        n = new_n
+        while n > self._N:
+            self.get_connection(n, 0)
+            n //= 2
+        self._N = new_n
+
+        return True
+
+
+    def _levels(self):
+        'Returns the N of each loaded level, highest first.'
+
+        return sorted(set(n for (n, i) in self._connections), reverse = True)
+
+
     def get_suffix(self, n, q):
         return '-%03d-%03d' % (n, q % n)
 
@@ -251,10 +440,111 @@ class Database(database.Database):
             for l in locs:
                 suffix = self.get_suffix(l[0], l[1])
                 self._connections[l] = database.Database.get_connection(self, suffix)
+                self._ranges[l] = self._load_range(self._connections[l])
+                self._blooms[l] = self._load_bloom(l)
 
         return self._connections[loc]
 
 
+    def get_bloom_filename(self, n, q):
+        filename = self.get_filename(self.get_suffix(n, q))
+        return os.path.splitext(filename)[0] + '.bloom'
+
+
+    def _load_bloom(self, loc):
+        '''Opens the bloom filter for a file, creating it if the file is empty.
+           Returns None if there is no (trustworthy) bloom filter.'''
+
+        filename = self.get_bloom_filename(*loc)
+        readonly = (self.profile == database.PROFILE_READONLY)
+
+        if os.path.isfile(filename):
+            return bloom.BloomFilter(filename, readonly)
+
+        # a filter for a non-empty file would be missing its existing txids
+        if readonly or self._ranges.get(loc) is not None:
+            return None
+
+        # sized for a full file, since a filter cannot grow
+        return bloom.BloomFilter.create(filename, self.TARGET_COUNT * self.BLOOM_BITS_PER_TXID)
+
+
+    def rebuild_bloom_filters(self):
+        '''Rebuild the bloom filter for every file. This must be done offline;
+           any other process with the database open would not update the new
+           filters.'''
+
+        for (loc, connection) in sorted(self._connections.items()):
+            filename = self.get_bloom_filename(*loc)
+
+            cursor = connection.cursor()
+            cursor.execute('select count(*) from txns')
+            count = cursor.fetchone()[0]
+
+            bit_count = max(self.TARGET_COUNT, count) * self.BLOOM_BITS_PER_TXID
+
+            # build beside the old filter, then replace it
+            bloom_filter = bloom.BloomFilter.create(filename + '.tmp', bit_count)
+            cursor.execute('select txid from txns')
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows: break
+                for row in rows:
+                    bloom_filter.add(str(row[0]))
+            bloom_filter.flush()
+            bloom_filter.close()
+
+            if self._blooms.get(loc):
+                self._blooms[loc].close()
+            os.rename(filename + '.tmp', filename)
+            self._blooms[loc] = bloom.BloomFilter(filename)
+
+
+    def _load_range(self, connection):
+        'Returns the (min_blockid, max_blockid) for a file, or None if empty.'
+
+        cursor = connection.cursor()
+        lo = self.get_metadata(cursor, KEY_MIN_BLOCKID)
+        hi = self.get_metadata(cursor, KEY_MAX_BLOCKID)
+
+        # files from before ranges were tracked; the keys are the rowid, so
+        # this is cheap
+        if lo is None or hi is None:
+            cursor.execute('select min(txck), max(txck) from txns')
+            (lo, hi) = cursor.fetchone()
+            if lo is None:
+                return None
+            lo = keys.get_txck_blockid(lo)
+            hi = keys.get_txck_blockid(hi)
+
+        return (lo, hi)
+
+
+    def _refresh_ranges(self):
+        '''Reload every file's block id range, since another process may have
+           added to the database. Returns True if anything changed.'''
+
+        # maybe another process grew us; load any new levels
+        changed = self._load_levels()
+
+        for (loc, connection) in self._connections.items():
+            block_range = self._load_range(connection)
+            if block_range != self._ranges.get(loc):
+                self._ranges[loc] = block_range
+                changed = True
+
+        return changed
+
+
+    def _locate(self, blockid):
+        '''Returns the connections whose block id range may contain blockid;
+           all partitions of each level whose range matches (see Block
+           Ranges).'''
+
+        return [self._connections[loc] for (loc, r) in self._ranges.iteritems()
+                if r is not None and r[0] <= blockid <= r[1]]
+
+
     def check_size(self):
         'Checks the sizes of the database level, increasing the size as needed.'
 
@@ -269,110 +559,345 @@ class Database(database.Database):
     def add(self, block, transactions):
         'Add transactions to the database.'
 
+        return self.add_blocks([(block, transactions)])[0]
+
+
+    def add_blocks(self, blocks):
+        '''Add the transactions for many blocks to the database at once.
+
+           Each item in blocks is a (block, transactions) tuple. Rows are
+           inserted with a single executemany per partition and each
+           partition is committed once, as are the blocks' transaction
+           counts. Returns the list of updated blocks.'''
+
         # expand the database if necessary
         self.check_size()
 
-        # check the merkle root of the transactions against the block
-        block._check_merkle_root(util.get_merkle_root(transactions))
+        # check the merkle root of every block before writing anything
+        for (block, transactions) in blocks:
+            block._check_merkle_root(util.get_merkle_root(transactions))
 
-        # for each transaction...
-        connections = dict()
-        block_txns = [ ]
-        for (txn_index, txn) in enumerate(transactions):
+        # group the rows (and txids) by the partition they belong in
+        rows = dict()
+        txids = dict()
+        updates = [ ]
+        for (block, transactions) in blocks:
+            block_txns = [ ]
+            for (txn_index, txn) in enumerate(transactions):
+                txid = txn.hash
+                loc = (self._N, get_q(txid) % self._N)
 
-            # ...get the database to save to
-            txid = txn.hash
-            q = get_q(txid)
-            connection = self.get_connection(self._N, q)
-            connections[(self._N, q % self._N)] = connection
+                txck = keys.get_txck(block._blockid, txn_index)
+                row = (txck, keys.get_hint(txid), buffer(txn.binary()), buffer(txid))
+                rows.setdefault(loc, [ ]).append(row)
+                txids.setdefault(loc, [ ]).append(txid)
 
-            # ...insert
-            cursor = connection.cursor()
-            txck = keys.get_txck(block._blockid, txn_index)
-            row = (txck, keys.get_hint(txid), buffer(txn.binary()))
-            try:
-                cursor.execute(self.sql_insert, row)
+                # wrap up the transaction for the returned block
+                block_txns.append(Transaction(self, row, txn))
+
+            updates.append((block, block_txns))
+
+        self._write_partitions(rows, txids)
+
+        # update the blocks with their transactions (all in one commit)
+        if updates:
+            block = updates[0][0]
+            block._database._update_transactions(updates)
 
-            # (duplicates don't matter)
-            except sqlite3.IntegrityError, e:
-                if e.message != _KEY_DUP:
-                    raise e
+        # return the now updated blocks
+        return [b for (b, t) in updates]
+
+    def _write_partitions(self, rows, txids):
+        '''Insert and commit each partition's rows, along with its block id
+           range and bloom filter. Both rows and txids map (n, i % n) tuples
+           to a list. Internal use.'''
+
+        for (loc, partition_rows) in rows.iteritems():
+            connection = self.get_connection(*loc)
+            connection.executemany(self.sql_insert_ignore, partition_rows)
+
+            blockids = [keys.get_txck_blockid(r[0]) for r in partition_rows]
+            block_range = (min(blockids), max(blockids))
+            if self._ranges.get(loc):
+                block_range = (min(block_range[0], self._ranges[loc][0]),
+                               max(block_range[1], self._ranges[loc][1]))
+
+            cursor = connection.cursor()
+            self.set_metadata(cursor, KEY_MIN_BLOCKID, block_range[0])
+            self.set_metadata(cursor, KEY_MAX_BLOCKID, block_range[1])
 
-            # wrap up the transaction for the returned block
-            block_txns.append(Transaction(self, row, txn))
+            # the bloom filter must be on disk before the rows are committed
+            bloom_filter = self._blooms.get(loc)
+            if bloom_filter is not None:
+                for txid in txids[loc]:
+                    bloom_filter.add(txid)
+                bloom_filter.flush()
 
-        # commit the transactions to the databases
-        for connection in connections.values():
             connection.commit()
 
-        # update the block with the transactions
-        block._update_transactions(block_txns)
+            self._ranges[loc] = block_range
+
+
+    def compact(self, limit = None, duration = None):
+        '''Move up to limit transactions (or all, if None) from the lower
+           levels into the highest level, retiring each level that is left
+           empty. If duration is given, stop (between batches) once that many
+           seconds have passed. Returns the number of transactions moved.
+
+           Only the process adding transactions may compact, since the bloom
+           filters of the highest level are updated.'''
+
+        # expand the database if necessary, so we don't fill the top level
+        self.check_size()
+
+        self._remove_retired_files()
+
+        deadline = None
+        if duration is not None:
+            deadline = time.time() + duration
+
+        moved = 0
+        for n in reversed(self._levels()):
+            if n >= self._N: break
+
+            for i in xrange(0, n):
+                connection = self._connections[(n, i)]
+                cursor = connection.cursor()
+                while True:
+                    count = self.COMPACT_BATCH_SIZE
+                    if limit is not None:
+                        count = min(count, limit - moved)
+                        if count <= 0: return moved
+
+                    # always make some progress, then yield once out of time
+                    if moved and deadline is not None and time.time() >= deadline:
+                        return moved
+
+                    cursor.execute(self.sql_select + ' limit ?', (count, ))
+                    partition_rows = cursor.fetchall()
+                    if not partition_rows: break
+
+                    rows = dict()
+                    txids = dict()
+                    for row in partition_rows:
+                        txid = Transaction(self, row).hash
+                        loc = (self._N, get_q(txid) % self._N)
+                        rows.setdefault(loc, [ ]).append(tuple(row))
+                        txids.setdefault(loc, [ ]).append(txid)
+
+                    # commit the new copies before deleting the old ones
+                    self._write_partitions(rows, txids)
+
+                    cursor.executemany('delete from txns where txck = ?', [(r[0], ) for r in partition_rows])
+                    connection.commit()
+
+                    moved += len(partition_rows)
+
+            self._retire_level(n)
+
+        return moved
+
+
+    def _close_level(self, n):
+        'Close the connections and bloom filters for level n. Internal use.'
+
+        for i in xrange(0, n):
+            loc = (n, i)
+
+            self._connections.pop(loc).close()
+            del self._ranges[loc]
+            bloom_filter = self._blooms.pop(loc)
+            if bloom_filter is not None:
+                bloom_filter.close()
+
+
+    def _retire_level(self, n):
+        '''Close and delete the (now empty) files for level n. Internal use.
+
+           Other processes may still have the files open; they keep reading
+           the (empty) level until they notice it is gone (see _load_levels).
+           So the -wal and -shm files are left until a later pass (see
+           _remove_retired_files).'''
+
+        self._close_level(n)
+
+        # the first file marks the level as existing, so it goes first
+        for i in xrange(0, n):
+            filename = self.get_filename(self.get_suffix(n, i))
+            for path in (filename, self.get_bloom_filename(n, i)):
+                if os.path.isfile(path):
+                    os.remove(path)
+
+        self._retired.add(n)
+
+
+    def _remove_retired_files(self):
+        '''Delete any -wal and -shm files left by retiring levels. Once the
+           database file is gone, no new connection can use them, and open
+           connections keep their own descriptors. Internal use.'''
+
+        for n in self._retired:
+            for i in xrange(0, n):
+                filename = self.get_filename(self.get_suffix(n, i))
+                if os.path.isfile(filename): continue
+                for path in (filename + '-wal', filename + '-shm'):
+                    if os.path.isfile(path):
+                        os.remove(path)
+
+        self._retired = set()
 
-        # return the now updated block
-        return block
 
-    # @TODO optimization: store in each txn db a max_blockid so we can prune
     def _get(self, txck):
-        ''
+        'Find a transaction by its txck. Internal use.'
+
+        row = self._select(txck, self.sql_select)
+        if row is None:
+            return None
+
+        return Transaction(self, row)
 
-        for connection in self._connections.values():
+    def _get_txid(self, txck):
+        '''Find the txid for a txck, without reading the transaction. Internal
+           use.'''
+
+        row = self._select(txck, 'select txid from txns')
+        if row is None:
+            return None
+
+        return str(row[0])
+
+    def _get_txids(self, txcks, refresh = True):
+        '''Find the txids for many txcks, with one query per batch of txcks for
+           each database which may contain them. Returns a dict mapping txck to
+           txid. Internal use.'''
+
+        # group the txcks by the databases that may contain them
+        groups = dict()
+        for txck in set(txcks):
+            blockid = keys.get_txck_blockid(txck)
+            for (loc, r) in self._ranges.iteritems():
+                if r is not None and r[0] <= blockid <= r[1]:
+                    groups.setdefault(loc, [ ]).append(txck)
+
+        txids = dict()
+        for (loc, group) in groups.iteritems():
+            cursor = self._connections[loc].cursor()
+            for offset in xrange(0, len(group), 500):
+                batch = group[offset:offset + 500]
+                sql = 'select txck, txid from txns where txck in (%s)' % ','.join('?' for t in batch)
+                cursor.execute(sql, batch)
+                txids.update((r[0], str(r[1])) for r in cursor.fetchall())
+
+        # maybe another process added some, and we didn't know? Try again.
+        missing = [t for t in txcks if t not in txids]
+        if missing and refresh and self._refresh_ranges():
+            txids.update(self._get_txids(missing, False))
+
+        return txids
+
+    def _select(self, txck, sql, refresh = True):
+        'Return the row selected by sql for a txck, or None. Internal use.'
+
+        blockid = keys.get_txck_blockid(txck)
+        for connection in self._locate(blockid):
             cursor = connection.cursor()
-            cursor.execute(self.sql_select + ' where txck = ?', (txck, ))
+            cursor.execute(sql + ' where txck = ?', (txck, ))
             row = cursor.fetchone()
             if row:
-                return Transaction(self, row)
+                return row
+
+        # maybe another process added it, and we didn't know? Try again.
+        if refresh and self._refresh_ranges():
+            return self._select(txck, sql, False)
 
         return None
 
-    def _get_transactions(self, blockid):
+    def _get_transactions(self, blockid, refresh = True):
         "Find all transactions for a block, ordered by transaction index. Internal use."
 
         # the range that this block's composite keys can have [lo, hi)
         lo = keys.get_txck(blockid, 0)
         hi = keys.get_txck(blockid + 1, 0)
 
-        # find all transactions across all databases within this range
-        txns = [ ]
-        for connection in self._connections.values():
+        # find all transactions across the databases that may contain them
+        # (while compacting, a transaction may briefly be in two files)
+        txns = dict()
+        for connection in self._locate(blockid):
             cursor = connection.cursor()
             cursor.execute(self.sql_select + ' where txck >= ? and txck < ?', (lo, hi))
-            txns.extend((r[0], r) for r in cursor.fetchall())
+            txns.update((r[0], r) for r in cursor.fetchall())
+
+        # maybe another process added them, and we didn't know? Try again.
+        if not txns and refresh and self._refresh_ranges():
+            return self._get_transactions(blockid, False)
 
         # sort by index (actually (blockid, index), but all have same blockid)
-        txns.sort()
+        # and wrap it up in a helpful wrapper
+        return [Transaction(self, txns[txck]) for txck in sorted(txns)]
 
-        # wrap it up in a helpful wrapper
-        return [Transaction(self, row) for (txck, row) in txns]
+
+    def get_block_binary(self, block):
+        '''Returns the payload of a block message for a block, or None if its
+           transactions are not stored.'''
+
+        txns = self._get_transactions(block._blockid)
+        if not txns:
+            return None
+
+        header = util.get_block_header(block.version, block.previous_hash or _0,
+                                       block.merkle_root, block.timestamp,
+                                       block.bits, block.nonce)
+        count = protocol.format.FormatTypeVarInteger.binary(len(txns))
+        return ''.join([header, count] + [t.txn_binary for t in txns])
 
 
     def get(self, txid, default = None):
         'Get a transaction by its txid.'
 
+        row = self._find(txid, self.sql_select)
+        if row is None:
+            return default
+
+        return Transaction(self, row)
+
+
+    def _get_txck(self, txid):
+        '''Find the txck for a txid, without reading the transaction. Internal
+           use.'''
+
+        row = self._find(txid, 'select txck from txns')
+        if row is None:
+            return None
+
+        return row[0]
+
+
+    def _find(self, txid, sql):
+        'Return the row selected by sql for a txid, or None. Internal use.'
+
         # the hint we index by for faster lookup
         txid_hint = keys.get_hint(txid)
 
         # search each level (n, n // 2, n // 4, etc)
-        n = self._N
         q = get_q(txid)
-        while n >= self.MINIMUM_N:
+        for n in self._levels():
             connection = self.get_connection(n, q)
 
-            cursor = connection.cursor()
-            cursor.execute(self.sql_select + ' where txid_hint = ?', (txid_hint, ))
-            for row in cursor.fetchall():
-                (vl, txn) = protocol.Txn.parse(row[2])
-                if txn.hash == txid:
-                    return Transaction(self, row, txn)
-
-            n //= 2
+            # skip files the bloom filter says definitely don't have it
+            bloom_filter = self._blooms.get((n, q % n))
+            if bloom_filter is None or txid in bloom_filter:
+                # the hint index prunes; the stored txid confirms
+                cursor = connection.cursor()
+                cursor.execute(sql + ' where txid_hint = ? and txid = ?', (txid_hint, buffer(txid)))
+                row = cursor.fetchone()
+                if row:
+                    return row
 
         # maybe another process grew us, and we didn't know? Try again.
-        new_n = self.load_n()
-        if new_n != self._N:
-            self._N = new_n
-            return self._get(txid)
+        if self._load_levels():
+            return self._find(txid, sql)
 
-        return default
+        return None
 
 
     #def __getitem__(self, name):
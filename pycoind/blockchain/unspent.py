@@ -25,6 +25,13 @@
 #
 #   uock         - unspent output composite key (see below)
 #   address_hint - hash integer, provides pruning to likely address
+#   value        - the output's value
+#   pk_script    - the output's script, compressed (see compress_script)
+#   height       - the height of the block that created the output
+#   coinbase     - whether the output is from a coinbase transaction
+#
+# Since the value and script are stored, spending an output needs only its
+# txck from the transaction database; not the whole previous transaction.
 #
 
 # Composite Keys
@@ -45,32 +52,153 @@
 # any obviously non-matching elements. The remaining elements must then be
 # compared against confirmed values, since the hash may yield false positives.
 
+# Cache
+#
+# Changes are made to an in-memory write-back cache (see UnspentCache) and
+# only written to the database when it is flushed, along with the last valid
+# block, in a single transaction. Most outputs are spent within a few blocks
+# of being created, so are never written at all, and spending a cached output
+# doesn't need to load its transaction.
+
+# Undo
+#
+# For each block added, the outputs it spent (exactly as they were stored) are
+# kept in the undo table, so the block can be rolled back by deleting the
+# outputs it created and restoring the outputs it spent. Only the most recent
+# UNDO_DEPTH blocks are kept.
+#
+#   blockid      - the block the undo data is for
+#   height       - the block's height (for pruning)
+#   data         - the spent unspent rows (see pack_undo)
+
 
-import sqlite3
+import collections
 import multiprocessing
 import signal
+import struct
 import time
 
+from . import block
 from . import database
 from . import keys
 
 from .. import coins
+from .. import protocol
 from .. import script
 from .. import util
 
+from ..util.ecdsa import SECP256k1 as _curve
+from ..util.ecdsa.numbertheory import square_root_mod_prime
+
 __all__ = ['Database']
 
 
 KEY_LAST_VALID_BLOCK = 2
 
 
-_KEY_DUP = 'PRIMARY KEY must be unique'
 _0 = chr(0) * 32
 
 
 class InvalidTransactionException(Exception): pass
 
 
+# Script Compression
+#
+# The most common scripts are stored as a kind byte followed by only their
+# interesting bytes (the same scheme as the reference client):
+#   0x00 + hash160          - pay-to-pubkey-hash
+#   0x01 + hash160          - pay-to-script-hash
+#   0x02 (or 0x03) + x      - pay-to-pubkey (compressed public key)
+#   0x04 (or 0x05) + x      - pay-to-pubkey (uncompressed public key)
+#   0xff + script           - anything else
+
+_p = _curve.curve.p()
+_b = _curve.curve.b()
+
+def _on_curve(x, y):
+    return (y * y - x * x * x - _b) % _p == 0
+
+def compress_script(pk_script):
+    'Returns the compressed form of a pk_script.'
+
+    length = len(pk_script)
+
+    # OP_DUP OP_HASH160 <20 bytes> OP_EQUALVERIFY OP_CHECKSIG
+    if length == 25 and pk_script[:3] == '\x76\xa9\x14' and pk_script[23:] == '\x88\xac':
+        return '\x00' + pk_script[3:23]
+
+    # OP_HASH160 <20 bytes> OP_EQUAL
+    if length == 23 and pk_script[:2] == '\xa9\x14' and pk_script[22] == '\x87':
+        return '\x01' + pk_script[2:22]
+
+    # <33 byte compressed public key> OP_CHECKSIG
+    if length == 35 and pk_script[0] == '\x21' and pk_script[1] in '\x02\x03' and pk_script[34] == '\xac':
+        return pk_script[1:34]
+
+    # <65 byte uncompressed public key> OP_CHECKSIG (only if on the curve,
+    # otherwise it could not be decompressed)
+    if length == 67 and pk_script[:2] == '\x41\x04' and pk_script[66] == '\xac':
+        x = int(pk_script[2:34].encode('hex'), 16)
+        y = int(pk_script[34:66].encode('hex'), 16)
+        if _on_curve(x, y):
+            return chr(0x04 | (y & 0x01)) + pk_script[2:34]
+
+    return '\xff' + pk_script
+
+def decompress_script(data):
+    'Returns the pk_script for the compressed form of a pk_script.'
+
+    data = str(data)
+    kind = ord(data[0])
+
+    if kind == 0x00:
+        return '\x76\xa9\x14' + data[1:] + '\x88\xac'
+
+    if kind == 0x01:
+        return '\xa9\x14' + data[1:] + '\x87'
+
+    if kind in (0x02, 0x03):
+        return '\x21' + data + '\xac'
+
+    if kind in (0x04, 0x05):
+        x = int(data[1:].encode('hex'), 16)
+        y = square_root_mod_prime((x * x * x + _b) % _p, _p)
+        if (y & 0x01) != (kind & 0x01):
+            y = _p - y
+        return '\x41\x04' + data[1:] + ('%064x' % y).decode('hex') + '\xac'
+
+    return data[1:]
+
+
+# uock, address_hint, value, height, coinbase, pk_script length
+_UNDO_FORMAT = struct.Struct('<QqqiBI')
+
+def pack_undo(rows):
+    '''Returns the undo data for a list of unspent rows (uock, address_hint,
+       value, pk_script, height, coinbase); pk_script must be compressed.'''
+
+    data = [ ]
+    for (uock, address_hint, value, pk_script, height, coinbase) in rows:
+        data.append(_UNDO_FORMAT.pack(uock, address_hint, value, height, coinbase, len(pk_script)))
+        data.append(str(pk_script))
+    return ''.join(data)
+
+def unpack_undo(data):
+    'Returns the list of unspent rows for undo data.'
+
+    data = str(data)
+
+    rows = [ ]
+    offset = 0
+    while offset < len(data):
+        (uock, address_hint, value, height, coinbase, length) = _UNDO_FORMAT.unpack_from(data, offset)
+        offset += _UNDO_FORMAT.size
+        pk_script = data[offset:offset + length]
+        offset += length
+        rows.append((uock, address_hint, value, buffer(pk_script), height, bool(coinbase)))
+    return rows
+
+
 def init_worker():
     "Initialize a process to ignore keyboard interrupts."
 
@@ -84,50 +212,309 @@ def po_value(transaction, index):
     return 0
 
 
+# Verification
+#
+# Checking signatures dominates adding a block, so it is spread across worker
+# processes. Rather than pickling whole transactions (and their previous
+# transactions) for the workers, each input is reduced here to a compact work
+# item, which are sent to the workers in chunks:
+#   (WORK_SIGNATURE, digest, public_key, signature) - a standard input
+#   (WORK_SCRIPT, txn_binary, input_index, pk_script) - any other input
+
+WORK_SIGNATURE = 0
+WORK_SCRIPT    = 1
+
+class _TxnView(object):
+    'Just enough of a transaction, from its bytes, to process its scripts.'
+
+    def __init__(self, binary):
+        (vl, self._txn) = protocol.Txn.parse(binary)
+
+    version = property(lambda s: s._txn.version)
+    inputs = property(lambda s: s._txn.tx_in)
+    outputs = property(lambda s: s._txn.tx_out)
+    lock_time = property(lambda s: s._txn.lock_time)
+
+
+def check_transaction(transaction, verify_scripts = True):
+    """Check a transaction's amounts and prepare its inputs' work items. Returns
+       (valid, pubkeyhashes, fees, items), with the public key hash each output
+       pays to (or None); each item must also verify. If not verify_scripts,
+       there are no items."""
+
+    # do the inputs afford the outputs? (coinbase is an exception)
+    fees = 0
+    if transaction.index != 0:
+        sum_in = sum(po_value(transaction, i) for i in xrange(0, len(transaction.inputs)))
+        sum_out = sum(o.value for o in transaction.outputs)
+        fees = sum_in - sum_out
+        if fees < 0:
+            return (False, [], 0, [])
+
+    txio = script.Script(transaction)
+    pubkeyhashes = [txio.output_pubkeyhash(o) for o in xrange(0, txio.output_count)]
+
+    items = [ ]
+    if not verify_scripts:
+        return (True, pubkeyhashes, fees, items)
+
+    binary = None
+    for i in xrange(0, len(transaction.inputs)):
+
+        # ignore coinbase (generation transaction input)
+        if transaction.index == 0 and i == 0: continue
+
+        previous_output = transaction.previous_output(i)
+        if previous_output is None:
+            return (False, pubkeyhashes, fees, [])
+
+        check = txio.signature_check(i, previous_output.pk_script)
+        if check is None:
+            if binary is None:
+                binary = transaction.txn.binary()
+            items.append((WORK_SCRIPT, binary, i, previous_output.pk_script))
+        else:
+            items.append((WORK_SIGNATURE, ) + check)
+
+    return (True, pubkeyhashes, fees, items)
+
+
+def verify_item(item):
+    "Verify a work item (see check_transaction). Safe for worker processes."
+
+    if item[0] == WORK_SIGNATURE:
+        return util.ecc.verify_digest(item[1], item[2], item[3])
+
+    (kind, binary, input_index, pk_script) = item
+    transaction = _TxnView(binary)
+    signature_script = transaction.inputs[input_index].signature_script
+    return script.Script.process(signature_script, pk_script, transaction, input_index)
+
+
 def verify(transaction):
     "Veryify a transaction's inputs and outputs."
-    try:
-        # do the inputs afford the outputs? (coinbase is an exception)
-        fees = 0
-        if transaction.index != 0:
-            sum_in = sum(po_value(transaction, i) for i in xrange(0, len(transaction.inputs)))
-            sum_out = sum(o.value for o in transaction.outputs)
-            fees = sum_in - sum_out
-            if fees < 0:
-                print sum_in, sum_out
-                print "FAIL(sum_in < sum_out)", transaction
-                return (False, [], 0)
-
-        # are all inputs valid against their previous output?
-        txio = script.Script(transaction)
-        valid = txio.verify()
-        addresses = [txio.output_address(o) for o in xrange(0, txio.output_count)]
-
-        if not valid:
-            print transaction
-
-        return (valid, addresses, fees)
-    except Exception, e:
-        print transaction, e
-        import traceback
-        traceback.print_exc()
-        raise e
+
+    (valid, pubkeyhashes, fees, items) = check_transaction(transaction)
+    if valid:
+        valid = all(verify_item(i) for i in items)
+    return (valid, pubkeyhashes, fees)
+
+
+class UnspentCache(object):
+    '''An in-memory write-back cache of unspent outputs, by (txid, index).
+
+       Added outputs are dirty until flushed; spending a dirty output simply
+       forgets it. Spending any other output queues its uock to be deleted.
+       Once flushed, the least recently used outputs are evicted.'''
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+
+        # maps (txid, index) => [uock, value, pk_script, height, coinbase,
+        # address_hint, dirty]
+        self._outputs = collections.OrderedDict()
+        self._dirty_count = 0
+
+        # maps address_hint => set of (txid, index) of the dirty outputs
+        self._added = dict()
+
+        # uocks spent since the last flush
+        self._spent = set()
+
+    spent = property(lambda s: s._spent)
+    full = property(lambda s: len(s._outputs) > s._max_size)
+
+    # are there changes not yet flushed?
+    dirty = property(lambda s: bool(s._dirty_count or s._spent))
+
+    def __len__(self):
+        return len(self._outputs)
+
+    def get(self, txid, index):
+        '''Returns the (uock, value, pk_script, height, coinbase, address_hint)
+           of an output, or None if not cached.'''
+
+        key = (txid, index)
+        entry = self._outputs.pop(key, None)
+        if entry is None:
+            return None
+
+        # now the most recently used
+        self._outputs[key] = entry
+
+        return tuple(entry[:6])
+
+    def add(self, txid, index, uock, value, pk_script, height, coinbase, address_hint, dirty = True):
+        if (txid, index) in self._outputs: return
+        self._outputs[(txid, index)] = [uock, value, pk_script, height, coinbase, address_hint, dirty]
+        if dirty:
+            self._dirty_count += 1
+            self._added.setdefault(address_hint, set()).add((txid, index))
+
+    def spend(self, txid, index, uock):
+        entry = self._outputs.pop((txid, index), None)
+
+        # never written, so there is nothing to delete
+        if entry is not None and entry[6]:
+            self._dirty_count -= 1
+            added = self._added[entry[5]]
+            added.discard((txid, index))
+            if not added:
+                del self._added[entry[5]]
+            return
+
+        if uock in self._spent:
+            raise Exception('bad state: output spent twice')
+        self._spent.add(uock)
+
+    def added(self, address_hints):
+        '''Returns the (uock, value, pk_script, address_hint) of unflushed
+           outputs with any of address_hints.'''
+
+        result = [ ]
+        for address_hint in address_hints:
+            for key in self._added.get(address_hint, ()):
+                entry = self._outputs[key]
+                result.append(tuple(entry[:3]) + (address_hint, ))
+        return result
+
+    def flush(self, cursor, sql_insert, sql_delete):
+        '''Write the dirty outputs and queued deletes using cursor; the caller
+           must commit, then call flushed. Nothing is marked clean here, so a
+           failed flush may simply be retried.'''
+
+        rows = [ ]
+        if self._dirty_count:
+            for entry in self._outputs.itervalues():
+                if not entry[6]: continue
+                (uock, value, pk_script, height, coinbase, address_hint, dirty) = entry
+                rows.append((uock, address_hint, value, buffer(compress_script(pk_script)), height, coinbase))
+        cursor.executemany(sql_insert, rows)
+
+        if self._spent:
+            cursor.executemany(sql_delete, [(u, ) for u in self._spent])
+            if cursor.rowcount != len(self._spent):
+                raise Exception('bad state: failed to delete a utxo')
+
+    def flushed(self):
+        'Mark everything written by flush as clean, once committed.'
+
+        if self._dirty_count:
+            for entry in self._outputs.itervalues():
+                entry[6] = False
+            self._dirty_count = 0
+            self._added = dict()
+
+        self._spent = set()
+
+    def evict(self):
+        'Drop the least recently used outputs, until no longer full.'
+
+        if self._dirty_count:
+            raise ValueError('cannot evict unflushed outputs')
+
+        while self.full:
+            self._outputs.popitem(last = False)
+
+    def clear(self):
+        'Drop all outputs; everything must already be flushed.'
+
+        if self._dirty_count or self._spent:
+            raise ValueError('cannot clear unflushed outputs')
+
+        self._outputs.clear()
 
 
 class Database(database.Database):
     Columns = [
         ('uock', 'integer primary key', False),
         ('address_hint', 'integer', True),
+        ('value', 'integer', False),
+        ('pk_script', 'blob', False),
+        ('height', 'integer', False),
+        ('coinbase', 'boolean', False),
     ]
     Name = 'unspent'
 
-    def __init__(self, data_dir, coin = coins.Bitcoin, processes = None):
-        database.Database.__init__(self, data_dir, coin)
+    Version = 3
+
+    def _migrate_from_1(self, cursor):
+        '''Adds the value, pk_script, height and coinbase columns, reading
+           each output from the transaction database.'''
+
+        # a previously interrupted migration may have added the columns
+        cursor.execute('pragma table_info(unspent)')
+        existing = [r[1] for r in cursor.fetchall()]
+        for (name, kind, indexed) in self.Columns:
+            if name not in existing:
+                cursor.execute('alter table unspent add column %s %s' % (name, kind))
+
+        # the block (and transaction) databases may be obsolete too
+        blocks = block.Database(self.data_dir, self.coin, migrate = self.migrate)
+
+        # maps blockid => height
+        heights = dict()
+
+        uock = -1
+        while True:
+            cursor.execute('select uock from unspent where uock > ? order by uock limit 1000', (uock, ))
+            uocks = [r[0] for r in cursor.fetchall()]
+            if not uocks: break
+
+            updates = [ ]
+            for uock in uocks:
+                txck = keys.get_uock_txck(uock)
+                output = blocks._txns._get(txck).outputs[keys.get_uock_index(uock)]
+
+                blockid = keys.get_txck_blockid(txck)
+                if blockid not in heights:
+                    heights[blockid] = blocks._get(blockid).height
+
+                coinbase = (keys.get_txck_index(txck) == 0)
+                updates.append((output.value, buffer(compress_script(output.pk_script)), heights[blockid], coinbase, uock))
+
+            cursor.executemany('update unspent set value = ?, pk_script = ?, height = ?, coinbase = ? where uock = ?', updates)
+
+        blocks.close()
+
+    def _migrate_from_2(self, cursor):
+        'Adds the undo table; blocks already added cannot be rolled back.'
+
+        self._create_undo_table(cursor)
+
+    Migrations = {1: _migrate_from_1, 2: _migrate_from_2}
+
+    # maximum number of outputs to hold in memory (see UnspentCache)
+    CACHE_SIZE = 250000
+
+    # number of recent blocks which can be rolled back
+    UNDO_DEPTH = 2016
+
+    # number of blocks being verified while the next block is prepared
+    PIPELINE_DEPTH = 4
+
+    def __init__(self, data_dir, coin = coins.Bitcoin, processes = None, profile = None, migrate = False, assume_valid = False):
+        database.Database.__init__(self, data_dir, coin, profile, migrate)
+
+        # skip verifying scripts up to the coin's last checkpoint
+        self._assume_valid = assume_valid
 
         self.sql_delete = 'delete from unspent where uock = ?'
 
+        # duplicates don't matter
+        self.sql_insert_ignore = self.sql_insert.replace('insert', 'insert or ignore', 1)
+
         self._connection = self.get_connection()
 
+        self._cache = UnspentCache(self.CACHE_SIZE)
+        self._last_valid_block = self.get_metadata(self._connection.cursor(), KEY_LAST_VALID_BLOCK)
+
+        # (blockid, height, undo data) for each block not yet flushed
+        self._undo = [ ]
+
+        # verified blocks not yet flushed (see update_blocks)
+        self._unflushed = [ ]
+
         if processes is None or processes != 1:
             self._pool = multiprocessing.Pool(processes = processes, initializer = init_worker)
             print "Spawning %d processes" % self._pool._processes
@@ -135,145 +522,458 @@ class Database(database.Database):
             self._pool = None
 
     def populate_database(self, cursor):
+        self._create_undo_table(cursor)
         self.set_metadata(cursor, KEY_LAST_VALID_BLOCK, 1)
 
-    @property
-    def last_valid_block(self):
-        cursor = self._connection.cursor()
-        return self.get_metadata(cursor, KEY_LAST_VALID_BLOCK)
+    def _create_undo_table(self, cursor):
+        cursor.execute('create table undo (blockid integer primary key, height integer, data blob)')
+        cursor.execute('create index index_undo_height on undo (height)')
+
+    # the last block added; it may not be flushed to the database yet
+    last_valid_block = property(lambda s: s._last_valid_block)
+
+    assume_valid = property(lambda s: s._assume_valid)
+
+    def _assumed_valid(self, block):
+        '''Returns True if a block's scripts need not be verified; it is on the
+           mainchain at or below the last checkpoint, which is also on the
+           mainchain.'''
+
+        if not (self._assume_valid and self.coin.checkpoints):
+            return False
 
-    def _todo_rollback(self, block):
-        'Undo all unspent transactions for a block. Must be the latest valid block.'
+        (height, block_hash) = self.coin.checkpoints[-1]
+        if block.height > height or not block.mainchain:
+            return False
+
+        return block._database.get(block_hash) is not None
+
+    def rollback(self, block):
+        '''Undo all unspent transaction outputs for a block, restoring those it
+           spent. Must be the latest valid block.'''
 
         # this would break our data model (but shouldn't be possible anyways)
         if block._blockid <= 1:
             raise ValueError('cannot remove pre-genesis block')
 
-        # get the base uock for this block (ie. txn_index == output_index == 0)
-        txck = keys.get_txck(block._blockid, 0)
-        uock = keys.get_uock(txck, 0)
+        # make sure we are removing a block we have already added
+        if self._last_valid_block != block._blockid:
+            raise ValueError('can only rollback last valid block')
+
+        # the database must be up to date (including the undo data)
+        self.flush()
+
+        # the range of uocks for this block (ie. txn_index == output_index == 0)
+        uock_lo = keys.get_uock(keys.get_txck(block._blockid, 0), 0)
+        uock_hi = keys.get_uock(keys.get_txck(block._blockid + 1, 0), 0)
 
         # begin a transaction, locking out other updates
         cursor = self._connection.cursor()
         cursor.execute('begin immediate transaction')
+        try:
+            cursor.execute('select data from undo where blockid = ?', (block._blockid, ))
+            row = cursor.fetchone()
+            if row is None:
+                raise ValueError('no undo data for block')
 
-        # make sure we are removing a block we have already added
-        last_valid_block = self.get_metadata(cursor, KEY_LAST_VALID_BLOCK)
-        if last_valid_block != block._blockid:
-            raise ValueError('can only rollback last valid block')
+            # remove all outputs
+            cursor.execute('delete from unspent where uock >= ? and uock < ?', (uock_lo, uock_hi))
 
-        # remove all outputs
-        raise NotImplemented()
+            # re-add all inputs' outputs
+            cursor.executemany(self.sql_insert, unpack_undo(row[0]))
+            cursor.execute('delete from undo where blockid = ?', (block._blockid, ))
 
-        # re-add all inputs' outputs
-        raise NotImplemented()
+            # the most recent block is now the previous block
+            self.set_metadata(cursor, KEY_LAST_VALID_BLOCK, block._previous_blockid)
 
-        # the most recent block is now the previous block
-        self.set_metadata(cursor, KEY_LAST_VALID_BLOCK, block._previous_blockid)
+        except Exception, e:
+            self._connection.rollback()
+            raise e
 
         self._connection.commit()
 
+        self._last_valid_block = block._previous_blockid
+
+        # the cache may hold outputs from this block
+        self._cache.clear()
+
+
+    def connect(self, blocks, max_count = None, duration = None):
+        '''Follow the mainchain of a block database; rolls back any blocks no
+           longer on the mainchain, then adds the following mainchain blocks
+           whose transactions are available. At most max_count blocks are
+           added and, if duration is given, no more are begun once that many
+           seconds have passed. Returns the number of blocks added.'''
+
+        deadline = None
+        if duration is not None:
+            deadline = time.time() + duration
+
+        tip = blocks._get(self._last_valid_block)
+
+        # disconnect blocks orphaned by a mainchain switch
+        while not tip.mainchain:
+            self.rollback(tip)
+            tip = tip.previous_block
+
+        def following(tip):
+            count = 0
+            while max_count is None or count < max_count:
+                if count and deadline is not None and time.time() >= deadline:
+                    break
+
+                try:
+                    tip = blocks[tip.height + 1]
+                except IndexError:
+                    break
+
+                # transactions not downloaded yet
+                if tip.txn_count == 0: break
+
+                yield tip
+                count += 1
+
+        return self.update_blocks(following(tip))
+
 
     def update(self, block):
         '''Updates the unspent transaction output (utxo) database with the
            transactions from a block.'''
 
-        t0 = time.time()
+        self.update_blocks([block])
 
-        txns = block.transactions
-        for txn in txns:
-            txn.cache_previous_outputs()
 
-        t1 = time.time()
+    def update_blocks(self, blocks):
+        '''Updates the utxo database with consecutive blocks, returning the
+           number of blocks added.
 
-        if self._pool is None:
-            results = map(verify, txns)
-        else:
-            results = self._pool.map(verify, txns)
+           The blocks are pipelined; while the workers verify a block's
+           signatures, the following blocks' previous outputs are loaded and
+           their changes made to the cache (at most PIPELINE_DEPTH blocks
+           ahead). Nothing is flushed until those blocks are verified. The
+           verified changes are flushed whenever the cache fills, and before
+           returning, so other processes see them (and a crash loses at most
+           a batch of blocks).
+
+           If a block is invalid, every change after the last valid block is
+           discarded and the exception is raised.
+
+           With assume_valid, scripts in blocks up to the coin's last
+           checkpoint are not verified; amounts are still checked. Coins
+           without checkpoints (currently all but Bitcoin) verify everything.'''
+
+        # (block, callable returning each work item's result)
+        pending = collections.deque()
+
+        # the block database, to replay verified blocks if one is invalid
+        block_database = None
+
+        count = 0
+        try:
+            for block in blocks:
+                block_database = block._database
+                while len(pending) >= self.PIPELINE_DEPTH:
+                    self._commit(*pending.popleft())
+
+                pending.append(self._prepare(block))
+                count += 1
+
+                # write everything out in one large batch once the cache fills up
+                if self._cache.full:
+                    while pending:
+                        self._commit(*pending.popleft())
+                    self.flush()
+
+            while pending:
+                self._commit(*pending.popleft())
+
+            if self._unflushed:
+                self.flush()
+
+        except Exception, e:
+
+            # drop any changes made for blocks not verified
+            if self._unflushed:
+                verified = self._unflushed[-1]
+            else:
+                verified = self.get_metadata(self._connection.cursor(), KEY_LAST_VALID_BLOCK)
+            if self._last_valid_block != verified:
+                self._discard(block_database)
+            raise e
+
+        return count
+
+
+    def _prepare(self, block):
+        '''Loads a block's previous outputs, checks its amounts, makes its
+           changes to the cache and starts verifying its signatures. Returns
+           (block, callable) for _commit.'''
+
+        txns = block.transactions
+        undo = self._load_previous_outputs(txns, block._database._txns)
+
+        # amounts are always checked, but scripts may be trusted
+        verify_scripts = not self._assumed_valid(block)
+        checks = [check_transaction(t, verify_scripts) for t in txns]
 
         # make sure the coinbase's output doesn't exceed its permitted fees
-        fees = sum(r[2] for r in results)
+        fees = sum(c[2] for c in checks)
         fees += self.coin.block_creation_fee(block)
         sum_out = sum(o.value for o in txns[0].outputs)
         if fees < sum_out:
             raise InvalidTransactionException('invalid coinbase fee')
 
-        t2 = time.time()
+        items = [ ]
+        for (valid, pubkeyhashes, fees, txn_items) in checks:
+            items.extend(txn_items)
 
-        # update the database
-        self._update(block, [(t, r[0], r[1]) for (t, r) in zip(txns, results)])
+        if self._pool is None:
+            verified = map(verify_item, items)
+            get_verified = lambda: verified
+        else:
+            chunksize = max(1, len(items) // (4 * self._pool._processes))
+            get_verified = self._pool.map_async(verify_item, items, chunksize).get
+
+        # update the cache, assuming the signatures are valid
+        self._update(block, [(t, c[0], c[1]) for (t, c) in zip(txns, checks)], undo)
+
+        return (block, get_verified)
+
+
+    def _commit(self, block, get_verified):
+        "Wait for the workers to verify a block's signatures."
 
-        t3 = time.time()
+        if not all(get_verified()):
+            raise InvalidTransactionException('invalid signature')
 
-        print "Processed %d transaction (cache=%fs, compute=%fs, update=%fs)" % (len(txns), t1 - t0, t2 - t1, t3 - t2)
+        self._unflushed.append(block._blockid)
 
 
-    def _update(self, block, results):
+    def _discard(self, blocks):
+        '''Drop all unflushed changes, then re-apply the blocks already
+           verified since the last flush (skipping signatures).'''
 
-        # lock the database
         cursor = self._connection.cursor()
-        cursor.execute('begin immediate transaction')
+        self._cache = UnspentCache(self.CACHE_SIZE)
+        self._last_valid_block = self.get_metadata(cursor, KEY_LAST_VALID_BLOCK)
+        self._undo = [ ]
+
+        unflushed = self._unflushed
+        self._unflushed = [ ]
+        for blockid in unflushed:
+            block = blocks._get(blockid)
+            txns = block.transactions
+            undo = self._load_previous_outputs(txns, blocks._txns)
+            checks = [check_transaction(t, False) for t in txns]
+            self._update(block, [(t, c[0], c[1]) for (t, c) in zip(txns, checks)], undo)
+            self._unflushed.append(blockid)
+
+
+    def _load_previous_outputs(self, txns, txndb):
+        '''Provide each transaction with its previous outputs, from the cache,
+           an earlier transaction in the block or the database, so their
+           transactions need not be loaded. Returns the unspent rows spent from
+           before this block (the undo data). Nothing in the cache is changed,
+           so an invalid block can simply be dropped.'''
+
+        undo = [ ]
+        created = dict()
+        missing = dict()
+
+        # each previous output spent in this block, so none is spent twice
+        spent = set()
+
+        for txn in txns:
+            for i in xrange(0, len(txn.inputs)):
+
+                # coinbase transaction
+                if txn.index == 0 and i == 0: continue
+
+                po = txn.inputs[i].previous_output
+                if (po.hash, po.index) in spent:
+                    raise InvalidTransactionException('previous output spent twice in block')
+                spent.add((po.hash, po.index))
+
+                # created earlier in this block (rolling back removes it anyways)
+                known = created.get((po.hash, po.index))
+                if known is not None:
+                    txn._set_previous_output(i, *known)
+                    continue
+
+                known = self._cache.get(po.hash, po.index)
+                if known is not None:
+                    (uock, value, pk_script, height, coinbase, address_hint) = known
+                    txn._set_previous_output(i, uock, value, pk_script)
+                    undo.append((uock, address_hint, value, buffer(compress_script(pk_script)), height, coinbase))
+                    continue
+
+                # only the txck is needed to find the output in the database
+                txck = txndb._get_txck(po.hash)
+                if txck is None:
+                    raise InvalidTransactionException('missing transaction: %s' % po.hash.encode('hex'))
+
+                uock = keys.get_uock(txck, po.index)
+                if uock in self._cache.spent:
+                    raise InvalidTransactionException('previous output already spent')
+                missing.setdefault(uock, [ ]).append((txn, i))
+
+            for (o, output) in enumerate(txn.outputs):
+                uock = keys.get_uock(txn._txck, o)
+                created[(txn.hash, o)] = (uock, output.value, output.pk_script)
+
+        # look up the remaining outputs in batches
+        uocks = missing.keys()
+        cursor = self._connection.cursor()
+        for offset in xrange(0, len(uocks), 500):
+            batch = uocks[offset:offset + 500]
+            cursor.execute(self.sql_select + ' where uock in (%s)' % ','.join('?' for u in batch), batch)
+            for row in cursor.fetchall():
+                undo.append(tuple(row))
+                (uock, address_hint, value, pk_script, height, coinbase) = row
+                pk_script = decompress_script(pk_script)
+                for (txn, i) in missing.pop(uock):
+                    txn._set_previous_output(i, uock, value, pk_script)
+
+        if missing:
+            raise InvalidTransactionException('previous output already spent')
+
+        return undo
+
+
+    def _update(self, block, results, undo):
 
         # make sure we are adding the next block (haven't skipped any)
-        last_valid_block = self.get_metadata(cursor, KEY_LAST_VALID_BLOCK)
-        if last_valid_block != block._previous_blockid:
+        if self._last_valid_block != block._previous_blockid:
             raise InvalidTransactionException('must add consequetive block')
 
-        for (txn, valid, addresses) in results:
-
-            # invalid transaction
+        # invalid transaction (checked before changing anything)
+        for (txn, valid, pubkeyhashes) in results:
             if not valid:
                 raise InvalidTransactionException('temporary')
-                print "invalid", txn
-                continue
+
+        for (txn, valid, pubkeyhashes) in results:
 
             # remove each input's previous outputs
             for i in xrange(0, len(txn.inputs)):
                 uock = txn._previous_uock(i)
                 if uock is None: continue
 
-                txck = keys.get_uock_txck(uock)
-                #print '-', keys.get_txck_blockid(txck), keys.get_txck_index(txck), keys.get_uock_index(uock), txn.previous_output(i).value
-
-                cursor.execute(self.sql_delete, (uock, ))
-                if cursor.rowcount != 1:
-                    raise Exception('bad state: failed to delete a utxo')
+                po = txn.inputs[i].previous_output
+                self._cache.spend(po.hash, po.index, uock)
 
             # add new outputs (with a hint of the address)
-            for (o, address) in enumerate(addresses):
+            coinbase = (txn.index == 0)
+            for (o, pubkeyhash) in enumerate(pubkeyhashes):
                 uock = keys.get_uock(txn._txck, o)
+                output = txn.outputs[o]
+                address_hint = keys.get_pubkeyhash_hint(pubkeyhash)
+                self._cache.add(txn.hash, o, uock, output.value, output.pk_script, block.height, coinbase, address_hint)
 
-                #print '+', keys.get_txck_blockid(txn._txck), keys.get_txck_index(txn._txck), o, txn.outputs[o].value
+        # keep what was spent, so the block can be rolled back
+        self._undo.append((block._blockid, block.height, buffer(pack_undo(undo))))
 
-                address_hint = keys.get_address_hint(address)
-                try:
-                    cursor.execute(self.sql_insert, (uock, address_hint))
+        # update last valid block
+        self._last_valid_block = block._blockid
 
-                # (duplicates don't matter)
-                except sqlite3.IntegrityError, e:
-                    if e.message != _KEY_DUP:
-                        raise e
 
-        # update last valid block
-        self.set_metadata(cursor, KEY_LAST_VALID_BLOCK, block._blockid)
+    def flush(self):
+        '''Write all cached changes (and the last valid block) to the database
+           in a single transaction.'''
+
+        cursor = self._connection.cursor()
+        cursor.execute('begin immediate transaction')
+        try:
+            self._cache.flush(cursor, self.sql_insert_ignore, self.sql_delete)
+
+            if self._undo:
+                cursor.executemany('insert or replace into undo (blockid, height, data) values (?, ?, ?)', self._undo)
+                height = max(h for (b, h, d) in self._undo)
+                cursor.execute('delete from undo where height <= ?', (height - self.UNDO_DEPTH, ))
+
+            self.set_metadata(cursor, KEY_LAST_VALID_BLOCK, self._last_valid_block)
+        except Exception, e:
+            self._connection.rollback()
+            raise e
 
         self._connection.commit()
+        self._cache.flushed()
+
+        self._undo = [ ]
+        self._unflushed = [ ]
+        self._cache.evict()
+
+
+    def close(self):
+
+        # only write if there is something to write (eg. readers must not
+        # overwrite the last valid block, and may be readonly)
+        if self._undo or self._cache.dirty:
+            self.flush()
+        self._connection.close()
+
+
+    def unspent_outputs(self, address):
+        '''Returns the (uock, value, pk_script) of each unspent output paying to
+           address, ordered by uock, including changes not yet flushed.'''
 
+        return self.unspent_outputs_many([address])[address]
 
 
-    def _list_unspent(self, address):
-        address_hint = keys.get_address_hint(address)
+    def unspent_outputs_many(self, addresses):
+        '''Returns a dict mapping each address to the (uock, value, pk_script)
+           of each unspent output paying to it (see unspent_outputs), looking
+           up the addresses together in batches.
+
+           Only pay-to-pubkey-hash addresses are indexed; any other address
+           version (eg. pay-to-script-hash) raises a ValueError. Invalid
+           addresses have no outputs.'''
+
+        # addresses by hint, then by version and public key hash (each
+        # address is decoded once)
+        hints = dict()
+        for address in set(addresses):
+            bytes = util.base58.decode_check(address)
+            if bytes is None: continue
+            if bytes[0] != self.coin.address_version:
+                raise ValueError('unsupported address: %s (only pay-to-pubkey-hash addresses are indexed)' % address)
+            hints.setdefault(keys.get_pubkeyhash_hint(bytes[1:]), dict())[bytes] = address
+
+        candidates = dict()
         cursor = self._connection.cursor()
-        cursor.execute('select uock from unspent where address_hint = ?', (address_hint, ))
-
-        return [r[0] for r in cursor.fetchall()]
-        #for row in cursor.fetchall():
-        #    uock = row[0]
-        #    txck = keys.get_uock_txck(uock)
-        #    output_index = keys.get_uock_index(uock)
-        #    blockid = keys.get_txck_blockid(txck)
-        #    txn_index = keys.get_txck_index(txck)
-        #    txn = self._txndb._get_transactions(blockid)[txn_index]
-        #    outputs.append(txn.tx_out[output_index])
-
-        #return outputs
+        hint_list = hints.keys()
+        for offset in xrange(0, len(hint_list), 500):
+            batch = hint_list[offset:offset + 500]
+            sql = 'select uock, value, pk_script, address_hint from unspent where address_hint in (%s)'
+            cursor.execute(sql % ','.join('?' for h in batch), batch)
+            for (uock, value, pk_script, address_hint) in cursor.fetchall():
+                if uock in self._cache.spent: continue
+                candidates[uock] = (uock, value, decompress_script(pk_script), address_hint)
+
+        # include the changes not yet flushed
+        for (uock, value, pk_script, address_hint) in self._cache.added(hints):
+            candidates[uock] = (uock, value, pk_script, address_hint)
+
+        # the hint may have false positives; the stored script confirms
+        result = dict((a, [ ]) for a in addresses)
+        for uock in sorted(candidates):
+            (uock, value, pk_script, address_hint) = candidates[uock]
+            pubkeyhash = script.script_pubkeyhash(pk_script)
+            if pubkeyhash is None: continue
+            address = hints[address_hint].get(self.coin.address_version + pubkeyhash)
+            if address is not None:
+                result[address].append((uock, value, pk_script))
+
+        return result
+
+
+    def balance(self, address):
+        'Returns the total value of the unspent outputs paying to address.'
+
+        return self.balances([address])[address]
+
+
+    def balances(self, addresses):
+        'Returns a dict mapping each address to its total unspent value.'
+
+        outputs = self.unspent_outputs_many(addresses)
+        return dict((a, sum(o[1] for o in outputs[a])) for a in outputs)
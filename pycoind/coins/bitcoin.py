@@ -63,6 +63,26 @@ class Bitcoin(coin.Coin):
 
     alert_public_key = '04fc9702847840aaf195de8442ebecedf5b095cdbb9bc716bda9110971b28a49e0ead8564ff0db22209e0374782c093bb899692d524e9d6a6956e7c5ecbcd68284'.decode('hex')
 
+    # Blocks known to be on the mainchain, as (height, block_hash); scripts in
+    # blocks up to the last checkpoint need not be verified (see the
+    # assume_valid option of blockchain.unspent.Database)
+    # See: https://github.com/bitcoin/bitcoin/blob/master/src/chainparams.cpp
+    checkpoints = [
+        (11111, '1d7c6eb2fd42f55925e92efad68b61edd22fba29fde8783df744e26900000000'.decode('hex')),
+        (33333, 'a6d0b5df7d0df069ceb1e736a216ad187a50b07aaa4e78748a58d52d00000000'.decode('hex')),
+        (74000, '201a66b853f9e7814a820e2af5f5dc79c07144e31ce4c9a39339570000000000'.decode('hex')),
+        (105000, '97dc6b1d15fbeef373a744fee0b254b0d2c820a3ae7f0228ce91020000000000'.decode('hex')),
+        (134444, 'feb0d2420d4a18914c81ac30f494a5d4ff34cd15d34cfd2fb105000000000000'.decode('hex')),
+        (168000, '63b703835cb735cb9a89d733cbe66f212f63795e0172ea619e09000000000000'.decode('hex')),
+        (193000, '17138bca83bdc3e6f60f01177c3877a98266de40735f2a459f05000000000000'.decode('hex')),
+        (210000, '2e3471a19b8e22b7f939c63663076603cf692f19837e34958b04000000000000'.decode('hex')),
+        (216116, '4edf231bf170234e6a811460f95c94af9464e41ee833b4f4b401000000000000'.decode('hex')),
+        (225430, '32595730b165f097e7b806a679cf7f3e439040f750433808c101000000000000'.decode('hex')),
+        (250000, '14d2f24d29bed75354f3f88a5fb50022fc064b02291fdf873800000000000000'.decode('hex')),
+        (279000, '407ebde958e44190fa9e810ea1fc3a7ef601c3b0a0728cae0100000000000000'.decode('hex')),
+        (295000, '83a93246c67003105af33ae0b29dd66f689d0f0ff54e9b4d0000000000000000'.decode('hex')),
+    ]
+
     # Not sure if these will be needed later... from chainparams
     secret_key = chr(239)
     ext_public_key = "".join(chr(i) for i in (0x04, 0x35, 0x87, 0xCF))
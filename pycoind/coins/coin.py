@@ -62,6 +62,15 @@ class Coin(object):
 
     checkpoint_public_key = None
 
+    # Blocks known to be on the mainchain, as (height, block_hash) tuples in
+    # ascending height (hashes are little endian, like genesis_block_hash)
+    #
+    # Only Bitcoin lists its checkpoints so far; every other coin has none,
+    # so the assume_valid option of blockchain.unspent.Database has no effect
+    # for them (all scripts are verified) until their lists are added (see
+    # template.py)
+    checkpoints = [ ]
+
     # Callables that can be used to guess the current block height. This data
     # should not be trusted blindly, but is useful for approximating the
     # completeness of a blockchain sync.
@@ -79,5 +79,13 @@ class ___coin(coin.Coin):
     # pycoind.wallet.Address to generate a public/private key pair
     alert_public_key = '___'.decode('hex')
 
+    # Blocks known to be on the mainchain, as (height, block_hash) tuples in
+    # ascending height; scripts up to the last one may be skipped when
+    # building the utxo database
+    # Usually in checkpoints.cpp or chainparams.cpp
+    #checkpoints = [
+    #    (___, '___'.decode('hex')),
+    #]
+
 
     block_height_guess = []
@@ -22,6 +22,7 @@
 
 
 import random
+import struct
 import time
 import sys
 
@@ -30,6 +31,25 @@ from .basenode import BaseNode
 from .. import blockchain
 from .. import coins
 from .. import protocol
+from .. import util
+
+class _RawMessage(object):
+    'A message whose payload is already serialized (eg. a stored block).'
+
+    def __init__(self, command, payload):
+        self.command = command
+        self._payload = payload
+
+    def binary(self, magic):
+        checksum = util.sha256d(self._payload)[:4]
+        command = self.command + (chr(0) * (12 - len(self.command)))
+        return magic + command + struct.pack('<I', len(self._payload)) + checksum + self._payload
+
+    def _debug(self):
+        return '<%s command=%s len(payload)=%d>' % (self.__class__.__name__, self.command, len(self._payload))
+
+    __str__ = _debug
+
 
 class Node(BaseNode):
 
@@ -45,13 +65,37 @@ class Node(BaseNode):
     # maximum number of entries in the memory pool
     MEMORY_POOL_SIZE = 30000
 
-    def __init__(self, data_dir = None, address = None, seek_peers = 16, max_peers = 125, bootstrap = True, log = sys.stdout, coin = coins.Bitcoin):
+    # maximum number of received blocks to hold before writing them to the
+    # database in a single batch (pending blocks are also written each
+    # heartbeat)
+    MAX_PENDING_BLOCKS = 100
+
+    # maximum number of transactions (and seconds) to spend moving
+    # transactions from older database levels into the current level each
+    # heartbeat, so large merges don't stall message handling (see
+    # transaction.Database.compact)
+    MAX_COMPACT_TXNS = 10000
+    MAX_COMPACT_SECONDS = 0.25
+
+    # maximum number of blocks (and seconds) to spend adding blocks to the
+    # unspent database each heartbeat (rolling back blocks orphaned by a
+    # mainchain switch is not limited)
+    MAX_CONNECT_BLOCKS = 100
+    MAX_CONNECT_SECONDS = 0.5
+
+    def __init__(self, data_dir = None, address = None, seek_peers = 16, max_peers = 125, bootstrap = True, log = sys.stdout, coin = coins.Bitcoin, db_profile = None, block_files = False):
         BaseNode.__init__(self, data_dir, address, seek_peers, max_peers, bootstrap, log, coin)
 
         # blockchain database
-        self._blocks = blockchain.block.Database(self.data_dir, self._coin)
+        self._blocks = blockchain.block.Database(self.data_dir, self._coin, db_profile, header_index = True, block_files = block_files)
         self._txns = self._blocks._txns
 
+        # unspent outputs; follows the mainchain (see _update_unspent)
+        self._unspent = blockchain.unspent.Database(self.data_dir, self._coin, profile = db_profile)
+
+        # once the unspent database fails to update, it is no longer followed
+        self._unspent_failed = False
+
         # memory pool; circular buffer of 30,000 most recent seen transactions
         self._mempool_index = 0
         self._mempool = []
@@ -70,6 +114,9 @@ class Node(BaseNode):
         # last time headers were requested from a peer
         self._inflight_headers = dict()
 
+        # (block, txns) tuples received but not yet written to the database
+        self._pending_blocks = []
+
 
     @property
     def blockchain_height(self):
@@ -104,8 +151,13 @@ class Node(BaseNode):
             if not block:
                 raise blockchain.block.InvalidBlockException('block header not found')
 
-            # add the transactions
-            self._txns.add(block, txns)
+            # check the transactions now, so we know which peer to blame
+            block._check_merkle_root(util.get_merkle_root(txns))
+
+            # queue the transactions to be added in the next batch
+            self._pending_blocks.append((block, txns))
+            if len(self._pending_blocks) >= self.MAX_PENDING_BLOCKS:
+                self._flush_pending_blocks()
 
             # update the memory pool
             for txn in txns:
@@ -126,6 +178,37 @@ class Node(BaseNode):
                 self._inflight_blocks[peer] = 0
 
 
+    def _flush_pending_blocks(self):
+        'Write all pending blocks to the database in a single batch.'
+
+        if not self._pending_blocks: return
+
+        pending = self._pending_blocks
+        self._pending_blocks = []
+        self._txns.add_blocks(pending)
+
+
+    def _update_unspent(self):
+        '''Move the unspent database toward the mainchain; blocks orphaned by
+           a mainchain switch are rolled back, then the following mainchain
+           blocks (whose transactions we have) are added, a few at a time.
+
+           Any failure (eg. an invalid block, or a mainchain switch deeper than
+           the undo data) is logged and the unspent database is no longer
+           followed, rather than stopping the node.'''
+
+        if self._unspent_failed: return
+
+        try:
+            self._unspent.connect(self._blocks, self.MAX_CONNECT_BLOCKS, self.MAX_CONNECT_SECONDS)
+        except blockchain.unspent.InvalidTransactionException, e:
+            self._unspent_failed = True
+            self.log('invalid block transactions; no longer updating unspent outputs (%s)' % e.message, level = self.LOG_LEVEL_ERROR)
+        except Exception, e:
+            self._unspent_failed = True
+            self.log('failed to update unspent outputs; no longer updating them (%s)' % e, level = self.LOG_LEVEL_ERROR)
+
+
     def command_get_blocks(self, peer, version, block_locator_hashes, hash_stop):
         blocks = self._blocks.locate_blocks(block_locator_hashes, 500, hash_stop)
 
@@ -147,12 +230,15 @@ class Node(BaseNode):
 
             if iv.type == protocol.OBJECT_TYPE_MSG_BLOCK:
 
-                # search the database
+                # search the database (block files need only a single read)
+                payload = None
                 block = self._blocks.get(iv.hash)
-
-                # if we found one, return it
                 if block:
-                    peer.send_message(protocol.Block(block.block_message()))
+                    payload = self._txns.get_block_binary(block)
+
+                # if we found one, return it (as stored; no need to parse it)
+                if payload:
+                    peer.send_message(_RawMessage(protocol.Block.command, payload))
                 else:
                     notfound.append(iv)
 
@@ -192,17 +278,15 @@ class Node(BaseNode):
 
         # Add the headers to the database (we fill in the transactions later)
         new_headers = False
-        for header in headers:
-            try:
-                added = self._blocks.add_header(header)
-                if added:
-                    new_headers = True
-                else:
+        try:
+            results = self._blocks.add_headers(headers)
+            new_headers = any(results)
+            for (header, added) in zip(headers, results):
+                if not added:
                     self.log('block header already exists: %s' % header.hash.encode('hex'), level = self.LOG_LEVEL_DEBUG)
-            except blockchain.block.InvalidBlockException, e:
-                self.log('invalid block header: %s (%s)' % (header.hash.encode('hex'), e.message), level = self.LOG_LEVEL_DEBUG)
-                self.punish_peer(peer, str(e))
-
+        except blockchain.block.InvalidBlockException, e:
+            self.log('invalid block header (%s)' % e.message, level = self.LOG_LEVEL_DEBUG)
+            self.punish_peer(peer, str(e))
 
         # we got some headers, so we can request the next batch now
         self.sync_blockchain_headers(new_headers = new_headers)
@@ -259,12 +343,21 @@ class Node(BaseNode):
     def heartbeat(self):
         BaseNode.heartbeat(self)
 
+        # write any blocks that have been waiting
+        self._flush_pending_blocks()
+        self._update_unspent()
+
+        # a little at a time, move transactions out of the older levels
+        self._txns.compact(self.MAX_COMPACT_TXNS, self.MAX_COMPACT_SECONDS)
+
         # if we have peers, poke them to sync the blockchain
         if self.peers:
             self.sync_blockchain_headers()
             self.sync_blockchain_blocks()
 
     def close(self):
+        self._flush_pending_blocks()
+        self._unspent.close()
         self._blocks.close()
         BaseNode.close(self)
 
@@ -25,22 +25,27 @@ import struct
 
 from .. import util
 
-def parse_variable_set(data, kind):
-    '''Reads a set of Parsable objects prefixed with a VarInteger.
+_UInt16 = struct.Struct('<H')
+_UInt32 = struct.Struct('<I')
+_UInt64 = struct.Struct('<Q')
 
-       Any object can be used that supports parse(data), which returns
-       a tuple of (bytes_consumed, value).'''
+_IPv4Prefix = (chr(0) * 10) + (chr(255) * 2)
 
-    (offset, count) = FormatTypeVarInteger.parse(data)
+def parse_variable_set(data, kind, offset = 0):
+    '''Reads a set of Parsable objects prefixed with a VarInteger, starting
+       at offset within data.
 
-    result = [ ]
-    index = 0
+       Any object can be used that supports parse_from(data, offset), which
+       returns a tuple of (next_offset, value). The returned tuple is
+       (next_offset, values).'''
+
+    (offset, count) = FormatTypeVarInteger.parse_from(data, offset)
 
-    while index < count:
-        (item_length, item_obj) = kind.parse(data[offset:])
+    parse_from = kind.parse_from
+    result = [ ]
+    for index in xrange(0, count):
+        (offset, item_obj) = parse_from(data, offset)
         result.append(item_obj)
-        index += 1
-        offset += item_length
 
     return (offset, result)
 
@@ -58,8 +63,94 @@ class ParameterException(Exception):
     kind = property(lambda s: s._kind)
 
 
+class _PropertyCodec(object):
+    'Parses and serializes a single property with its FormatType.'
+
+    def __init__(self, key, vt):
+        self._key = key
+        self._vt = vt
+
+    name = property(lambda s: s._key)
+    kind = property(lambda s: s._vt)
+
+    def parse_into(self, kw, data, offset):
+        (offset, kw[self._key]) = self._vt.parse_from(data, offset)
+        return offset
+
+    def binary(self, properties):
+        return self._vt.binary(properties[self._key])
+
+
+class _StructCodec(object):
+    '''Parses and serializes a run of consecutive fixed-width properties with
+       a single precompiled struct.Struct.'''
+
+    def __init__(self, properties, byte_order):
+        self._keys = tuple(k for (k, vt) in properties)
+        self._struct = struct.Struct(byte_order + "".join(vt.struct_format for (k, vt) in properties))
+
+        # numbers which accept floats must be converted before packing
+        self._integral = [i for (i, (k, vt)) in enumerate(properties) if vt.allow_float]
+
+    name = property(lambda s: ",".join(s._keys))
+    kind = property(lambda s: s._struct.format)
+
+    def parse_into(self, kw, data, offset):
+        kw.update(zip(self._keys, self._struct.unpack_from(data, offset)))
+        return offset + self._struct.size
+
+    def binary(self, properties):
+        values = [properties[k] for k in self._keys]
+        for i in self._integral:
+            values[i] = int(values[i])
+        return self._struct.pack(*values)
+
+
+def _compile_codecs(properties):
+    '''Returns a list of codecs for properties, merging each run of adjacent
+       fixed-width properties (with compatible byte orders) into a single
+       _StructCodec.'''
+
+    codecs = [ ]
+
+    run = [ ]
+    run_byte_order = None
+
+    def flush():
+        if len(run) == 1:
+            codecs.append(_PropertyCodec(*run[0]))
+        elif run:
+            codecs.append(_StructCodec(run, run_byte_order or '<'))
+        run[:] = [ ]
+
+    for (key, vt) in properties:
+        struct_format = getattr(vt, 'struct_format', None)
+
+        # not fixed-width; end the current run and use the FormatType
+        if struct_format is None:
+            flush()
+            run_byte_order = None
+            codecs.append(_PropertyCodec(key, vt))
+            continue
+
+        # a struct can only have one byte order, so start a new run
+        byte_order = vt.byte_order
+        if byte_order and run_byte_order and byte_order != run_byte_order:
+            flush()
+            run_byte_order = None
+
+        run.append((key, vt))
+        if byte_order:
+            run_byte_order = byte_order
+
+    flush()
+
+    return codecs
+
+
 # This metaclass will convert all the (name, kind) pairs in properties into
 # class properties and if the base class has a register(cls) method, call it.
+# The properties are also compiled into codecs, used by parse and binary.
 class _AutoPopulateAndRegister(type):
 
     def __init__(cls, name, bases, dct):
@@ -72,6 +163,8 @@ class _AutoPopulateAndRegister(type):
 
         cls._name = name
 
+        cls._codecs = _compile_codecs(cls.properties)
+
         for base in bases:
             if hasattr(base, 'register'):
                 if hasattr(base, 'do_not_register') and not base.do_not_register:
@@ -124,21 +217,26 @@ class CompoundType(object):
 
     def binary(self):
         'Returns the binary representation of the message.'
-        return "".join(vt.binary(self._properties[key]) for (key, vt) in self.properties)
+        properties = self._properties
+        return "".join(c.binary(properties) for c in self._codecs)
 
 
     @classmethod
     def parse(cls, data):
+        '''Returns a (length, value) tuple where length is the amount of
+           data that was consumed.'''
+
+        return cls.parse_from(data, 0)
+
+
+    @classmethod
+    def parse_from(cls, data, offset = 0):
+        '''Parses an object starting at offset within data, without copying
+           the remaining data. Returns a (next_offset, value) tuple.'''
+
         #t0 = time.time()
 
-        kw = dict()
-        offset = 0
-        for (key, vt) in cls.properties:
-            try:
-                (length, kw[key]) = vt.parse(data[offset:])
-                offset += length
-            except Exception, e:
-                raise ParameterException(key, data[offset:], vt)
+        (offset, kw) = cls._parse_properties(data, offset)
 
         #dt = time.time() - t0
         #if cls not in profile: profile[cls] = [0.0, 0]
@@ -158,6 +256,21 @@ class CompoundType(object):
         return (offset, self)
 
 
+    @classmethod
+    def _parse_properties(cls, data, offset):
+        '''Parses each property starting at offset within data and returns a
+           (next_offset, properties) tuple. Internal use.'''
+
+        kw = dict()
+        for codec in cls._codecs:
+            try:
+                offset = codec.parse_into(kw, data, offset)
+            except Exception, e:
+                raise ParameterException(codec.name, data[offset:], codec.kind)
+
+        return (offset, kw)
+
+
     def __str__(self):
         output = [self._name]
         for (key, vt) in self.properties:
@@ -168,6 +281,12 @@ class CompoundType(object):
 
 class FormatType(object):
 
+    # fixed-width types that map directly onto a struct format code should
+    # set these, so CompoundTypes can pack runs of them in a single call
+    struct_format = None
+    byte_order = None
+    allow_float = False
+
     def validate(self, obj):
         '''Returns the object to store if obj is valid for this type, otherwise
            None. The type returned should be immutable.'''
@@ -183,6 +302,13 @@ class FormatType(object):
         '''Returns a (length, value) tuple where length is the amount of
          data that was consumed.'''
 
+        return self.parse_from(data, 0)
+
+    def parse_from(self, data, offset = 0):
+        '''Returns a (next_offset, value) tuple, parsing the value found at
+         offset within data. Sub-classes should not slice away the data
+         preceding offset, so large payloads are parsed in linear time.'''
+
         raise NotImplemented()
 
     def str(self, obj):
@@ -210,6 +336,10 @@ class FormatTypeCompoundType(object):
     def parse(cls, data):
         return cls.expected_type.parse(data)
 
+    @classmethod
+    def parse_from(cls, data, offset = 0):
+        return cls.expected_type.parse_from(data, offset)
+
     @classmethod
     def str(cls, obj):
         return str(obj)
@@ -233,12 +363,12 @@ class FormatTypeOptional(FormatType):
     def binary(self, obj):
         return self._child.binary(obj)
 
-    def parse(self, data):
+    def parse_from(self, data, offset = 0):
         try:
-            return self._child.parse(data)
+            return self._child.parse_from(data, offset)
         except Exception, e:
             pass
-        return (0, self._default)
+        return (offset, self._default)
 
     def __str__(self):
         return '<FormatTypeOptional child=%s default=%s>' % (self._child, self._default)
@@ -267,8 +397,13 @@ class FormatTypeNumber(FormatType):
         if format not in self._ranges:
             raise ValueError('invalid format type: %s' % format)
         self._format = {True: '>', False: '<'}[big_endian] + format
+        self._struct = struct.Struct(self._format)
         self._allow_float = allow_float
 
+    struct_format = property(lambda s: s._format[1:])
+    byte_order = property(lambda s: s._format[0])
+    allow_float = property(lambda s: s._allow_float)
+
     _ranges = dict(
         b = (-128, 128),
         B = (0, 256),
@@ -300,9 +435,8 @@ class FormatTypeNumber(FormatType):
     def binary(self, obj):
         return struct.pack(self._format, int(obj))
 
-    def parse(self, data):
-        length = dict(b = 1, h = 2, i = 4, q = 8)[self._format.lower()[-1]]
-        return (length, struct.unpack(self._format, data[:length])[0])
+    def parse_from(self, data, offset = 0):
+        return (offset + self._struct.size, self._struct.unpack_from(data, offset)[0])
 
     def __str__(self):
         return '<FormatTypeNumber format=%s>' % (self._format, self._expected_type)
@@ -328,14 +462,18 @@ class FormatTypeVarInteger(FormatType):
 
     @staticmethod
     def parse(data):
-        value = ord(data[0])
+        return FormatTypeVarInteger.parse_from(data, 0)
+
+    @staticmethod
+    def parse_from(data, offset = 0):
+        value = ord(data[offset])
         if value == 0xfd:
-            return (3, struct.unpack('<H', data[1:3])[0])
+            return (offset + 3, _UInt16.unpack_from(data, offset + 1)[0])
         elif value == 0xfe:
-            return (5, struct.unpack('<I', data[1:5])[0])
-        elif value == 0xfd:
-            return (9, struct.unpack('<Q', data[1:9])[0])
-        return (1, value)
+            return (offset + 5, _UInt32.unpack_from(data, offset + 1)[0])
+        elif value == 0xff:
+            return (offset + 9, _UInt64.unpack_from(data, offset + 1)[0])
+        return (offset + 1, value)
 
     def str(self, obj):
         return str(obj)
@@ -402,9 +540,13 @@ class FormatTypeIPAddress(FormatType):
 
     @staticmethod
     def parse(data):
-        if data[0:10] == (chr(0) * 10) and data[10:12] == (chr(255) * 2):
-            return (16, '.'.join(str(i) for i in struct.unpack('>BBBB', data[12:16])))
-        return (16, ':'.join(("%x" % i) for i in struct.unpack('>HHHHHHHH', data[:16])))
+        return FormatTypeIPAddress.parse_from(data, 0)
+
+    @staticmethod
+    def parse_from(data, offset = 0):
+        if data[offset:offset + 12] == _IPv4Prefix:
+            return (offset + 16, '.'.join(str(i) for i in struct.unpack_from('>BBBB', data, offset + 12)))
+        return (offset + 16, ':'.join(("%x" % i) for i in struct.unpack_from('>HHHHHHHH', data, offset)))
 
     def binary(self, obj):
 
@@ -428,6 +570,8 @@ class FormatTypeBytes(FormatType):
     def __init__(self, length):
         self._length = length
 
+    struct_format = property(lambda s: '%ds' % s._length)
+
     def validate(self, obj):
         if isinstance(obj, str) and len(obj) == self._length:
             return obj
@@ -436,8 +580,9 @@ class FormatTypeBytes(FormatType):
     def binary(self, obj):
         return obj
 
-    def parse(self, data):
-        return (self._length, data[:self._length])
+    def parse_from(self, data, offset = 0):
+        end = offset + self._length
+        return (end, data[offset:end])
 
     def str(self, obj):
         return '0x' + obj.encode('hex')
@@ -463,9 +608,13 @@ class FormatTypeVarString(FormatType):
 
     @staticmethod
     def parse(data):
-        (vl, length) = FormatTypeVarInteger.parse(data)
-        obj = data[vl:vl + length]
-        return (vl + len(obj), obj)
+        return FormatTypeVarString.parse_from(data, 0)
+
+    @staticmethod
+    def parse_from(data, offset = 0):
+        (offset, length) = FormatTypeVarInteger.parse_from(data, offset)
+        obj = data[offset:offset + length]
+        return (offset + len(obj), obj)
 
     def str(self, obj):
         return repr(obj)
@@ -506,8 +655,8 @@ class FormatTypeArray(FormatType):
         return (FormatTypeVarInteger.binary(len(obj)) +
                 "".join(self._child_type.binary(o) for o in obj))
 
-    def parse(self, data):
-        return parse_variable_set(data, self._child_type)
+    def parse_from(self, data, offset = 0):
+        return parse_variable_set(data, self._child_type, offset)
 
     def str(self, obj):
         return "[%s]" % ", ".join(self._child_type.str(o) for o in obj)
@@ -560,8 +709,19 @@ class FormatTypeNetworkAddressWithoutTimestamp(FormatTypeNetworkAddress):
 
     @classmethod
     def parse(cls, data):
-        (vl, obj) = FormatTypeNetworkAddress.parse((chr(0) * 4) + data)
-        return (vl - 4, obj)
+        return cls.parse_from(data, 0)
+
+    @classmethod
+    def parse_from(cls, data, offset = 0):
+
+        # parse everything following the (omitted) timestamp
+        kw = dict(timestamp = 0)
+        for (key, vt) in NetworkAddress.properties[1:]:
+            (offset, kw[key]) = vt.parse_from(data, offset)
+
+        obj = NetworkAddress.__new__(NetworkAddress)
+        obj._properties = kw
+        return (offset, obj)
 
     def binary(self, obj):
         return FormatTypeNetworkAddress.binary(obj)[4:]
@@ -636,7 +796,40 @@ class FormatTypeTxnOut(FormatTypeCompoundType):
     expected_type = TxnOut
 
 
+def _txn_length(data, offset):
+    '''Returns the offset following the Txn at offset within data, walking
+       over the inputs and outputs without creating any objects.'''
+
+    parse_var_integer = FormatTypeVarInteger.parse_from
+
+    # version
+    offset += 4
+
+    # tx_in (previous_output, signature_script, sequence)
+    (offset, count) = parse_var_integer(data, offset)
+    for i in xrange(0, count):
+        (offset, length) = parse_var_integer(data, offset + 36)
+        offset += length + 4
+
+    # tx_out (value, pk_script)
+    (offset, count) = parse_var_integer(data, offset)
+    for i in xrange(0, count):
+        (offset, length) = parse_var_integer(data, offset + 8)
+        offset += length
+
+    # lock_time
+    offset += 4
+
+    return offset
+
+
 class Txn(CompoundType):
+    '''A transaction.
+
+       A parsed Txn only locates its boundaries and keeps its raw bytes; the
+       inputs and outputs are not parsed until a property is accessed, so
+       large blocks can be stored and hashed without being decoded.'''
+
     properties = [
         ('version', FormatTypeNumber('I')),
         ('tx_in', FormatTypeArray(FormatTypeTxnIn, 1)),
@@ -644,11 +837,41 @@ class Txn(CompoundType):
         ('lock_time', FormatTypeNumber('I')),
     ]
 
+    _binary = None
+    _hash = None
+    _parsed = None
+
+    def _get_properties(self):
+        if self._parsed is None:
+            (vl, self._parsed) = self._parse_properties(self._binary, 0)
+        return self._parsed
+    def _set_properties(self, properties):
+        self._parsed = properties
+    _properties = property(_get_properties, _set_properties)
+
+    @classmethod
+    def parse_from(cls, data, offset = 0):
+        try:
+            end = _txn_length(data, offset)
+            if end > len(data):
+                raise ValueError('not enough data')
+        except Exception, e:
+            raise ParameterException('txn', data[offset:], cls)
+
+        self = cls.__new__(cls)
+        self._binary = data[offset:end]
+        return (end, self)
+
+    def binary(self):
+        if self._binary is None:
+            self._binary = CompoundType.binary(self)
+        return self._binary
+
     @property
     def hash(self):
-        if '__hash' not in self._properties:
-            self._properties['__hash'] = util.sha256d(self.binary())
-        return self._properties['__hash']
+        if self._hash is None:
+            self._hash = util.sha256d(self.binary())
+        return self._hash
 
 
 class FormatTypeTxn(FormatTypeInventoryVector):
@@ -674,6 +897,10 @@ class BlockHeader(CompoundType):
         ('txn_count', FormatTypeVarInteger()),
     ]
 
+    # the original bytes (when parsed) and block hash, once computed
+    _binary = None
+    _hash = None
+
     @staticmethod
     def from_block(block):
         return BlockHeader(block.version, block.previous_hash,
@@ -681,11 +908,22 @@ class BlockHeader(CompoundType):
                            block.bits, block.nonce,
                            len(block.transactions))
 
+    @classmethod
+    def parse_from(cls, data, offset = 0):
+        (end, self) = super(BlockHeader, cls).parse_from(data, offset)
+        self._binary = data[offset:end]
+        return (end, self)
+
+    def binary(self):
+        if self._binary is None:
+            self._binary = CompoundType.binary(self)
+        return self._binary
+
     @property
     def hash(self):
-        if '__hash' not in self._properties:
-            self._properties['__hash'] = util.sha256d(self.binary()[:80])
-        return self._properties['__hash']
+        if self._hash is None:
+            self._hash = util.sha256d(self.binary()[:80])
+        return self._hash
 
 
 class FormatTypeBlockHeader(FormatTypeInventoryVector):
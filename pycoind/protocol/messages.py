@@ -441,7 +441,7 @@ class Alert(Message):
             offset = 0
 
             # extract version, relay_until, expiration, id and cancel
-            (v, r, e, i, c) = struct.unpack('<iqqii', data[offset:offset + 28])
+            (v, r, e, i, c) = struct.unpack_from('<iqqii', data, offset)
             self._data['version'] = v
             self._data['relay_until'] = r
             self._data['expiration'] = e
@@ -450,41 +450,36 @@ class Alert(Message):
             offset += 28
 
             # extract the set of alerts this alert cancels
-            (vl, s) = format.parse_variable_set(data[offset:], format.FormatTypeNumber('i'))
+            (offset, s) = format.parse_variable_set(data, format.FormatTypeNumber('i'), offset)
             self._data['set_cancel'] = s
-            offset += vl
 
             # extract minimum and maximum versions affecte by this alert
-            (minver, maxver) = struct.unpack('<ii', data[offset:offset + 8])
+            (minver, maxver) = struct.unpack_from('<ii', data, offset)
             self._data['min_ver'] = minver
             self._data['max_ver'] = maxver
             offset += 8
 
             # extract the set of sub-versions affected by this alert
-            (vl, s) = format.parse_variable_set(data[offset:], format.FormatTypeVarString())
+            (offset, s) = format.parse_variable_set(data, format.FormatTypeVarString(), offset)
             self._data['set_sub_ver'] = s
-            offset += vl
 
             # extract priority
-            (p, ) = struct.unpack('<i', data[offset:offset + 4])
+            (p, ) = struct.unpack_from('<i', data, offset)
             self._data['priority'] = p
             offset += 4
 
             # extract comment (no need to display)
-            (vl, c) = format.FormatTypeVarString.parse(data[offset:])
+            (offset, c) = format.FormatTypeVarString.parse_from(data, offset)
             self._data['comment'] = c
-            offset += vl
 
             # extract status bar message (should be shown in the UI)
-            (vl, s) = format.FormatTypeVarString.parse(data[offset:])
+            (offset, s) = format.FormatTypeVarString.parse_from(data, offset)
             self._data['status_bar'] = s
-            offset += vl
 
             # just incase *this* is an old version and the new format includes
             # extra stuff, we can still view it
-            (vl, r) = format.FormatTypeVarString.parse(data[offset:])
+            (offset, r) = format.FormatTypeVarString.parse_from(data, offset)
             self._data['reserved'] = r
-            offset += vl
 
         return self._data[name]
 
@@ -24,9 +24,9 @@
 import opcodes
 
 from .bytevector import ByteVector
-from .script import Script, Tokenizer
+from .script import Script, Tokenizer, script_address, script_pubkeyhash
 
 from .script import TEMPLATE_PAY_TO_PUBKEY, TEMPLATE_PAY_TO_PUBKEY_HASH
-__all__ = ['ByteVector', 'opcodes', 'Script', 'Tokenizer']
+__all__ = ['ByteVector', 'opcodes', 'Script', 'Tokenizer', 'script_address', 'script_pubkeyhash']
 
 
@@ -21,6 +21,7 @@
 # THE SOFTWARE.
 
 
+import collections
 import inspect
 import struct
 
@@ -34,7 +35,7 @@ from .. import util
 
 from ..protocol import format
 
-__all__ = ['Script', 'Tokenizer']
+__all__ = ['Script', 'Tokenizer', 'script_address', 'script_pubkeyhash']
 
 # Convenient constants
 Zero = ByteVector.from_value(0)
@@ -180,7 +181,9 @@ def _hash_op(stack, func):
     return True
 
 
-def check_signature(signature, public_key, hash_type, subscript, transaction, input_index):
+def signature_hash(signature, hash_type, subscript, transaction, input_index):
+    '''Returns the (digest, signature) a signature must be verified against,
+       with the hash type removed from the signature.'''
 
     # figure out the hash_type and adjust the signature
     if hash_type == 0:
@@ -265,12 +268,67 @@ def check_signature(signature, public_key, hash_type, subscript, transaction, in
     sig_hash = struct.pack('<I', hash_type)
     payload = tx_copy.binary() + sig_hash
 
+    return (util.sha256d(payload), signature)
+
+
+def check_signature(signature, public_key, hash_type, subscript, transaction, input_index):
+    (digest, signature) = signature_hash(signature, hash_type, subscript, transaction, input_index)
+
     # verify the data
     #print "PK", public_key.encode('hex')
     #print "S", signature.encode('hex'), input_index
     #print "T", transaction
     #print "I", input_index
-    return util.ecc.verify(payload, public_key, signature)
+    return util.ecc.verify_digest(digest, public_key, signature)
+
+
+# most recently used public keys' hash160 (many outputs pay the same key)
+_PUBLICKEY_HASH_CACHE_SIZE = 8192
+_publickey_hashes = collections.OrderedDict()
+
+def _publickey_hash(publickey):
+    pubkeyhash = _publickey_hashes.pop(publickey, None)
+    if pubkeyhash is None:
+        pubkeyhash = util.hash160(publickey)
+        if len(_publickey_hashes) >= _PUBLICKEY_HASH_CACHE_SIZE:
+            _publickey_hashes.popitem(last = False)
+    _publickey_hashes[publickey] = pubkeyhash
+    return pubkeyhash
+
+def script_pubkeyhash(pk_script):
+    '''Return the public key hash (hash160) a standard pk_script pays to, or
+       None if not a standard script.'''
+
+    # the canonical forms are matched directly, without tokenizing
+    length = len(pk_script)
+    if length == 25 and pk_script[:3] == '\x76\xa9\x14' and pk_script[23:] == '\x88\xac':
+        return pk_script[3:23]
+    if length == 67 and pk_script[:2] == '\x41\x04' and pk_script[66] == '\xac':
+        return _publickey_hash(pk_script[1:66])
+
+    # otherwise (eg. non-canonical pushes), match the templates; malformed
+    # scripts (eg. truncated pushes) exist on chain, and are non-standard
+    try:
+        tokens = Tokenizer(pk_script)
+    except Exception, e:
+        return None
+
+    if tokens.match_template(TEMPLATE_PAY_TO_PUBKEY_HASH):
+        return tokens.get_value(2).vector
+
+    if tokens.match_template(TEMPLATE_PAY_TO_PUBKEY):
+        return _publickey_hash(tokens.get_value(0).vector)
+
+    return None
+
+def script_address(pk_script, coin = coins.Bitcoin):
+    'Return the address a pk_script pays to, or None if not a standard script.'
+
+    pubkeyhash = script_pubkeyhash(pk_script)
+    if pubkeyhash is None:
+        return None
+
+    return util.key.pubkeyhash_to_address(pubkeyhash, coin.address_version)
 
 
 # identical to protocol.Txn except it allows zero tx_out for SIGHASH_NONE
@@ -438,17 +496,11 @@ class Script(object):
 
     def output_address(self, output_index):
         pk_script = self._transaction.outputs[output_index].pk_script
-        tokens = Tokenizer(pk_script)
+        return script_address(pk_script, self._coin)
 
-        if tokens.match_template(TEMPLATE_PAY_TO_PUBKEY_HASH):
-            pubkeyhash = tokens.get_value(2).vector
-            return util.key.pubkeyhash_to_address(pubkeyhash, self._coin.address_version)
-
-        if tokens.match_template(TEMPLATE_PAY_TO_PUBKEY):
-            pubkey = tokens.get_value(0).vector
-            return util.key.publickey_to_address(pubkey, self._coin.address_version)
-
-        return None
+    def output_pubkeyhash(self, output_index):
+        pk_script = self._transaction.outputs[output_index].pk_script
+        return script_pubkeyhash(pk_script)
 
     #def previous_output(self, index):
     #    po = self._transaction.tx_in[index].previous_output
@@ -478,6 +530,56 @@ class Script(object):
         input = self._transaction.inputs[input_index]
         return self.process(input.signature_script, pk_script, self._transaction, input_index)
 
+    def signature_check(self, input_index, pk_script):
+        '''Returns the (digest, public_key, signature) of the only signature
+           check deciding whether an input is valid against a standard (pay-to-
+           pubkey-hash or pay-to-pubkey) pk_script; see util.ecc.verify_digest.
+
+           Returns None if the input's scripts must be processed in full (see
+           verify_input), such as for non-standard scripts.'''
+
+        signature_script = self._transaction.inputs[input_index].signature_script
+        try:
+            tokens = Tokenizer(signature_script)
+        except Exception, e:
+            return None
+
+        # the signature script may only push data
+        for opcode in tokens:
+            if opcode != Tokenizer.OP_LITERAL: return None
+
+        try:
+            pk_tokens = Tokenizer(pk_script)
+        except Exception, e:
+            return None
+
+        # <signature> <public_key> | OP_DUP OP_HASH160 <hash160> OP_EQUALVERIFY OP_CHECKSIG
+        if pk_tokens.match_template(TEMPLATE_PAY_TO_PUBKEY_HASH):
+            if len(tokens) != 2: return None
+            public_key = tokens.get_value(1).vector
+            if util.hash160(public_key) != pk_tokens.get_value(2).vector:
+                return None
+
+        # <signature> | <public_key> OP_CHECKSIG
+        elif pk_tokens.match_template(TEMPLATE_PAY_TO_PUBKEY):
+            if len(tokens) != 1: return None
+            public_key = pk_tokens.get_value(0).vector
+
+        else:
+            return None
+
+        signature = tokens.get_value(0).vector
+        if not signature:
+            return None
+
+        # the templates have no code separators, so the subscript is pk_script
+        try:
+            (digest, signature) = signature_hash(signature, 0, pk_tokens.get_subscript(), self._transaction, input_index)
+        except Exception, e:
+            return None
+
+        return (digest, public_key, signature)
+
     def verify(self):
         '''Return True if all transaction inputs can be verified against their
            previous output.'''
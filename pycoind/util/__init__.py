@@ -83,15 +83,22 @@ def verify_target(coin, block_header):
     pow = coin.proof_of_work(binary_header)[::-1]
     return pow <= get_target(block_header.bits)
 
+def _get_target_value(bits):
+    return ((bits & 0x7fffff) * 2 ** (8 * ((bits >> 24) - 3)))
+
 def get_target(bits):
-    target = ((bits & 0x7fffff) * 2 ** (8 * ((bits >> 24) - 3)))
-    return ("%064x" % target).decode('hex')
+    return ("%064x" % _get_target_value(bits)).decode('hex')
 
 
 DifficultyOneTarget = 26959535291011309493156476344723991336010898738574164086137773096960.0
 def get_difficulty(bits):
     return DifficultyOneTarget / ((bits & 0x7fffff) * 2 ** (8 * ((bits >> 24) - 3)))
 
+def get_work(bits):
+    'Returns the expected number of hashes to find a block with bits.'
+
+    return (1 << 256) // (_get_target_value(bits) + 1)
+
 # https://en.bitcoin.it/wiki/Protocol_specification#Merkle_Trees
 def get_merkle_root(transactions):
     branches = [t.hash for t in transactions]
@@ -32,7 +32,7 @@ from .hash import sha256d
 
 from .key import decompress_public_key, privkey_from_wif
 
-__all__ = ['sign', 'verify']
+__all__ = ['sign', 'verify', 'verify_digest']
 
 # http://stackoverflow.com/questions/1604464/twos-complement-in-python
 def twos_comp(val, bits):
@@ -79,6 +79,12 @@ def sign(data, private_key):
 
 
 def verify(data, public_key, signature):
+    return verify_digest(sha256d(data), public_key, signature)
+
+
+def verify_digest(digest, public_key, signature):
+    'Verify a signature against the sha256d digest of its data.'
+
     try:
         public_key = decompress_public_key(public_key)
     except ValueError:
@@ -86,7 +92,7 @@ def verify(data, public_key, signature):
 
     key = ecdsa.VerifyingKey.from_string(public_key[1:], ecdsa.SECP256k1)
     try:
-        return key.verify_digest(signature, sha256d(data), sigdecode = sigdecode_der)
+        return key.verify_digest(signature, digest, sigdecode = sigdecode_der)
     except ecdsa.BadSignatureError, e:
         return False
 
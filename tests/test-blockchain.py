@@ -5,6 +5,16 @@ import unittest
 
 import pycoind
 
+class FakeBlock(object):
+    'Just enough of a block for the unspent database to add or rollback.'
+
+    _database = None
+
+    def __init__(self, blockid, previous_blockid, height):
+        self._blockid = blockid
+        self._previous_blockid = previous_blockid
+        self.height = height
+
 class TestBlockchain(unittest.TestCase):
 
     # Block whose hash does not meet the required target
@@ -141,20 +151,17 @@ class TestBlockchain(unittest.TestCase):
         return header
 
 
-    def run_on_new_database(self, func):
+    def run_in_new_data_dir(self, func):
         import shutil
         import tempfile
 
-        # get temp directory for storing a database
+        # get temp directory for storing databases
         data_dir = tempfile.mkdtemp('-test-fork')
         #print "Using temporary directory %s..." % data_dir
 
         try:
-            # create new database
-            database = pycoind.blockchain.block.Database(data_dir)
-
             # run the function
-            func(database)
+            func(data_dir)
 
         finally:
             # remove the temp directory
@@ -162,6 +169,15 @@ class TestBlockchain(unittest.TestCase):
             shutil.rmtree(data_dir)
 
 
+    def run_on_new_database(self, func, **kwargs):
+        def run(data_dir):
+            # create new database
+            database = pycoind.blockchain.block.Database(data_dir, **kwargs)
+            func(database)
+
+        self.run_in_new_data_dir(run)
+
+
     def do_header_test(self, chain, top_block, chain_height, message = ''):
 
         # make all that binary data into nice block headers
@@ -178,6 +194,15 @@ class TestBlockchain(unittest.TestCase):
                 result = database.add_header(header)
                 self.assertTrue(result, 'a block header failed to get added to the blockchain (%s)' % message)
 
+            check(database)
+
+        def test_batch(database):
+            results = database.add_headers(headers[1:])
+            self.assertTrue(all(results), 'a block header failed to get added to the blockchain (%s)' % message)
+            check(database)
+
+        def check(database):
+
             # build a map that maps each block hash to whether it is mainchain or not
             cursor = database._cursor()
             cursor.execute('select hash, mainchain from blocks where height >= 0')
@@ -206,7 +231,19 @@ class TestBlockchain(unittest.TestCase):
             # check that the chain was the correct height
             self.assertTrue(height == chain_height, 'the chain height was incorrect [expected %d, got %d] (%s)' % (chain_height, height, message))
 
+            # the header index (if any) must agree with the database
+            self.assertEqual(len(database), chain_height)
+            self.assertEqual(database[-1].hash, top_header.hash)
+            self.assertEqual(database.block_locator_hashes()[0], top_header.hash)
+            if database._index:
+                reloaded = pycoind.blockchain.block.HeaderIndex(database._cursor())
+                self.assertEqual(reloaded._mainchain_ids, database._index._mainchain_ids)
+                self.assertEqual(reloaded._mainchain, database._index._mainchain)
+
         self.run_on_new_database(test)
+        self.run_on_new_database(test, header_index = True)
+        self.run_on_new_database(test_batch)
+        self.run_on_new_database(test_batch, header_index = True)
 
 
     def test_duplicate(self):
@@ -219,6 +256,58 @@ class TestBlockchain(unittest.TestCase):
         self.run_on_new_database(test)
 
 
+    def test_add_headers(self):
+        def test(database):
+            headers = [self.get_header(b) for b in (self.block_1, self.block_2, self.block_1, self.block_2_aa, self.block_3)]
+
+            # the headers before an invalid one are still added
+            try:
+                database.add_headers(headers)
+                self.fail('A block header with no parent was added')
+            except pycoind.blockchain.block.InvalidBlockException, e:
+                self.assertEqual(e.message, 'previous block does not exist')
+            self.assertEqual(database[-1].hash, headers[1].hash)
+
+            results = database.add_headers([headers[1], self.get_header(self.block_3)])
+            self.assertEqual(results, [False, True])
+            self.assertEqual(len(database), 4)
+
+            # anything unexpected adds nothing, and leaves the database unlocked
+            self.assertRaises(AttributeError, database.add_headers, [self.get_header(self.block_4), None])
+            self.assertEqual(len(database), 4)
+            self.assertEqual(database.add_headers([self.get_header(self.block_4)]), [True])
+
+        self.run_on_new_database(test)
+        self.run_on_new_database(test, header_index = True)
+
+
+    def test_ancestors(self):
+        def test(database):
+            chain = [self.block_1, self.block_2, self.block_3, self.block_4, self.block_5, self.block_6, self.block_7, self.block_8, self.block_9]
+            database.add_headers([self.get_header(b) for b in chain])
+            database.add_headers([self.get_header(b) for b in (self.block_1_a, self.block_2_aa, self.block_3_aaa)])
+
+            top = database[-1]
+            for height in xrange(0, 10):
+                self.assertEqual(top.get_ancestor(height).hash, database[height].hash)
+            self.assertEqual(top.get_ancestor(10), None)
+
+            # a sidechain block forks from the mainchain at its parent
+            orphan = database._header(block_hash = self.get_header(self.block_3_aaa).hash)
+            self.assertEqual(database._fork_point(orphan)[2], 0)
+
+            # peers on a sidechain continue from the fork
+            blocks = database.locate_blocks([self.get_header(self.block_2_aa).hash], 3)
+            self.assertEqual([b.height for b in blocks], [1, 2, 3])
+
+            locator = database.block_locator_hashes()
+            self.assertEqual(locator[0], top.hash)
+            self.assertEqual(locator[-1], database[0].hash)
+
+        self.run_on_new_database(test)
+        self.run_on_new_database(test, header_index = True)
+
+
     def test_invalid_target(self):
         def test(database):
             try:
@@ -241,6 +330,819 @@ class TestBlockchain(unittest.TestCase):
         self.run_on_new_database(test)
 
 
+    # Genesis block transactions (excluding the 81 byte header)
+    block_0_txns = '0101000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000'
+
+    def get_transactions(self, txns):
+        (l, txns) = pycoind.protocol.format.parse_variable_set(txns.decode('hex'), pycoind.protocol.format.FormatTypeTxn)
+        return txns
+
+
+    def test_transactions(self):
+        def test(database):
+            txns = self.get_transactions(self.block_0_txns)
+            txid = txns[0].hash
+
+            block = database[0]
+            database._txns.add(block, txns)
+            self.assertEqual(database[0].txn_count, 1)
+
+            # look up by txid
+            txn = database._txns.get(txid)
+            self.assertTrue(txn is not None, 'transaction not found')
+            self.assertEqual(txn.hash, txid)
+            self.assertEqual(txn.txn_binary, txns[0].binary())
+            self.assertEqual(txn.outputs[0].value, 5000000000)
+            self.assertEqual(database._txns.get(chr(0) * 32), None)
+
+            # look up txids by txck, without the transactions
+            self.assertEqual(database._txns._get_txid(txn._txck), txid)
+            self.assertEqual(database._txns._get_txids([txn._txck, txn._txck + 1]), {txn._txck: txid})
+
+            # and txcks by txid, from the index alone
+            self.assertEqual(database._txns._get_txck(txid), txn._txck)
+            for connection in database._txns._connections.values():
+                plan = connection.execute('explain query plan select txck from txns where txid_hint = ? and txid = ?', (0, buffer(txid))).fetchall()
+                self.assertTrue('COVERING INDEX index_txid ' in plan[0][-1], plan[0][-1])
+
+            # empty partitions (here, all but one) are not searched by block
+            blockid = txn._blockid
+            self.assertEqual(len(database._txns._locate(blockid)), 1)
+            self.assertEqual(len(database._txns._locate(blockid + 1)), 0)
+            reopened = pycoind.blockchain.transaction.Database(database.data_dir)
+            self.assertEqual(reopened._ranges, database._txns._ranges)
+
+            # the txid is in exactly one bloom filter, and survives a rebuild
+            blooms = [b for b in database._txns._blooms.values() if txid in b]
+            self.assertEqual(len(blooms), 1)
+
+            # each filter is sized for a full file (about 1% false positives)
+            txdb = database._txns
+            self.assertEqual(blooms[0].bit_count, txdb.TARGET_COUNT * txdb.BLOOM_BITS_PER_TXID)
+            self.assertTrue(txdb.TARGET_COUNT * 256 >= txdb.TARGET_SIZE)
+
+            reopened.rebuild_bloom_filters()
+            blooms = [b for b in reopened._blooms.values() if txid in b]
+            self.assertEqual(len(blooms), 1)
+            self.assertEqual(blooms[0].count, 1)
+
+            # look up by block
+            txns = database[0].transactions
+            self.assertEqual([t.hash for t in txns], [txid])
+
+            # re-adding in a batch is harmless (duplicates are ignored)
+            blocks = database._txns.add_blocks([(database[0], self.get_transactions(self.block_0_txns))])
+            self.assertEqual(blocks[0].txn_count, 1)
+            self.assertEqual([t.hash for t in database[0].transactions], [txid])
+
+        self.run_on_new_database(test)
+
+
+    def test_compact(self):
+        def test(database):
+            import os
+
+            txns = self.get_transactions(self.block_0_txns)
+            txid = txns[0].hash
+            database._txns.add(database[0], txns)
+
+            # grow a new level (as check_size would)
+            txdb = database._txns
+            txdb._N *= 2
+            txdb.get_connection(txdb._N, 0, True)
+            self.assertEqual(txdb._levels(), [8, 4])
+
+            # another process, reading the old level
+            reader = pycoind.blockchain.transaction.Database(database.data_dir, profile = 'readonly')
+            self.assertEqual(reader.get(txid).hash, txid)
+            old = txdb.get_filename(txdb.get_suffix(4, 0))
+
+            # out of time after the first batch; the level is not yet retired
+            self.assertEqual(txdb.compact(duration = 0), 1)
+            self.assertEqual(txdb._levels(), [8, 4])
+
+            self.assertEqual(txdb.compact(), 0)
+            self.assertEqual(txdb._levels(), [8])
+            self.assertFalse(os.path.isfile(old))
+
+            # the reader's sqlite files are left alone until it notices
+            self.assertTrue(os.path.isfile(old + '-wal'))
+            self.assertEqual(reader.get(txid).hash, txid)
+            self.assertTrue(reader._load_levels())
+            self.assertEqual(reader._levels(), [8])
+
+            # still found, by txid and by block, and from a new process
+            self.assertEqual(txdb.get(txid).hash, txid)
+            self.assertEqual([t.hash for t in database[0].transactions], [txid])
+            reopened = pycoind.blockchain.transaction.Database(database.data_dir)
+            self.assertEqual(reopened._levels(), [8])
+            self.assertEqual(reopened.get(txid).hash, txid)
+
+            # a later pass removes what sqlite left behind
+            self.assertEqual(txdb.compact(), 0)
+            self.assertFalse(os.path.isfile(old + '-wal'))
+            self.assertFalse(os.path.isfile(old + '-shm'))
+
+        self.run_on_new_database(test, profile = 'steady')
+
+
+    def test_block_files(self):
+        def test(database):
+            import os
+
+            txns = self.get_transactions(self.block_0_txns)
+            txid = txns[0].hash
+
+            txdb = database._txns
+            self.assertTrue(isinstance(txdb, pycoind.blockchain.blockfile.Database))
+
+            database._txns.add(database[0], txns)
+            self.assertEqual(database[0].txn_count, 1)
+
+            # the stored block is the genesis block message's payload
+            payload = txdb.get_block_binary(database[0])
+            self.assertEqual(payload[81:], self.block_0_txns.decode('hex')[1:])
+            self.assertEqual(pycoind.util.sha256d(payload[:80]), database[0].hash)
+
+            # look up by txid, by txck and by block
+            txn = txdb.get(txid)
+            self.assertEqual(txn.txn_binary, txns[0].binary())
+            self.assertEqual(txn.outputs[0].value, 5000000000)
+            self.assertEqual(txdb.get(chr(0) * 32), None)
+            self.assertEqual(txdb._get(txn._txck).hash, txid)
+            self.assertEqual(txdb._get_txck(txid), txn._txck)
+            self.assertEqual(txdb._get_txids([txn._txck, txn._txck + 1]), {txn._txck: txid})
+            self.assertEqual([t.hash for t in database[0].transactions], [txid])
+
+            # re-adding is harmless; the block is stored once
+            filename = txdb.get_block_filename(0)
+            size = os.path.getsize(filename)
+            txdb.add_blocks([(database[0], self.get_transactions(self.block_0_txns))])
+            self.assertEqual(os.path.getsize(filename), size)
+
+            # bytes (and files) never indexed (eg. a crash) are dropped by
+            # the next writer
+            with open(filename, 'ab') as f:
+                f.write('garbage')
+            with open(txdb.get_block_filename(1), 'wb') as f:
+                f.write('garbage')
+            reopened = pycoind.blockchain.block.Database(database.data_dir)
+            self.assertTrue(isinstance(reopened._txns, pycoind.blockchain.blockfile.Database))
+            self.assertEqual(reopened._txns.get(txid).hash, txid)
+            reopened._txns.add(reopened[0], self.get_transactions(self.block_0_txns))
+            self.assertEqual(os.path.getsize(filename), size)
+            self.assertFalse(os.path.isfile(txdb.get_block_filename(1)))
+
+            # a new file is begun once full, also dropping anything never indexed
+            txdb = reopened._txns
+            with open(txdb.get_block_filename(1), 'wb') as f:
+                f.write('garbage')
+            txdb._connection.execute('delete from blocks')
+            txdb._connection.execute('delete from txindex')
+            txdb._connection.commit()
+            txdb.MAX_FILE_SIZE = size
+            txdb.add(reopened[0], self.get_transactions(self.block_0_txns))
+            self.assertEqual(tuple(txdb._locate(reopened[0]._blockid))[:2], (1, 8))
+            self.assertEqual(os.path.getsize(txdb.get_block_filename(1)), size)
+            self.assertEqual(txdb.get(txid).hash, txid)
+
+        self.run_on_new_database(test, block_files = True)
+
+        # a data directory with sqlite transactions cannot switch to block files
+        def test(database):
+            database._txns.add(database[0], self.get_transactions(self.block_0_txns))
+            self.assertRaises(pycoind.blockchain.database.DatabaseException, pycoind.blockchain.block.Database, database.data_dir, block_files = True)
+
+        self.run_on_new_database(test)
+
+        # but a new (or empty) one can
+        def test(database):
+            blocks = pycoind.blockchain.block.Database(database.data_dir, block_files = True)
+            self.assertTrue(isinstance(blocks._txns, pycoind.blockchain.blockfile.Database))
+
+        self.run_on_new_database(test)
+
+
+    def test_migrate(self):
+        def test(database):
+            txns = self.get_transactions(self.block_0_txns)
+            txid = txns[0].hash
+            database._txns.add(database[0], txns)
+
+            # rewrite every file as a version 1 database (no txid column)
+            for connection in database._txns._connections.values():
+                connection.executescript('''
+                    create table txns_v1 as select txck, txid_hint, txn from txns;
+                    drop table txns;
+                    alter table txns_v1 rename to txns;
+                    update metadata set value = 1 where key = %d;
+                ''' % pycoind.blockchain.database.KEY_VERSION)
+
+            # obsolete databases refuse to open unless migrating
+            self.assertRaises(pycoind.blockchain.database.DatabaseException, pycoind.blockchain.transaction.Database, database.data_dir)
+
+            migrated = pycoind.blockchain.transaction.Database(database.data_dir, migrate = True)
+            txn = migrated.get(txid)
+            self.assertTrue(txn is not None, 'transaction not found')
+            self.assertEqual(str(txn._data['txid']), txid)
+
+            reopened = pycoind.blockchain.transaction.Database(database.data_dir)
+            self.assertEqual(reopened.get(txid).txn_binary, txns[0].binary())
+
+            # the hint and txid are indexed together
+            for connection in reopened._connections.values():
+                plan = connection.execute('explain query plan select txck from txns where txid_hint = ? and txid = ?', (0, buffer(txid))).fetchall()
+                self.assertTrue('INDEX index_txid ' in plan[0][-1], plan[0][-1])
+
+            # rewrite the blocks as a version 1 database (no chainwork column)
+            self.assertTrue(database.add_header(self.get_header(self.block_1)))
+            chainwork = database[1].chainwork
+            database._connection.executescript('''
+                drop index index_chainwork;
+                alter table blocks drop column chainwork;
+                alter table blocks drop column skip_id;
+                update metadata set value = 1 where key = %d;
+            ''' % pycoind.blockchain.database.KEY_VERSION)
+
+            self.assertRaises(pycoind.blockchain.database.DatabaseException, pycoind.blockchain.block.Database, database.data_dir)
+
+            migrated = pycoind.blockchain.block.Database(database.data_dir, migrate = True, header_index = True)
+            self.assertEqual(migrated[1].chainwork, chainwork)
+            self.assertEqual(migrated._top_header()[4], chainwork)
+            self.assertEqual(migrated._top_header()[5], migrated[0]._blockid)
+
+        self.run_on_new_database(test)
+
+
+    def test_migrate_unspent(self):
+        keys = pycoind.blockchain.keys
+        unspent = pycoind.blockchain.unspent
+        KEY_VERSION = pycoind.blockchain.database.KEY_VERSION
+
+        def test(database):
+            txns = self.get_transactions(self.block_0_txns)
+            database._txns.add(database[0], txns)
+            uock = keys.get_uock(database._txns._get_txck(txns[0].hash), 0)
+
+            # a version 1 unspent database (only the uock and address hint)
+            outputs = unspent.Database(database.data_dir, processes = 1)
+            outputs._connection.executescript('''
+                drop table undo;
+                create table unspent_v1 as select uock, address_hint from unspent;
+                drop table unspent;
+                alter table unspent_v1 rename to unspent;
+                insert into unspent (uock, address_hint) values (%d, 0);
+                update metadata set value = 1 where key = %d;
+            ''' % (uock, KEY_VERSION))
+            outputs.close()
+
+            # with version 1 block and transaction databases
+            database._connection.executescript('''
+                drop index index_chainwork;
+                alter table blocks drop column chainwork;
+                alter table blocks drop column skip_id;
+                update metadata set value = 1 where key = %d;
+            ''' % KEY_VERSION)
+            for connection in database._txns._connections.values():
+                connection.executescript('''
+                    create table txns_v1 as select txck, txid_hint, txn from txns;
+                    drop table txns;
+                    alter table txns_v1 rename to txns;
+                    update metadata set value = 1 where key = %d;
+                ''' % KEY_VERSION)
+
+            self.assertRaises(pycoind.blockchain.database.DatabaseException, unspent.Database, database.data_dir, processes = 1)
+
+            # migrating the unspent database migrates what it reads from
+            migrated = unspent.Database(database.data_dir, processes = 1, migrate = True)
+            cursor = migrated._connection.cursor()
+            cursor.execute('select value, height, coinbase from unspent where uock = ?', (uock, ))
+            self.assertEqual(tuple(cursor.fetchone()), (5000000000, 0, 1))
+            migrated.close()
+
+            blocks = pycoind.blockchain.block.Database(database.data_dir)
+            self.assertEqual([t.hash for t in blocks[0].transactions], [txns[0].hash])
+
+        self.run_on_new_database(test)
+
+
+    def test_chainwork(self):
+        def test(database):
+            work = pycoind.util.get_work(self.get_header(self.block_1).bits)
+            self.assertEqual(work, 0x100010001)
+            self.assertEqual(database[0].chainwork, work)
+
+            database.add_headers([self.get_header(b) for b in (self.block_1, self.block_2, self.block_1_a)])
+            self.assertEqual(database[-1].chainwork, 3 * work)
+            self.assertEqual(database.get(self.get_header(self.block_1_a).hash, orphans = True).chainwork, 2 * work)
+
+        self.run_on_new_database(test)
+        self.run_on_new_database(test, header_index = True)
+
+
+    def test_chainwork_fork(self):
+        BlockHeader = pycoind.protocol.BlockHeader
+
+        # difficulty 1, and about twice that
+        easy = 0x1d00ffff
+        hard = 0x1c7fff00
+
+        def header(previous, bits, nonce):
+            return BlockHeader(1, previous.hash, chr(nonce) * 32, 1231006505 + nonce, bits, nonce, 0)
+
+        def test(database):
+            genesis = database[0]
+            work = pycoind.util.get_work
+
+            # the old chain is longer, but the fork has more work (until the
+            # old chain has five blocks)
+            old = [ ]
+            previous = genesis
+            for nonce in xrange(1, 6):
+                old.append(header(previous, easy, nonce))
+                previous = old[-1]
+            fork = [header(genesis, hard, 11)]
+            fork.append(header(fork[0], hard, 12))
+
+            self.assertTrue(work(easy) * 4 < work(hard) * 2 < work(easy) * 5)
+
+            def mainchain(database):
+                return [database[h].hash for h in xrange(1, database[-1].height + 1)]
+
+            self.assertEqual(database.add_headers(old[:3]), [True] * 3)
+            self.assertEqual(mainchain(database), [h.hash for h in old[:3]])
+
+            # the shorter fork, with more work, becomes the mainchain
+            self.assertEqual(database.add_headers(fork), [True] * 2)
+            self.assertEqual(mainchain(database), [h.hash for h in fork])
+            self.assertEqual(database[-1].chainwork, work(easy) + 2 * work(hard))
+            self.assertEqual(database.get(old[2].hash), None)
+
+            # extending the old chain, with less work, leaves it a side branch
+            self.assertEqual(database.add_headers([old[3]]), [True])
+            self.assertEqual(mainchain(database), [h.hash for h in fork])
+            orphan = database.get(old[3].hash, orphans = True)
+            self.assertEqual((orphan.height, orphan.mainchain), (4, False))
+
+            # the same, once the header index is rebuilt from the database
+            reloaded = pycoind.blockchain.block.Database(database.data_dir, header_index = True)
+            self.assertEqual(mainchain(reloaded), [h.hash for h in fork])
+            self.assertEqual(reloaded.get(old[3].hash), None)
+            self.assertEqual(reloaded._top_header()[4], work(easy) + 2 * work(hard))
+
+            # until it has more work
+            self.assertEqual(reloaded.add_headers([old[4]]), [True])
+            self.assertEqual(mainchain(reloaded), [h.hash for h in old])
+            self.assertEqual(reloaded.get(fork[0].hash), None)
+
+        # only the chainwork matters here, not the proof-of-work
+        verify_target = pycoind.util.verify_target
+        pycoind.util.verify_target = lambda coin, header: True
+        try:
+            self.run_on_new_database(test)
+            self.run_on_new_database(test, header_index = True)
+        finally:
+            pycoind.util.verify_target = verify_target
+
+
+    def test_unspent_cache(self):
+        address = '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'
+        address_hint = pycoind.blockchain.keys.get_address_hint(address)
+        pubkeyhash = '62e907b15cbf27d5425399ebf6f0fb50ebb88f18'.decode('hex')
+        pk_script = '\x76\xa9\x14' + pubkeyhash + '\x88\xac'
+
+        # hints from the public key hash need no base58
+        self.assertEqual(pycoind.blockchain.keys.get_pubkeyhash_hint(pubkeyhash), address_hint)
+        self.assertEqual(pycoind.blockchain.keys.get_pubkeyhash_hint(None), pycoind.blockchain.keys.get_address_hint(None))
+
+        def test(data_dir):
+            database = pycoind.blockchain.unspent.Database(data_dir, processes = 1)
+
+            def list_unspent():
+                return [o[0] for o in database.unspent_outputs(address)]
+
+            cache = database._cache
+
+            uocks = [pycoind.blockchain.keys.get_uock(pycoind.blockchain.keys.get_txck(2, 0), i) for i in xrange(0, 3)]
+            for (i, uock) in enumerate(uocks):
+                cache.add('a' * 32, i, uock, 50, pk_script, 2, i == 0, address_hint)
+            self.assertEqual(cache.get('a' * 32, 1), (uocks[1], 50, pk_script, 2, False, address_hint))
+
+            # a script with the same hint, but another address
+            other = pycoind.blockchain.keys.get_uock(pycoind.blockchain.keys.get_txck(2, 1), 0)
+            cache.add('d' * 32, 0, other, 25, 'script', 2, False, address_hint)
+            self.assertEqual(cache.get('b' * 32, 1), None)
+
+            # spending an unflushed output never touches the database
+            cache.spend('a' * 32, 0, uocks[0])
+            self.assertEqual(cache.spent, set())
+            self.assertEqual(list_unspent(), uocks[1:])
+
+            database.flush()
+            cursor = database._connection.cursor()
+            cursor.execute('select uock, value, pk_script, height from unspent order by uock')
+            rows = cursor.fetchall()
+            self.assertEqual([r[0] for r in rows], uocks[1:] + [other])
+            self.assertEqual([(r[1], pycoind.blockchain.unspent.decompress_script(r[2]), r[3]) for r in rows], [(50, pk_script, 2)] * 2 + [(25, 'script', 2)])
+
+            # spending a flushed output deletes it on the next flush
+            cache.spend('a' * 32, 1, uocks[1])
+            self.assertEqual(list_unspent(), uocks[2:])
+            database.flush()
+            self.assertEqual(list_unspent(), uocks[2:])
+
+            # spending a missing output is an error, and changes nothing...
+            def stored():
+                cursor.execute('select uock from unspent order by uock')
+                return [r[0] for r in cursor.fetchall()]
+            added = pycoind.blockchain.keys.get_uock(pycoind.blockchain.keys.get_txck(3, 0), 0)
+            cache.add('e' * 32, 0, added, 10, 'script', 3, False, address_hint)
+            cache.spend('d' * 32, 0, other)
+            cache.spend('c' * 32, 0, uocks[0])
+            self.assertRaises(Exception, database.flush)
+            self.assertEqual(stored(), uocks[2:] + [other])
+            self.assertEqual(list_unspent(), uocks[2:])
+
+            # ...and nothing is lost; a retry writes everything
+            cache.spent.discard(uocks[0])
+            database.flush()
+            self.assertEqual(stored(), uocks[2:] + [added])
+            self.assertEqual(cache.spent, set())
+
+            self.assertEqual(database.unspent_outputs(address), [(uocks[2], 50, pk_script)])
+            self.assertEqual(database.balance(address), 50)
+
+            # many addresses at once (invalid addresses have nothing)
+            empty = '1BitcoinEaterAddressDontSendf59kuE'
+            self.assertEqual(database.unspent_outputs_many([address, empty, 'invalid']), {address: [(uocks[2], 50, pk_script)], empty: [ ], 'invalid': [ ]})
+            self.assertEqual(database.balances([address, empty]), {address: 50, empty: 0})
+
+        self.run_in_new_data_dir(test)
+
+
+    def test_double_spend(self):
+        keys = pycoind.blockchain.keys
+        protocol = pycoind.protocol
+        unspent = pycoind.blockchain.unspent
+
+        def transaction(blockid, index, previous_outputs):
+            tx_in = [protocol.TxnIn(protocol.OutPoint(h, i), '', 0xffffffff) for (h, i) in previous_outputs]
+            txn = protocol.Txn(1, tx_in, [protocol.TxnOut(50, 'script')], 0)
+            row = (keys.get_txck(blockid, index), keys.get_hint(txn.hash), buffer(txn.binary()), buffer(txn.hash))
+            return pycoind.blockchain.transaction.Transaction(None, row, txn)
+
+        # an output from block 2, in the database, the cache (clean) and the
+        # cache (dirty)
+        txid = 'a' * 32
+        uock = keys.get_uock(keys.get_txck(2, 0), 0)
+        class TransactionDatabase(object):
+            def _get_txck(self, h):
+                return {txid: keys.get_txck(2, 0)}.get(h)
+
+        def test(data_dir):
+            database = unspent.Database(data_dir, processes = 1)
+            cache = database._cache
+
+            def check(where):
+                coinbase = transaction(3, 0, [('\0' * 32, 0xffffffff)])
+                created = transaction(3, 1, [(txid, 0)])
+
+                blocks = [
+                    # twice in one transaction
+                    [coinbase, transaction(3, 1, [(txid, 0), (txid, 0)])],
+
+                    # once in each of two transactions
+                    [coinbase, created, transaction(3, 2, [(txid, 0)])],
+
+                    # an output created earlier in the block, twice
+                    [coinbase, created, transaction(3, 2, [(created.hash, 0), (created.hash, 0)])],
+                    [coinbase, created, transaction(3, 2, [(created.hash, 0)]), transaction(3, 3, [(created.hash, 0)])],
+                ]
+
+                for txns in blocks:
+                    before = (len(cache), cache.dirty, set(cache.spent))
+                    self.assertRaises(unspent.InvalidTransactionException, database._load_previous_outputs, txns, TransactionDatabase())
+                    self.assertEqual((len(cache), cache.dirty, set(cache.spent)), before, where)
+
+                # spending it once is fine
+                undo = database._load_previous_outputs([coinbase, created], TransactionDatabase())
+                self.assertEqual(created._previous_uock(0), uock)
+                self.assertEqual([u[0] for u in undo], [uock])
+
+            cache.add(txid, 0, uock, 50, 'script', 0, True, 1)
+            check('dirty')
+
+            database.flush()
+            check('clean')
+
+            cache.clear()
+            check('database')
+
+            # the database still flushes afterwards
+            database.flush()
+
+        self.run_in_new_data_dir(test)
+
+
+    def test_blockchain_unspent(self):
+        keys = pycoind.blockchain.keys
+
+        address = '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'
+        address_hint = keys.get_address_hint(address)
+        pk_script = ('76a914' + '62e907b15cbf27d5425399ebf6f0fb50ebb88f18' + '88ac').decode('hex')
+
+        # another address with the same hint (a false positive)
+        collision = ('76a914' + '62e907b15cbf27d5ff' + ('00' * 11) + '88ac').decode('hex')
+        self.assertEqual(keys.get_pubkeyhash_hint(collision[3:23]), address_hint)
+
+        empty = '1BitcoinEaterAddressDontSendf59kuE'
+        p2sh = '3P14159f73E4gFr7JterCCQh9QjiTjiZrG'
+
+        def test(database):
+            txns = self.get_transactions(self.block_0_txns)
+            txid = txns[0].hash
+            database._txns.add(database[0], txns)
+            txck = database._txns._get_txck(txid)
+
+            blockchain = pycoind.BlockChain(database.data_dir)
+            cache = blockchain._unspent._cache
+            cache.add(txid, 0, keys.get_uock(txck, 0), 150000000, pk_script, 0, True, address_hint)
+            cache.add(txid, 1, keys.get_uock(txck, 1), 25, collision, 0, True, address_hint)
+
+            # unflushed (from the cache) and flushed outputs are both found,
+            # and the hint's false positive is not
+            for i in xrange(0, 2):
+                outputs = blockchain.get_unspent_outputs_many([address, empty])
+                self.assertEqual(sorted(outputs), sorted([address, empty]))
+                self.assertEqual([(o.hash, o.index, t.value, t.pk_script) for (o, t) in outputs[address]], [(txid, 0, 150000000, pk_script)])
+                self.assertEqual(outputs[empty], [ ])
+                self.assertEqual(blockchain.get_balances([address, empty]), {address: 1.5, empty: 0.0})
+                blockchain._unspent.flush()
+
+            # a single address (the balance is in coins, not satoshis)
+            outputs = blockchain.get_unspent_outputs(address)
+            self.assertEqual([(o.hash, o.index, t.value, t.pk_script) for (o, t) in outputs], [(txid, 0, 150000000, pk_script)])
+            self.assertEqual(blockchain.get_balance(address), 1.5)
+            self.assertEqual(blockchain.get_balance(empty), 0.0)
+
+            # only pay-to-pubkey-hash addresses are indexed
+            self.assertRaises(ValueError, blockchain.get_unspent_outputs, p2sh)
+            self.assertRaises(ValueError, blockchain.get_balance, p2sh)
+            self.assertRaises(ValueError, blockchain.get_balances, [address, p2sh])
+
+            # a reader has nothing to write on close (and may be readonly)
+            reader = pycoind.blockchain.unspent.Database(database.data_dir, processes = 1, profile = 'readonly')
+            self.assertEqual(reader.balance(address), 150000000)
+
+        self.run_on_new_database(test)
+
+
+    def test_rollback(self):
+        keys = pycoind.blockchain.keys
+        unspent = pycoind.blockchain.unspent
+
+        address = '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'
+        address_hint = keys.get_address_hint(address)
+
+        def test(data_dir):
+            database = unspent.Database(data_dir, processes = 1)
+            cache = database._cache
+            cursor = database._connection.cursor()
+
+            def rows():
+                cursor.execute(database.sql_select + ' order by uock')
+                return [tuple(r) for r in cursor.fetchall()]
+
+            # block 2 creates an output
+            uock_a = keys.get_uock(keys.get_txck(2, 0), 0)
+            cache.add('a' * 32, 0, uock_a, 50, 'script', 0, True, address_hint)
+            database._update(FakeBlock(2, 1, 0), [ ], [ ])
+            database.flush()
+            before = rows()
+
+            # block 3 spends it and creates another
+            spent = (uock_a, address_hint, 50, buffer(unspent.compress_script('script')), 0, True)
+            self.assertEqual(unspent.unpack_undo(unspent.pack_undo([spent])), [spent])
+
+            cache.spend('a' * 32, 0, uock_a)
+            uock_b = keys.get_uock(keys.get_txck(3, 1), 0)
+            cache.add('b' * 32, 0, uock_b, 49, 'script', 1, False, address_hint)
+            database._update(FakeBlock(3, 2, 1), [ ], [spent])
+            database.flush()
+            self.assertEqual([r[0] for r in rows()], [uock_b])
+
+            # only the latest block can be rolled back
+            self.assertRaises(ValueError, database.rollback, FakeBlock(2, 1, 0))
+
+            database.rollback(FakeBlock(3, 2, 1))
+            self.assertEqual(rows(), before)
+            self.assertEqual(database.last_valid_block, 2)
+            self.assertEqual(database.get_metadata(cursor, unspent.KEY_LAST_VALID_BLOCK), 2)
+            self.assertEqual(len(cache), 0)
+
+            # the undo data is consumed
+            database._last_valid_block = 3
+            self.assertRaises(ValueError, database.rollback, FakeBlock(3, 2, 1))
+            self.assertEqual(rows(), before)
+
+        self.run_in_new_data_dir(test)
+
+
+    def test_connect_fork(self):
+        keys = pycoind.blockchain.keys
+
+        def test(blocks):
+            database = pycoind.blockchain.unspent.Database(blocks.data_dir, processes = 1)
+
+            # each block adds one output (its transactions are not needed)
+            def prepare(block):
+                uock = keys.get_uock(keys.get_txck(block._blockid, 0), 0)
+                database._cache.add(block.hash, 0, uock, 50, 'script', block.height, True, 1)
+                database._update(block, [ ], [ ])
+                return (block, lambda: [True])
+            database._prepare = prepare
+
+            def downloaded():
+                blocks._cursor().execute('update blocks set txn_count = 1 where height >= 0')
+                blocks._connection.commit()
+
+            def outputs():
+                database.flush()
+                cursor = database._connection.cursor()
+                cursor.execute('select uock from unspent order by uock')
+                return [blocks._get(keys.get_txck_blockid(keys.get_uock_txck(r[0]))).hash for r in cursor.fetchall()]
+
+            mainchain = [self.get_header(b) for b in (self.block_1, self.block_2)]
+            blocks.add_headers(mainchain)
+            downloaded()
+
+            # out of time after the first block
+            self.assertEqual(database.connect(blocks, duration = 0), 1)
+            self.assertEqual(database.connect(blocks), 2)
+            self.assertEqual(outputs(), [blocks[0].hash] + [h.hash for h in mainchain])
+
+            # a longer fork becomes the mainchain; its blocks replace ours
+            fork = [self.get_header(b) for b in (self.block_1_a, self.block_2_aa, self.block_3_aaa, self.block_4_aaaa)]
+            blocks.add_headers(fork)
+            downloaded()
+            self.assertEqual(database.connect(blocks), 4)
+            self.assertEqual(outputs(), [blocks[0].hash] + [h.hash for h in fork])
+            self.assertEqual(database.last_valid_block, blocks[-1]._blockid)
+
+            # and following it again changes nothing
+            self.assertEqual(database.connect(blocks), 0)
+
+        self.run_on_new_database(test)
+
+
+    def test_pipeline_discard(self):
+        keys = pycoind.blockchain.keys
+        unspent = pycoind.blockchain.unspent
+
+        def test(data_dir):
+            database = unspent.Database(data_dir, processes = 1)
+
+            # each block adds one output to the cache, as if it were valid
+            invalid = set([2])
+            def prepare(block):
+                uock = keys.get_uock(keys.get_txck(block._blockid, 0), 0)
+                database._cache.add(chr(block._blockid) * 32, 0, uock, 50, 'script', block.height, True, 1)
+                database._update(block, [ ], [ ])
+                return (block, lambda: [block._blockid not in invalid])
+            database._prepare = prepare
+
+            # the following blocks were prepared, but are dropped too
+            blocks = [FakeBlock(2, 1, 0), FakeBlock(3, 2, 1), FakeBlock(4, 3, 2)]
+            self.assertRaises(unspent.InvalidTransactionException, database.update_blocks, blocks)
+            self.assertEqual(database.last_valid_block, 1)
+            self.assertEqual(len(database._cache), 0)
+            self.assertEqual(database._undo, [ ])
+
+            # the blocks' iterator failing (before or after the first block)
+            # raises its own exception, and drops what was not yet verified
+            def failing(count):
+                for block in blocks[:count]:
+                    yield block
+                raise KeyError('missing block')
+
+            invalid.clear()
+            for count in (0, 2):
+                self.assertRaises(KeyError, database.update_blocks, failing(count))
+                self.assertEqual(database.last_valid_block, 1)
+                self.assertEqual(len(database._cache), 0)
+
+            self.assertEqual(database.update_blocks(blocks), 3)
+            self.assertEqual(database.last_valid_block, 4)
+            self.assertEqual(len(database._cache), 3)
+
+            # and everything is flushed before returning, for other readers
+            self.assertEqual(database._unflushed, [ ])
+            self.assertFalse(database._cache.dirty)
+            reader = unspent.Database(data_dir, processes = 1, profile = 'readonly')
+            self.assertEqual(reader.last_valid_block, 4)
+            cursor = reader._connection.cursor()
+            cursor.execute('select count(*) from unspent')
+            self.assertEqual(cursor.fetchone()[0], 3)
+            reader.close()
+
+        self.run_in_new_data_dir(test)
+
+
+    def test_assume_valid(self):
+        block_3 = self.get_header(self.block_3)
+
+        class CheckpointCoin(pycoind.coins.Bitcoin):
+            checkpoints = [(3, block_3.hash)]
+
+        def test(data_dir):
+            blocks = pycoind.blockchain.block.Database(data_dir, CheckpointCoin)
+            headers = [self.get_header(b) for b in (self.block_1, self.block_2, self.block_3, self.block_4, self.block_1_a)]
+            blocks.add_headers(headers)
+
+            database = pycoind.blockchain.unspent.Database(data_dir, CheckpointCoin, processes = 1, assume_valid = True)
+            self.assertEqual([database._assumed_valid(blocks[h]) for h in xrange(0, 5)], [True] * 4 + [False])
+
+            # orphaned blocks are always verified
+            self.assertFalse(database._assumed_valid(blocks.get(headers[-1].hash, orphans = True)))
+
+            # as is everything, unless requested
+            database = pycoind.blockchain.unspent.Database(data_dir, CheckpointCoin, processes = 1)
+            self.assertFalse(database._assumed_valid(blocks[1]))
+
+        self.run_in_new_data_dir(test)
+
+        # checkpoints must be in ascending order
+        for coin in pycoind.coins.Coins:
+            heights = [h for (h, b) in coin.checkpoints]
+            self.assertEqual(heights, sorted(heights))
+            self.assertTrue(all(len(b) == 32 for (h, b) in coin.checkpoints))
+
+
+    def test_verify_items(self):
+        unspent = pycoind.blockchain.unspent
+
+        # Block: bitcoin@170 (spending the pay-to-pubkey coinbase of bitcoin@9)
+        # Txn: f4184fc596403b9d638783cf57adfe4c75c605f6356fbc91338530e9831e9e16
+        txn_bytes = '0100000001c997a5e56e104102fa209c6a852dd90660a20b2d9c352423edce25857fcd3704000000004847304402204e45e16932b8af514961a1d3a1a25fdf3f4f7732e9d624c6c61548ab5fb8cd410220181522ec8eca07de4860a4acdd12909d831cc56cbbac4622082221a8768d1d0901ffffffff0200ca9a3b00000000434104ae1a62fe09c5f51b13905f07f06b99a2f7159b2225f374cd378d71302fa28414e7aab37397f554a7df5f142c21c1b7303b8a0626f1baded5c72a704f7e6cd84cac00286bee0000000043410411db93e1dcdb8a016b49840f8c53bc1eb68a382e97b1482ecad7b148a6909a5cb2e0eaddfb84ccf9744464f82e160bfa9b8b64f9d4c03f999b8643f656b412a3ac00000000'.decode('hex')
+        pk_script = '410411db93e1dcdb8a016b49840f8c53bc1eb68a382e97b1482ecad7b148a6909a5cb2e0eaddfb84ccf9744464f82e160bfa9b8b64f9d4c03f999b8643f656b412a3ac'.decode('hex')
+
+        # the full scripts
+        self.assertTrue(unspent.verify_item((unspent.WORK_SCRIPT, txn_bytes, 0, pk_script)))
+
+        # the compact signature check
+        txio = pycoind.script.Script(unspent._TxnView(txn_bytes))
+        (digest, public_key, signature) = txio.signature_check(0, pk_script)
+        self.assertTrue(unspent.verify_item((unspent.WORK_SIGNATURE, digest, public_key, signature)))
+        self.assertFalse(unspent.verify_item((unspent.WORK_SIGNATURE, digest[::-1], public_key, signature)))
+
+        # non-standard scripts must be processed in full
+        self.assertEqual(txio.signature_check(0, pk_script + chr(0x61)), None)
+
+
+    def test_compress_script(self):
+        unspent = pycoind.blockchain.unspent
+
+        # the genesis coinbase (pay-to-pubkey, uncompressed)
+        genesis = '4104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac'.decode('hex')
+
+        scripts = [
+            ('76a914' + ('11' * 20) + '88ac').decode('hex'),
+            ('a914' + ('22' * 20) + '87').decode('hex'),
+            ('21' + '02' + ('33' * 32) + 'ac').decode('hex'),
+            genesis,
+            'not a standard script',
+        ]
+        sizes = [21, 21, 33, 33, 22]
+
+        for (pk_script, size) in zip(scripts, sizes):
+            compressed = unspent.compress_script(pk_script)
+            self.assertEqual(len(compressed), size)
+            self.assertEqual(unspent.decompress_script(compressed), pk_script)
+
+        # a public key not on the curve is stored verbatim
+        bad = '4104' + ('44' * 64) + 'ac'
+        self.assertEqual(unspent.compress_script(bad.decode('hex'))[0], '\xff')
+
+
+    def test_profiles(self):
+        import sqlite3
+
+        def test(data_dir):
+            database = pycoind.blockchain.block.Database(data_dir, profile = 'steady')
+            mode = database._cursor().execute('pragma journal_mode').fetchone()[0]
+            self.assertEqual(mode, 'wal')
+            self.assertTrue(database.add_header(self.get_header(self.block_1)))
+
+            # readers see the writer's data, but cannot write
+            reader = pycoind.blockchain.block.Database(data_dir, profile = 'readonly')
+            self.assertEqual(reader[-1].hash, self.get_header(self.block_1).hash)
+            self.assertRaises(sqlite3.OperationalError, reader.add_header, self.get_header(self.block_2))
+
+            self.assertRaises(ValueError, pycoind.blockchain.block.Database, data_dir, profile = 'bogus')
+
+        self.run_in_new_data_dir(test)
+
+
     def test_forking(self):
 
         # maps blockhash => set(blockhashes...)
@@ -0,0 +1,105 @@
+import sys
+sys.path.append('.')
+
+import unittest
+
+import pycoind
+
+from pycoind.protocol import format
+
+class TestProtocol(unittest.TestCase):
+
+    # Block: bitcoin@0 (genesis)
+    block_0 = '0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c0101000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000'.decode('hex')
+
+    magic = pycoind.coins.Bitcoin.magic
+
+    def setUp(self):
+        pass
+
+
+    def test_block_message(self):
+        (vl, block) = format.CompoundType.parse.__func__(pycoind.protocol.Block, self.block_0)
+        self.assertEqual(vl, len(self.block_0))
+        self.assertEqual(len(block.txns), 1)
+        self.assertEqual(block.txns[0].hash, block.merkle_root)
+
+        # round trip through the wire format
+        data = block.binary(self.magic)
+        message = pycoind.protocol.Message.parse(data, self.magic)
+        self.assertEqual(message.binary(self.magic), data)
+        self.assertEqual(message.txns[0].hash, block.merkle_root)
+
+
+    def test_parse_from(self):
+
+        # parsing from an offset must match parsing the sliced data
+        prefix = 'garbage!'
+        data = prefix + self.block_0[81:]
+        (offset, txn) = pycoind.protocol.Txn.parse_from(data, len(prefix))
+        self.assertEqual(offset, len(data))
+        (vl, expected) = pycoind.protocol.Txn.parse(self.block_0[81:])
+        self.assertEqual(txn.binary(), expected.binary())
+
+        # buffers (eg. sqlite blobs) are parsed without conversion
+        (offset, header) = pycoind.protocol.BlockHeader.parse_from(buffer(self.block_0), 0)
+        self.assertEqual(offset, 81)
+        self.assertEqual(header.binary(), self.block_0[:81])
+        self.assertEqual(header.hash, pycoind.coins.Bitcoin.genesis_block_hash)
+
+
+    def test_fixed_width_run(self):
+
+        # version, prev_block, merkle_root, timestamp, bits and nonce are
+        # packed in a single struct (including a float timestamp)
+        header = pycoind.protocol.BlockHeader(1, 'a' * 32, 'b' * 32, 1231006505.5, 486604799, 7, 0)
+        data = header.binary()
+        self.assertEqual(len(data), 81)
+        self.assertEqual(data[:80], pycoind.util.get_block_header(1, 'a' * 32, 'b' * 32, 1231006505, 486604799, 7))
+
+        (vl, parsed) = pycoind.protocol.BlockHeader.parse(data)
+        self.assertEqual(vl, 81)
+        self.assertEqual(parsed.timestamp, 1231006505)
+        self.assertEqual(parsed.merkle_root, 'b' * 32)
+
+        # truncated fixed-width data is an error
+        self.assertRaises(pycoind.protocol.ParameterException, pycoind.protocol.BlockHeader.parse, data[:79])
+
+
+    def test_lazy_txn(self):
+        data = self.block_0[81:]
+        (vl, txn) = pycoind.protocol.Txn.parse(data)
+        self.assertEqual(vl, len(data))
+
+        # hashing and serializing use the original bytes without parsing
+        self.assertEqual(txn.binary(), data)
+        self.assertEqual(txn.hash, pycoind.util.sha256d(data))
+        self.assertTrue(txn._parsed is None)
+
+        # accessing a property parses the transaction
+        self.assertEqual(len(txn.tx_in), 1)
+        self.assertEqual(txn.tx_out[0].value, 5000000000)
+        self.assertEqual(txn.lock_time, 0)
+
+        # truncated transactions fail when located, not when accessed
+        self.assertRaises(pycoind.protocol.ParameterException, pycoind.protocol.Txn.parse, data[:-1])
+
+
+    def test_var_integer(self):
+        for value in (0, 0xfc, 0xfd, 0x1234, 0x12345678, 0x123456789a):
+            data = 'xx' + format.FormatTypeVarInteger.binary(value)
+            (offset, parsed) = format.FormatTypeVarInteger.parse_from(data, 2)
+            self.assertEqual(offset, len(data))
+            self.assertEqual(parsed, value)
+
+
+    def test_inventory(self):
+        inventory = [pycoind.protocol.InventoryVector(pycoind.protocol.OBJECT_TYPE_MSG_BLOCK, chr(i) * 32) for i in xrange(0, 100)]
+        data = pycoind.protocol.Inventory(inventory).binary(self.magic)
+        message = pycoind.protocol.Message.parse(data, self.magic)
+        self.assertEqual([i.hash for i in message.inventory], [i.hash for i in inventory])
+        self.assertEqual(message.binary(self.magic), data)
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(TestProtocol)
+unittest.TextTestRunner(verbosity = 2).run(suite)
@@ -28,6 +28,11 @@ class TestScriptTransactions(unittest.TestCase):
         valid = txio.verify_input(input_index, pk_script)
         self.assertTrue(valid)
 
+        # standard scripts reduce to a single signature check
+        check = txio.signature_check(input_index, pk_script)
+        self.assertTrue(check is not None)
+        self.assertTrue(pycoind.util.ecc.verify_digest(*check))
+
         # with self.assertRaises(exception):
         #self.assetRaises(exception, script.script, broken
 
@@ -388,5 +393,28 @@ class TestScriptTransactions(unittest.TestCase):
     def test_reserved_ops(self):
         pass
 
+    def test_script_pubkeyhash(self):
+        pubkeyhash = '62e907b15cbf27d5425399ebf6f0fb50ebb88f18'.decode('hex')
+        address = '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'
+
+        # canonical and non-canonical (OP_PUSHDATA1) pay-to-pubkey-hash
+        for push in ('14', '4c14'):
+            pk_script = ('76a9' + push + pubkeyhash.encode('hex') + '88ac').decode('hex')
+            self.assertEqual(pycoind.script.script_pubkeyhash(pk_script), pubkeyhash)
+            self.assertEqual(pycoind.script.script_address(pk_script), address)
+
+        # pay-to-pubkey (the genesis coinbase); repeated hits the cache
+        pk_script = '4104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac'.decode('hex')
+        for i in xrange(0, 2):
+            self.assertEqual(pycoind.script.script_address(pk_script), address)
+
+        # non-standard
+        self.assertEqual(pycoind.script.script_pubkeyhash(('a914' + pubkeyhash.encode('hex') + '87').decode('hex')), None)
+        self.assertEqual(pycoind.script.script_address(''), None)
+
+        # malformed (truncated pushes)
+        for pk_script in ('\x4c', '\x4c\x14' + pubkeyhash[:4], '\x76\xa9\x14' + pubkeyhash[:10]):
+            self.assertEqual(pycoind.script.script_pubkeyhash(pk_script), None)
+
 suite = unittest.TestLoader().loadTestsFromTestCase(TestScriptTransactions)
 unittest.TextTestRunner(verbosity=2).run(suite)